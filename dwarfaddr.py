@@ -0,0 +1,278 @@
+from dwarfmodel import die_get_attr, die_get_attr_form, die_get_name
+from elftools.dwarf.ranges import BaseAddressEntry
+from elftools.elf.elffile import ELFFile
+
+from array import array
+from bisect import bisect_right
+import argparse
+import sys
+
+# Tags of the DIEs whose children may contain scopes.
+container_tags = frozenset([
+    'DW_TAG_subprogram',
+    'DW_TAG_lexical_block',
+    'DW_TAG_namespace',
+    'DW_TAG_module',
+])
+
+def die_get_pc_ranges(die, range_lists, base):
+    low_pc = die_get_attr(die, 'DW_AT_low_pc')
+    high_pc = die_get_attr(die, 'DW_AT_high_pc')
+
+    if low_pc is not None and high_pc is not None:
+        # DWARF 4 and up encode high_pc as an offset from low_pc, when it is
+        # of the constant class.
+        if die_get_attr_form(die, 'DW_AT_high_pc') != 'DW_FORM_addr':
+            high_pc += low_pc
+
+        return [(low_pc, high_pc)]
+
+    ranges_offset = die_get_attr(die, 'DW_AT_ranges')
+
+    # DW_FORM_rnglistx (split DWARF) is not handled.
+    if ranges_offset is None or range_lists is None or \
+            die_get_attr_form(die, 'DW_AT_ranges') == 'DW_FORM_rnglistx':
+        return []
+
+    ret = []
+    for entry in range_lists.get_range_list_at_offset(ranges_offset, die.cu):
+        if isinstance(entry, BaseAddressEntry):
+            base = entry.base_address
+        elif entry.is_absolute:
+            ret.append((entry.begin_offset, entry.end_offset))
+        else:
+            ret.append((base + entry.begin_offset, base + entry.end_offset))
+
+    return [(low, high) for low, high in ret if low < high]
+
+class Scope:
+    CU = 0
+    SubProgram = 1
+    LexicalBlock = 2
+
+    # offset: absolute offset of the DIE of the scope, which is also the
+    #         offset of its element in the model
+    def __init__(self, kind, name, offset, parent):
+        self.kind = kind
+        self.name = name
+        self.offset = offset
+        self.parent = parent
+        self.depth = parent.depth + 1 if parent is not None else 0
+
+    # Returns the scopes from the CU to this one.
+    def chain(self):
+        ret = []
+        scope = self
+
+        while scope is not None:
+            ret.append(scope)
+            scope = scope.parent
+
+        ret.reverse()
+        return ret
+
+    def find(self, kind):
+        for scope in self.chain():
+            if scope.kind == kind:
+                return scope
+
+def subprogram_name(die):
+    name = die_get_name(die)
+
+    # Out-of-line definitions and concrete instances get their name from
+    # another DIE.
+    for attr_name in ('DW_AT_specification', 'DW_AT_abstract_origin'):
+        if name is not None:
+            break
+
+        if attr_name in die.attributes:
+            name = subprogram_name(die.get_DIE_from_attribute(attr_name))
+
+    return name
+
+class AddressIndex:
+    # Maps addresses to the innermost CU, subprogram or lexical block
+    # containing them.
+    #
+    # The ranges of the scopes are nested, so they are flattened into
+    # disjoint segments, each covered by a single innermost scope. A lookup
+    # is then a bisection in the segments.
+    def __init__(self, dwarf_info):
+        self.dwarf_info = dwarf_info
+        self.range_lists = dwarf_info.range_lists()
+
+        # (low, high, scope)
+        intervals = []
+
+        cu_aranges = self._read_aranges()
+
+        for cu in dwarf_info.iter_CUs():
+            top_die = cu.get_top_DIE()
+            base = die_get_attr(top_die, 'DW_AT_low_pc') or 0
+
+            cu_scope = Scope(Scope.CU, die_get_name(top_die), top_die.offset, None)
+
+            cu_ranges = cu_aranges.get(cu.cu_offset)
+            if cu_ranges is None:
+                cu_ranges = die_get_pc_ranges(top_die, self.range_lists, base)
+
+            for low, high in cu_ranges:
+                intervals.append((low, high, cu_scope))
+
+            self._collect_scopes(top_die, cu_scope, base, intervals)
+
+        self._flatten(intervals)
+
+    def _read_aranges(self):
+        # cu offset -> list of (low, high)
+        ret = dict()
+        aranges = self.dwarf_info.get_aranges()
+
+        if aranges is None:
+            return ret
+
+        for entry in aranges.entries:
+            if entry.length == 0:
+                continue
+
+            if entry.info_offset not in ret:
+                ret[entry.info_offset] = []
+
+            ret[entry.info_offset].append((entry.begin_addr, entry.begin_addr + entry.length))
+
+        return ret
+
+    def _collect_scopes(self, top_die, cu_scope, base, intervals):
+        # (die, scope of the die)
+        stack = [(top_die, cu_scope)]
+
+        while stack:
+            die, scope = stack.pop()
+
+            for child in die.iter_children():
+                tag = child.tag
+
+                if tag not in container_tags:
+                    continue
+
+                child_scope = scope
+
+                if tag == 'DW_TAG_subprogram' or tag == 'DW_TAG_lexical_block':
+                    ranges = die_get_pc_ranges(child, self.range_lists, base)
+
+                    # Declarations and abstract instances have no code.
+                    if not ranges:
+                        continue
+
+                    if tag == 'DW_TAG_subprogram':
+                        child_scope = Scope(Scope.SubProgram, subprogram_name(child), child.offset, scope)
+                    else:
+                        name = '0x{:x}-0x{:x}'.format(ranges[0][0], ranges[-1][1])
+                        child_scope = Scope(Scope.LexicalBlock, name, child.offset, scope)
+
+                    for low, high in ranges:
+                        intervals.append((low, high, child_scope))
+
+                stack.append((child, child_scope))
+
+    def _flatten(self, intervals):
+        self.starts = array('Q')
+        self.ends = array('Q')
+        self.scopes = []
+
+        def emit(low, high, scope):
+            if low < high:
+                self.starts.append(low)
+                self.ends.append(high)
+                self.scopes.append(scope)
+
+        intervals.sort(key = lambda x: (x[0], -x[1], x[2].depth))
+
+        # Intervals containing the current position, innermost last, as
+        # (high, scope).
+        stack = []
+        pos = 0
+
+        for low, high, scope in intervals:
+            while stack and stack[-1][0] <= low:
+                top_high, top_scope = stack.pop()
+                emit(pos, top_high, top_scope)
+                pos = max(pos, top_high)
+
+            if stack:
+                emit(pos, low, stack[-1][1])
+                # Don't let a badly nested interval outlive its parent.
+                high = min(high, stack[-1][0])
+
+            pos = low
+            stack.append((high, scope))
+
+        while stack:
+            top_high, top_scope = stack.pop()
+            emit(pos, top_high, top_scope)
+            pos = max(pos, top_high)
+
+    # Returns the innermost scope containing addr, or None.
+    def lookup(self, addr):
+        i = bisect_right(self.starts, addr) - 1
+
+        if i >= 0 and addr < self.ends[i]:
+            return self.scopes[i]
+
+        return None
+
+    # Returns the scopes containing an address in [low, high), and their
+    # parents, in the order of their offsets.
+    def lookup_range(self, low, high):
+        scopes = dict()
+        i = max(0, bisect_right(self.starts, low) - 1)
+
+        while i < len(self.starts) and self.starts[i] < high:
+            if self.ends[i] > low:
+                for scope in self.scopes[i].chain():
+                    scopes[scope.offset] = scope
+            i += 1
+
+        return [scopes[offset] for offset in sorted(scopes)]
+
+def format_scope(addr, scope):
+    if scope is None:
+        return "0x%x\t?" % addr
+
+    block = scope if scope.kind == Scope.LexicalBlock else None
+
+    names = []
+    for s in (scope.find(Scope.CU), scope.find(Scope.SubProgram), block):
+        names.append(s.name if s is not None and s.name is not None else "-")
+
+    return "0x%x\t%s" % (addr, "\t".join(names))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Resolve addresses to their CU, subprogram and innermost lexical block')
+    parser.add_argument('elfbinary', help = 'The ELF binary to analyze')
+    parser.add_argument('addresses', help = 'File with one address per line (default: stdin)', nargs = '?')
+    args = parser.parse_args()
+
+    with open(args.elfbinary, 'rb') as f:
+        elf = ELFFile(f)
+
+        if not elf.has_dwarf_info():
+            print("%s has no dwarf info." % args.elfbinary)
+            sys.exit(1)
+
+        index = AddressIndex(elf.get_dwarf_info())
+
+        addresses = open(args.addresses) if args.addresses else sys.stdin
+
+        for line in addresses:
+            line = line.strip()
+            if not line:
+                continue
+
+            try:
+                addr = int(line, 16)
+            except ValueError:
+                print("%s\tinvalid address" % line)
+                continue
+
+            print(format_scope(addr, index.lookup(addr)))
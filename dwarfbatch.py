@@ -0,0 +1,199 @@
+from dwarfmodel import DwarfModelBuilder
+from elftools.elf.elffile import ELFFile
+
+import argparse
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import resource
+import sys
+import time
+import traceback
+
+def count_elements(elem):
+    n = 0
+    stack = [elem]
+
+    while stack:
+        elem = stack.pop()
+        n += 1
+
+        for children in elem.children_groups.values():
+            stack += children
+
+    return n
+
+def analyze_file(filename):
+    result = {"file": filename}
+
+    with open(filename, 'rb') as f:
+        elf = ELFFile(f)
+
+        if not elf.has_dwarf_info():
+            result["error"] = "no DWARF info"
+            return result
+
+        builder = DwarfModelBuilder(elf.get_dwarf_info(), False, single_pass = True)
+        cus = 0
+        elements = 0
+
+        for cu, cu_elem in builder.build_iter(release = True):
+            cus += 1
+            elements += count_elements(cu_elem)
+
+    result["cus"] = cus
+    result["types"] = builder.num_types
+    result["elements"] = elements
+
+    return result
+
+def _child_main(filename, memory_limit, conn):
+    if memory_limit is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+    try:
+        result = analyze_file(filename)
+    except MemoryError:
+        result = {"file": filename, "error": "out of memory"}
+    except Exception as e:
+        result = {"file": filename, "error": traceback.format_exception_only(type(e), e)[-1].strip()}
+
+    conn.send(result)
+    conn.close()
+
+# Analyze each file in its own process, at most jobs at a time. A file that
+# takes more than timeout seconds, or more than memory_limit bytes, gets an
+# error in its result instead of stopping the batch. Returns the results in
+# the order of filenames.
+#
+# The time of each file, wall_seconds, is the wall time of its process, from
+# its start until its result is received or it is killed, so that the files
+# that fail are measured as those that don't (it includes starting Python).
+def run_batch(filenames, jobs = None, timeout = None, memory_limit = None):
+    if jobs is None:
+        jobs = os.cpu_count()
+
+    context = multiprocessing.get_context('spawn')
+    results = dict()
+    pending = list(reversed(filenames))
+    # connection -> (process, filename, start time)
+    running = dict()
+
+    def finish(conn, result):
+        proc, filename, start = running.pop(conn)
+        proc.join()
+        conn.close()
+
+        results[filename] = {"file": filename}
+        results[filename].update(result)
+        results[filename]["wall_seconds"] = time.monotonic() - start
+
+    while pending or running:
+        while pending and len(running) < jobs:
+            filename = pending.pop()
+            parent_conn, child_conn = context.Pipe(duplex = False)
+            proc = context.Process(target = _child_main, args = (filename, memory_limit, child_conn))
+            proc.start()
+            child_conn.close()
+            running[parent_conn] = (proc, filename, time.monotonic())
+
+        wait_timeout = None
+        if timeout is not None:
+            now = time.monotonic()
+            wait_timeout = max(0, min(start + timeout for proc, filename, start in running.values()) - now)
+
+        for conn in multiprocessing.connection.wait(list(running), wait_timeout):
+            try:
+                result = conn.recv()
+            except EOFError:
+                proc = running[conn][0]
+                proc.join()
+                result = {"error": "worker died (exit code %s)" % proc.exitcode}
+
+            finish(conn, result)
+
+        if timeout is not None:
+            now = time.monotonic()
+            for conn, (proc, filename, start) in list(running.items()):
+                if now - start >= timeout:
+                    proc.kill()
+                    finish(conn, {"error": "timeout after %g s" % timeout})
+
+    return [results[filename] for filename in filenames]
+
+def is_elf(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(4) == b'\x7fELF'
+    except OSError:
+        return False
+
+# Expand the directories of paths to the ELF files they contain.
+def collect_files(paths):
+    ret = []
+
+    for path in paths:
+        if not os.path.isdir(path):
+            ret.append(path)
+            continue
+
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for name in sorted(filenames):
+                filename = os.path.join(dirpath, name)
+                if not os.path.islink(filename) and is_elf(filename):
+                    ret.append(filename)
+
+    return ret
+
+def make_report(results):
+    ok = [r for r in results if "error" not in r]
+
+    return {
+        "files": results,
+        "total": {
+            "files": len(results),
+            "errors": len(results) - len(ok),
+            "cus": sum(r["cus"] for r in ok),
+            "types": sum(r["types"] for r in ok),
+            "elements": sum(r["elements"] for r in ok),
+            "wall_seconds": sum(r["wall_seconds"] for r in results),
+        },
+    }
+
+def print_text_report(report, out):
+    # The time is the wall time of the process of each file, see run_batch.
+    print("%-50s %8s %10s %12s %9s" % ("File", "CUs", "Types", "Elements", "Wall s"), file = out)
+
+    for r in report["files"]:
+        if "error" in r:
+            print("%-50s %8s %10s %12s %9.2f  error: %s" % (r["file"], "", "", "", r["wall_seconds"], r["error"]), file = out)
+        else:
+            print("%-50s %8d %10d %12d %9.2f" % (r["file"], r["cus"], r["types"], r["elements"], r["wall_seconds"]), file = out)
+
+    t = report["total"]
+    print("%-50s %8d %10d %12d %9.2f" % ("Total (%d files, %d errors)" % (t["files"], t["errors"]),
+                                         t["cus"], t["types"], t["elements"], t["wall_seconds"]), file = out)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Build the DWARF model of many ELF files and report on them')
+    parser.add_argument('paths', help = 'ELF files, or directories to search for ELF files', nargs = '+')
+    parser.add_argument('--jobs', '-j', type = int, default = None, help = 'Number of files analyzed at a time (default: number of CPUs)')
+    parser.add_argument('--timeout', type = float, default = None, help = 'Maximum time spent on a file, in seconds')
+    parser.add_argument('--memory-limit', type = int, default = None, help = 'Maximum memory used for a file, in MiB')
+    parser.add_argument('--format', choices = ["json", "text"], default = "json")
+    parser.add_argument('--output', '-o', help = 'Write the report to this file instead of stdout')
+    args = parser.parse_args()
+
+    memory_limit = args.memory_limit * 1024 * 1024 if args.memory_limit is not None else None
+    results = run_batch(collect_files(args.paths), args.jobs, args.timeout, memory_limit)
+    report = make_report(results)
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+
+    if args.format == "json":
+        json.dump(report, out, indent = 2)
+        out.write("\n")
+    else:
+        print_text_report(report, out)
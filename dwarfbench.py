@@ -0,0 +1,363 @@
+from dwarfmodel import DwarfModelBuilder, Element
+from dwarfinput import ElfInput
+import dwarfbatch
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Parameters of a generated fixture.
+#
+# cus: number of CUs (source files)
+# struct_width: number of members of the structs of each CU
+# block_depth: depth of the nested lexical blocks of the functions
+# chain_length: length of the chains of typedefs and pointers of each CU
+class FixtureParams:
+    def __init__(self, name, cus, struct_width, block_depth, chain_length):
+        self.name = name
+        self.cus = cus
+        self.struct_width = struct_width
+        self.block_depth = block_depth
+        self.chain_length = chain_length
+
+    def key(self):
+        return "%s-c%d-w%d-d%d-l%d" % (self.name, self.cus, self.struct_width, self.block_depth, self.chain_length)
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "cus": self.cus,
+            "struct_width": self.struct_width,
+            "block_depth": self.block_depth,
+            "chain_length": self.chain_length,
+        }
+
+# Each fixture stresses one dimension, the scale multiplies it.
+def default_fixtures(scale):
+    return [
+        FixtureParams("many-cus", 32 * scale, 8, 2, 2),
+        FixtureParams("wide-structs", 2, 128 * scale, 2, 2),
+        FixtureParams("deep-blocks", 2, 8, 16 * scale, 2),
+        FixtureParams("long-chains", 2, 8, 2, 32 * scale),
+    ]
+
+member_types = ["int", "long", "char", "unsigned short", "double", "char *"]
+
+# The types shared by all CUs, like those of a header.
+def generate_header(params):
+    lines = []
+
+    lines.append("struct common {")
+    for i in range(params.struct_width):
+        lines.append("\t%s m%d;" % (member_types[i % len(member_types)], i))
+    lines.append("\tstruct common *next;")
+    lines.append("};")
+    lines.append("")
+    lines.append("enum color { RED, GREEN, BLUE };")
+    lines.append("typedef struct common common_t;")
+
+    return "\n".join(lines) + "\n"
+
+def generate_cu(params, n):
+    lines = []
+
+    lines.append('#include "common.h"')
+    lines.append("")
+
+    # A struct of its own, of struct_width members.
+    lines.append("struct s%d {" % n)
+    for i in range(params.struct_width):
+        if i % 4 == 3:
+            lines.append("\tint a%d[%d];" % (i, i % 7 + 1))
+        elif i % 4 == 2:
+            lines.append("\tcommon_t *p%d;" % i)
+        else:
+            lines.append("\t%s m%d;" % (member_types[i % len(member_types)], i))
+    lines.append("\tenum color color;")
+    lines.append("\tstruct s%d *next;" % n)
+    lines.append("};")
+    lines.append("")
+
+    # Alternating typedefs and pointers: t0 is struct sN, t1 is t0 *, t2 is
+    # t1, t3 is t2 *...
+    lines.append("typedef struct s%d c%d_0;" % (n, n))
+    for i in range(1, params.chain_length + 1):
+        if i % 2:
+            lines.append("typedef c%d_%d *c%d_%d;" % (n, i - 1, n, i))
+        else:
+            lines.append("typedef c%d_%d c%d_%d;" % (n, i - 1, n, i))
+    lines.append("")
+
+    # The nested blocks each declare a variable, so that they are in the
+    # DWARF.
+    lines.append("int f%d(c%d_%d p, const volatile int *q, struct s%d *s)" % (n, n, params.chain_length, n))
+    lines.append("{")
+    lines.append("\tint v0 = *q + s->m0;")
+    for depth in range(1, params.block_depth + 1):
+        indent = "\t" * depth
+        lines.append("%s{" % indent)
+        lines.append("%s\tint v%d = v%d + %d;" % (indent, depth, depth - 1, depth))
+    lines.append("%s\treturn v%d + (p != 0);" % ("\t" * params.block_depth, params.block_depth))
+    for depth in range(params.block_depth, 0, -1):
+        lines.append("%s}" % ("\t" * depth))
+    lines.append("}")
+
+    if n == 0:
+        lines.append("")
+        lines.append("int main(void)")
+        lines.append("{")
+        lines.append("\treturn 0;")
+        lines.append("}")
+
+    return "\n".join(lines) + "\n"
+
+def write_file(path, contents):
+    with open(path, 'w') as f:
+        f.write(contents)
+
+# Write the sources of params in directory, returns their paths.
+def generate_sources(params, directory):
+    os.makedirs(directory, exist_ok = True)
+    write_file(os.path.join(directory, "common.h"), generate_header(params))
+
+    sources = []
+    for n in range(params.cus):
+        path = os.path.join(directory, "cu%d.c" % n)
+        write_file(path, generate_cu(params, n))
+        sources.append(path)
+
+    return sources
+
+def gcc_version(cc):
+    output = subprocess.run([cc, "--version"], stdout = subprocess.PIPE, universal_newlines = True, check = True).stdout
+    return output.splitlines()[0]
+
+# Build the binary of params with the given DWARF version in workdir, unless
+# it is already there. Returns its path.
+def build_fixture(params, dwarf_version, workdir, cc = "gcc"):
+    directory = os.path.join(workdir, params.key())
+    binary = os.path.join(directory, "dwarf%d" % dwarf_version)
+
+    if os.path.exists(binary):
+        return binary
+
+    sources = generate_sources(params, directory)
+    subprocess.run([cc, "-g", "-gdwarf-%d" % dwarf_version, "-O0", "-o", binary] + sources, check = True)
+
+    return binary
+
+def summarize(runs):
+    return {
+        "min": min(runs),
+        "median": statistics.median(runs),
+        "runs": runs,
+    }
+
+# Call run repeat times on a freshly opened ElfInput of filename (pyelftools
+# keeps the DIEs it has read), and return the times of the runs.
+def time_runs(filename, repeat, run):
+    runs = []
+
+    for i in range(repeat):
+        elf_input = ElfInput(filename)
+        try:
+            start = time.perf_counter()
+            run(elf_input.get_dwarf_info())
+            runs.append(time.perf_counter() - start)
+        finally:
+            elf_input.close()
+
+    return runs
+
+def run_build(dwarf_info):
+    DwarfModelBuilder(dwarf_info, False).build()
+
+def run_build_single_pass(dwarf_info):
+    DwarfModelBuilder(dwarf_info, False, single_pass = True).build()
+
+def run_build_columnar(dwarf_info):
+    DwarfModelBuilder(dwarf_info, False, single_pass = True, columnar = True).build()
+
+def run_build_step(dwarf_info):
+    generator = DwarfModelBuilder(dwarf_info, False, single_pass = True).build_step()
+
+    result = next(generator)
+    while not isinstance(result, Element):
+        result = next(generator)
+
+# Returns a DwarfUi to time build_tree_store with, or None if GTK can't be
+# used (not installed, or no display).
+def make_ui():
+    try:
+        from gi.repository import Gtk
+        import dwarftree
+    except ImportError:
+        return None
+
+    if not Gtk.init_check(sys.argv)[0]:
+        return None
+
+    return dwarftree.DwarfUi(cache = None)
+
+# Build the store of the model and create all its rows, as expanding every row
+# of the tree would.
+def fill_tree_store(ui, root_elem):
+    store = ui.build_tree_store(root_elem)
+    ui.tree.set_model(store)
+
+    iters = [store.get_iter_first()]
+    while iters:
+        it = iters.pop()
+        ui.on_tree_test_expand_row(ui.tree, it, None)
+
+        child = store.iter_children(it)
+        while child is not None:
+            iters.append(child)
+            child = store.iter_next(child)
+
+    return store
+
+def time_tree_store(ui, filename, repeat):
+    runs = []
+
+    elf_input = ElfInput(filename)
+    try:
+        root_elem = DwarfModelBuilder(elf_input.get_dwarf_info(), False, single_pass = True).build()
+    finally:
+        elf_input.close()
+
+    for i in range(repeat):
+        start = time.perf_counter()
+        fill_tree_store(ui, root_elem)
+        runs.append(time.perf_counter() - start)
+        ui.tree.set_model(None)
+
+    return runs
+
+benchmarks = [
+    ("build", run_build),
+    ("build_single_pass", run_build_single_pass),
+    ("build_step", run_build_step),
+    ("build_columnar", run_build_columnar),
+]
+
+def benchmark_fixture(filename, repeat, ui):
+    result = dict()
+
+    elf_input = ElfInput(filename)
+    try:
+        result["debug_info_size"] = elf_input.get_dwarf_info().debug_info_sec.size
+    finally:
+        elf_input.close()
+
+    analysis = dwarfbatch.analyze_file(filename)
+    result["types"] = analysis["types"]
+    result["elements"] = analysis["elements"]
+
+    times = dict()
+    for name, run in benchmarks:
+        times[name] = summarize(time_runs(filename, repeat, run))
+
+    if ui is not None:
+        times["build_tree_store"] = summarize(time_tree_store(ui, filename, repeat))
+
+    result["benchmarks"] = times
+
+    return result
+
+def run_benchmarks(fixtures, dwarf_versions, workdir, repeat, cc = "gcc", tree_store = True, verbose = False):
+    ui = make_ui() if tree_store else None
+
+    report = {
+        "python": platform.python_version(),
+        "compiler": gcc_version(cc),
+        "repeat": repeat,
+        "tree_store": ui is not None,
+        "results": [],
+    }
+
+    for params in fixtures:
+        for dwarf_version in dwarf_versions:
+            if verbose:
+                print("%s, DWARF %d" % (params.key(), dwarf_version), file = sys.stderr)
+
+            binary = build_fixture(params, dwarf_version, workdir, cc)
+
+            result = {"fixture": params.as_dict(), "dwarf_version": dwarf_version}
+            result.update(benchmark_fixture(binary, repeat, ui))
+            report["results"].append(result)
+
+    return report
+
+def result_key(result):
+    fixture = result["fixture"]
+    return (fixture["name"], fixture["cus"], fixture["struct_width"], fixture["block_depth"],
+            fixture["chain_length"], result["dwarf_version"])
+
+# Print the ratio of the median times of new to those of old, for the
+# fixtures and benchmarks they both have.
+def print_comparison(old, new, out):
+    old_results = {result_key(result): result for result in old["results"]}
+
+    print("%-40s %-18s %10s %10s %8s" % ("Fixture", "Benchmark", "Old (s)", "New (s)", "Ratio"), file = out)
+
+    for result in new["results"]:
+        old_result = old_results.get(result_key(result))
+        if old_result is None:
+            continue
+
+        fixture = "%s, DWARF %d" % (result["fixture"]["name"], result["dwarf_version"])
+
+        for name, times in result["benchmarks"].items():
+            old_times = old_result["benchmarks"].get(name)
+            if old_times is None:
+                continue
+
+            old_median = old_times["median"]
+            new_median = times["median"]
+            ratio = new_median / old_median if old_median else float('inf')
+            print("%-40s %-18s %10.4f %10.4f %7.2fx" % (fixture, name, old_median, new_median, ratio), file = out)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Time building the DWARF model of generated binaries')
+    parser.add_argument('--scale', type = int, default = 1, help = 'Multiply the size of the default fixtures')
+    parser.add_argument('--fixture', nargs = 4, type = int, action = 'append', metavar = ('CUS', 'WIDTH', 'DEPTH', 'CHAIN'),
+                        help = 'Use a fixture with these parameters instead of the default ones, can be repeated')
+    parser.add_argument('--dwarf', type = int, action = 'append', choices = [2, 3, 4, 5],
+                        help = 'DWARF version to compile the fixtures with, can be repeated (default: 4 and 5)')
+    parser.add_argument('--repeat', '-r', type = int, default = 3, help = 'Number of runs of each benchmark')
+    parser.add_argument('--workdir', help = 'Where to generate and build the fixtures, they are reused if already there')
+    parser.add_argument('--cc', default = 'gcc', help = 'The compiler to use')
+    parser.add_argument('--no-tree-store', action = "store_true", help = 'Do not time building the tree store')
+    parser.add_argument('--output', '-o', help = 'Write the results to this file instead of stdout')
+    parser.add_argument('--compare', help = 'Compare the results with those of this file, printed on stderr')
+    parser.add_argument('--verbose', action = "store_true")
+    args = parser.parse_args()
+
+    if args.fixture:
+        fixtures = [FixtureParams("custom", *fixture) for fixture in args.fixture]
+    else:
+        fixtures = default_fixtures(args.scale)
+
+    dwarf_versions = args.dwarf if args.dwarf else [4, 5]
+
+    workdir = args.workdir
+    if workdir is None:
+        workdir = os.path.join(tempfile.gettempdir(), "dwarfbench")
+
+    report = run_benchmarks(fixtures, dwarf_versions, workdir, args.repeat, args.cc,
+                            tree_store = not args.no_tree_store, verbose = args.verbose)
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    json.dump(report, out, indent = 2)
+    out.write("\n")
+
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), report, sys.stderr)
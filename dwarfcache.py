@@ -0,0 +1,137 @@
+from dwarfmodel import element_to_tuple, element_from_tuple
+
+import hashlib
+import os
+import pickle
+
+# Bump when the content of the model changes, so that old entries are not
+# used anymore.
+MODEL_VERSION = 2
+
+MAGIC = b'DWTC'
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+
+    return os.path.join(base, 'dwarftree')
+
+def elf_build_id(elf):
+    section = elf.get_section_by_name('.note.gnu.build-id')
+    if section is None:
+        return None
+
+    for note in section.iter_notes():
+        if note['n_type'] == 'NT_GNU_BUILD_ID':
+            return note['n_desc']
+
+    return None
+
+# Key of the model of the ELF file f (an opened file object, elf being the
+# pyelftools ELFFile object reading it). It is the build-id if there is one,
+# otherwise a hash of the size, modification time and content of the file.
+def model_key(elf, f):
+    build_id = elf_build_id(elf)
+    if build_id is not None:
+        return 'id-' + build_id
+
+    st = os.fstat(f.fileno())
+    h = hashlib.sha1()
+    h.update(('%d-%d-' % (st.st_size, st.st_mtime_ns)).encode())
+
+    pos = f.tell()
+    f.seek(0)
+    while True:
+        chunk = f.read(1 << 20)
+        if not chunk:
+            break
+        h.update(chunk)
+    f.seek(pos)
+
+    return 'sha1-' + h.hexdigest()
+
+class ModelCache:
+    # directory: where the entries are stored
+    # max_size: size in bytes above which the least recently used entries are
+    #           removed
+    def __init__(self, directory = None, max_size = 1 << 30):
+        if directory is None:
+            directory = default_cache_dir()
+
+        self.directory = directory
+        self.max_size = max_size
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key + '.model')
+
+    # Returns the file element stored for key, or None.
+    def load(self, key):
+        path = self._entry_path(key)
+
+        try:
+            with open(path, 'rb') as f:
+                if f.read(len(MAGIC)) != MAGIC:
+                    return None
+
+                version, file_tuple = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+            return None
+
+        if version != MODEL_VERSION:
+            return None
+
+        # The modification time of an entry is its last use.
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return element_from_tuple(file_tuple)
+
+    def store(self, key, file_elem):
+        os.makedirs(self.directory, exist_ok = True)
+
+        path = self._entry_path(key)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            pickle.dump((MODEL_VERSION, element_to_tuple(file_elem)), f,
+                        protocol = pickle.HIGHEST_PROTOCOL)
+
+        os.replace(tmp_path, path)
+
+        self.evict()
+
+    # Remove the least recently used entries until the cache fits in
+    # max_size.
+    def evict(self):
+        entries = []
+        total = 0
+
+        for name in os.listdir(self.directory):
+            if not name.endswith('.model'):
+                continue
+
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+        entries.sort()
+
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+
+            total -= size
@@ -0,0 +1,91 @@
+from array import array
+from bisect import bisect_right
+import struct
+
+# The offsets and sizes of the CUs of a .debug_info section, read from their
+# headers only. Unlike dwarf_info.iter_CUs, no CU object is created, so
+# counting the CUs or finding one is cheap even for big files.
+class CuIndex:
+    def __init__(self, dwarf_info):
+        self.dwarf_info = dwarf_info
+
+        # Offset in .debug_info of the header of each CU, in increasing order
+        self.offsets = array('Q')
+        # Offset of the end of each CU
+        self.ends = array('Q')
+        # DWARF version and abbreviation table offset of each CU
+        self.versions = array('H')
+        self.abbrev_offsets = array('Q')
+
+        if dwarf_info.debug_info_sec is not None:
+            self._scan(dwarf_info.debug_info_sec, dwarf_info.config.little_endian)
+
+    def _scan(self, section, little_endian):
+        stream = section.stream
+        size = section.size
+        endian = '<' if little_endian else '>'
+        offset = 0
+
+        while offset < size:
+            stream.seek(offset)
+            header = stream.read(24)
+
+            if len(header) < 4:
+                break
+
+            unit_length, = struct.unpack_from(endian + 'I', header, 0)
+
+            if unit_length == 0xffffffff:
+                unit_length, = struct.unpack_from(endian + 'Q', header, 4)
+                pos = 12
+                offset_format = 'Q'
+            else:
+                pos = 4
+                offset_format = 'I'
+
+            end = offset + pos + unit_length
+            if unit_length == 0 or end > size:
+                break
+
+            version, = struct.unpack_from(endian + 'H', header, pos)
+            pos += 2
+
+            # DWARF 5 puts the unit type and address size first.
+            if version >= 5:
+                pos += 2
+
+            abbrev_offset, = struct.unpack_from(endian + offset_format, header, pos)
+
+            self.offsets.append(offset)
+            self.ends.append(end)
+            self.versions.append(version)
+            self.abbrev_offsets.append(abbrev_offset)
+
+            offset = end
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def size(self, n):
+        return self.ends[n] - self.offsets[n]
+
+    # Returns the index of the CU containing the DIE at offset, or None.
+    def index_containing(self, offset):
+        n = bisect_right(self.offsets, offset) - 1
+
+        if n < 0 or offset >= self.ends[n]:
+            return None
+
+        return n
+
+    # Returns the pyelftools CU object of the nth CU.
+    def get_cu(self, n):
+        return self.dwarf_info.get_CU_at(self.offsets[n])
+
+    def get_cu_containing(self, offset):
+        n = self.index_containing(offset)
+
+        if n is None:
+            raise ValueError("No CU contains offset 0x%x" % offset)
+
+        return self.get_cu(n)
@@ -0,0 +1,294 @@
+from dwarfmodel import ChildrenGroup, DwarfModelBuilder, Element
+from dwarfinput import ElfInput
+import dwarfreload
+
+import argparse
+import hashlib
+import json
+import sys
+
+class DiffEntry:
+    # An element added, removed or changed between two models.
+    Added = 0
+    Removed = 1
+    Changed = 2
+
+    kind_names = ["added", "removed", "changed"]
+
+    __slots__ = ('kind', 'path', 'old', 'new')
+
+    # path: list of (group, name) from the CU to the element, the CU being
+    #       (None, CU name)
+    # old, new: the element in the old and new model, None for an element
+    #           added or removed
+    def __init__(self, kind, path, old, new):
+        self.kind = kind
+        self.path = path
+        self.old = old
+        self.new = new
+
+    def kind_name(self):
+        return DiffEntry.kind_names[self.kind]
+
+# The names of lexical blocks are their addresses, which change whenever code
+# moves. They are matched by position instead, and their names are not
+# compared.
+def element_key_name(group, elem):
+    if group == ChildrenGroup.LexicalBlock:
+        return None
+
+    return elem.name
+
+# Returns dict id(element) -> digest of the names and type strings of the
+# element and its descendants, for elem and its descendants. Two elements with
+# the same digest have identical subtrees, but for their DIE offsets and the
+# addresses of their lexical blocks.
+def subtree_digests(elem, group = None):
+    digests = dict()
+    # (element, its group, whether its children are done)
+    stack = [(elem, group, False)]
+
+    while stack:
+        elem, group, done = stack.pop()
+        groups = elem.children_groups
+
+        if not done:
+            stack.append((elem, group, True))
+            for child_group, children in groups.items():
+                stack.extend((child, child_group, False) for child in children)
+            continue
+
+        h = hashlib.blake2b(digest_size = 16)
+        h.update(repr((element_key_name(group, elem), elem.type_string)).encode())
+
+        for child_group, children in groups.items():
+            h.update(repr(child_group).encode())
+            for child in children:
+                h.update(digests[id(child)])
+
+        digests[id(elem)] = h.digest()
+
+    return digests
+
+# Returns the list of keys of elements, (name, number of elements of the same
+# name before it), in order.
+def element_keys(group, elements):
+    counts = dict()
+    keys = []
+
+    for elem in elements:
+        name = element_key_name(group, elem)
+        n = counts.get(name, 0)
+        counts[name] = n + 1
+        keys.append((name, n))
+
+    return keys
+
+# Yields the DiffEntry of the differences between the elements old_elem and
+# new_elem and their descendants, depth first. The children of an element are
+# matched by group and name, the nth one of a name in old_elem with the nth
+# one in new_elem. Subtrees with the same digest are skipped without looking
+# at them.
+#
+# path: the path of old_elem and new_elem
+def diff_elements(old_elem, new_elem, path, group = None):
+    old_digests = subtree_digests(old_elem, group)
+    new_digests = subtree_digests(new_elem, group)
+
+    stack = [(old_elem, new_elem, path)]
+
+    while stack:
+        old_elem, new_elem, path = stack.pop()
+
+        if old_digests[id(old_elem)] == new_digests[id(new_elem)]:
+            continue
+
+        changed = old_elem.type_string != new_elem.type_string
+        # Entries of the children, in order
+        entries = []
+        # (old child, new child, path) to compare, in order
+        pairs = []
+
+        old_groups = old_elem.children_groups
+        new_groups = new_elem.children_groups
+        groups = list(old_groups) + [group for group in new_groups if group not in old_groups]
+
+        for group in groups:
+            old_children = old_groups.get(group, [])
+            new_children = new_groups.get(group, [])
+            old_keys = element_keys(group, old_children)
+            new_keys = element_keys(group, new_children)
+            new_by_key = dict(zip(new_keys, new_children))
+            old_key_set = set(old_keys)
+
+            for key, old_child in zip(old_keys, old_children):
+                new_child = new_by_key.get(key)
+                child_path = path + [(group, old_child.name)]
+
+                if new_child is None:
+                    entries.append(DiffEntry(DiffEntry.Removed, child_path, old_child, None))
+                else:
+                    pairs.append((old_child, new_child, child_path))
+
+            for key, new_child in zip(new_keys, new_children):
+                if key not in old_key_set:
+                    entries.append(DiffEntry(DiffEntry.Added, path + [(group, new_child.name)], None, new_child))
+
+            # Members, parameters, etc. in another order
+            common = [key for key in new_keys if key in old_key_set]
+            if [key for key in old_keys if key in new_by_key] != common:
+                changed = True
+
+        if changed:
+            yield DiffEntry(DiffEntry.Changed, path, old_elem, new_elem)
+
+        yield from entries
+
+        stack.extend(reversed(pairs))
+
+def _cu_names(dwarf_info, fingerprints):
+    ret = []
+
+    for cu_offset, size, digest, base in fingerprints:
+        top_die = dwarf_info.get_CU_at(cu_offset).get_top_DIE()
+        name = top_die.attributes.get('DW_AT_name')
+        ret.append((name.value.decode() if name is not None else None, top_die.offset))
+
+    return ret
+
+class FileDiff:
+    # The differences between the models of two ELF files.
+    #
+    # The CUs are matched by name. The CUs whose DIEs are the same (see
+    # dwarfreload.cu_fingerprints) are skipped without building their
+    # model, the others are built and compared with diff_elements.
+    def __init__(self, old_filename, new_filename):
+        self.old_filename = old_filename
+        self.new_filename = new_filename
+
+        # Number of CUs found in both files and skipped, compared, only in
+        # the old file and only in the new file.
+        self.cus_skipped = 0
+        self.cus_compared = 0
+        self.cus_removed = 0
+        self.cus_added = 0
+
+        self.stop_requested = False
+
+    # Called from another thread, entries() returns at the next CU.
+    def request_stop(self):
+        self.stop_requested = True
+
+    # Yields the DiffEntry of the differences, the CUs of the old file first
+    # (in order), then those only in the new file.
+    def entries(self):
+        old_input = ElfInput(self.old_filename)
+        new_input = ElfInput(self.new_filename)
+
+        try:
+            yield from self._entries(old_input.get_dwarf_info(), new_input.get_dwarf_info())
+        finally:
+            old_input.close()
+            new_input.close()
+
+    def _entries(self, old_di, new_di):
+        old_fingerprints = dwarfreload.cu_fingerprints(old_di)
+        new_fingerprints = dwarfreload.cu_fingerprints(new_di)
+        old_names = _cu_names(old_di, old_fingerprints)
+        new_names = _cu_names(new_di, new_fingerprints)
+
+        # (CU name, number of CUs of that name before it) -> index of the new CU
+        new_by_key = dict()
+        counts = dict()
+        for i, (name, offset) in enumerate(new_names):
+            n = counts.get(name, 0)
+            counts[name] = n + 1
+            new_by_key[(name, n)] = i
+
+        old_builder = DwarfModelBuilder(old_di, False, single_pass = True, columnar = True)
+        new_builder = DwarfModelBuilder(new_di, False, single_pass = True, columnar = True)
+        matched = set()
+        counts = dict()
+
+        for old_index, (name, offset) in enumerate(old_names):
+            if self.stop_requested:
+                return
+
+            n = counts.get(name, 0)
+            counts[name] = n + 1
+            new_index = new_by_key.get((name, n))
+            path = [(None, name)]
+
+            if new_index is None:
+                self.cus_removed += 1
+                yield DiffEntry(DiffEntry.Removed, path, Element(name, offset), None)
+                continue
+
+            matched.add(new_index)
+            old_digest = old_fingerprints[old_index][2]
+            new_digest = new_fingerprints[new_index][2]
+
+            if old_digest is not None and old_digest == new_digest:
+                self.cus_skipped += 1
+                continue
+
+            self.cus_compared += 1
+            old_cu_elem = old_builder.build_cu(old_di.get_CU_at(old_fingerprints[old_index][0]))
+            new_cu_elem = new_builder.build_cu(new_di.get_CU_at(new_fingerprints[new_index][0]))
+
+            yield from diff_elements(old_cu_elem, new_cu_elem, path)
+
+        for new_index, (name, offset) in enumerate(new_names):
+            if new_index not in matched:
+                self.cus_added += 1
+                yield DiffEntry(DiffEntry.Added, [(None, name)], None, Element(name, offset))
+
+def format_path(path):
+    return " > ".join(name if name is not None else "<anonymous>" for group, name in path)
+
+def format_entry(entry):
+    if entry.kind == DiffEntry.Added:
+        elem = entry.new
+        line = "+ " + format_path(entry.path)
+    elif entry.kind == DiffEntry.Removed:
+        elem = entry.old
+        line = "- " + format_path(entry.path)
+    else:
+        line = "~ " + format_path(entry.path)
+        if entry.old.type_string != entry.new.type_string:
+            line += ": %s -> %s" % (entry.old.type_string, entry.new.type_string)
+        else:
+            line += ": reordered"
+        return line
+
+    if elem.type_string:
+        line += ": " + elem.type_string
+
+    return line
+
+def entry_to_json(entry):
+    return {
+        "kind": entry.kind_name(),
+        "path": [{"group": ChildrenGroup.name(group) if group is not None else None, "name": name}
+                 for group, name in entry.path],
+        "old": {"offset": entry.old.offset, "type": entry.old.type_string} if entry.old is not None else None,
+        "new": {"offset": entry.new.offset, "type": entry.new.type_string} if entry.new is not None else None,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Print the differences between the DWARF models of two ELF binaries')
+    parser.add_argument('old', help = 'The old ELF binary')
+    parser.add_argument('new', help = 'The new ELF binary')
+    parser.add_argument('--format', choices = ["text", "jsonl"], default = "text")
+    args = parser.parse_args()
+
+    diff = FileDiff(args.old, args.new)
+
+    for entry in diff.entries():
+        if args.format == "text":
+            print(format_entry(entry))
+        else:
+            print(json.dumps(entry_to_json(entry)))
+
+    print("%d CUs unchanged, %d compared, %d removed, %d added" %
+          (diff.cus_skipped, diff.cus_compared, diff.cus_removed, diff.cus_added), file = sys.stderr)
@@ -0,0 +1,192 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from dwarfmodel import SharedElement
+
+class NameIndex:
+    # Index of the names and type strings of the elements of a model, built
+    # once and then queried with search().
+    #
+    # Each element is an entry, identified by its number. The entries are
+    # numbered depth first, in the order of the model (that of the DIEs), so
+    # the descendants of an entry are the entries following it, but for those
+    # of the CUs of a lazily built model loaded after the index was built
+    # (see index_loaded). The path of an entry is kept as its parent entry,
+    # the group it is in and its position in that group.
+    def __init__(self, root_elem):
+        self.elements = []
+        self.parents = array('l')
+        # ChildrenGroup of the entry in its parent, -1 for None
+        self.groups = array('b')
+        self.positions = array('l')
+        # DIE offset -> entry, built on first use
+        self.offsets = None
+        # Entries of the elements whose children were not loaded when they
+        # were indexed (the CUs of a lazily built model), see index_loaded
+        self.unloaded = []
+
+        # lowered name or type string -> list of entries
+        keys = dict()
+        self._add_entries([(root_elem, -1, -1, 0)], keys)
+        self._set_keys(keys)
+
+    # stack: list of (element, parent entry, group, position), the elements
+    # to add with their descendants, last first.
+    def _add_entries(self, stack, keys):
+        while stack:
+            elem, parent, group, position = stack.pop()
+
+            entry = len(self.elements)
+            self.elements.append(elem)
+            self.parents.append(parent)
+            self.groups.append(group)
+            self.positions.append(position)
+
+            for key in (elem.name, elem.type_string):
+                if key:
+                    key = key.lower()
+                    if key not in keys:
+                        keys[key] = []
+                    keys[key].append(entry)
+
+            if not self.is_loaded(elem):
+                self.unloaded.append(entry)
+                continue
+
+            self._push_children(stack, elem, entry)
+
+    def _push_children(self, stack, elem, entry):
+        # Pushed last to first, so that they are popped in order.
+        pending = []
+
+        for child_group, children in elem.children_groups.items():
+            if child_group is None:
+                child_group = -1
+
+            for i, child in enumerate(children):
+                pending.append((child, entry, child_group, i))
+
+        stack.extend(reversed(pending))
+
+    def _set_keys(self, keys):
+        self.keys = sorted(keys)
+        self.key_entries = [keys[k] for k in self.keys]
+
+        # All the keys in one string, so that substring searches are done
+        # by str.find instead of a Python loop over the keys.
+        self.haystack = '\n'.join(self.keys)
+        self.key_starts = array('l')
+        start = 0
+        for key in self.keys:
+            self.key_starts.append(start)
+            start += len(key) + 1
+
+    # Don't load the CUs of a lazily built model just to index them.
+    def is_loaded(self, elem):
+        is_loaded = getattr(elem, 'is_loaded', None)
+        return is_loaded is None or is_loaded()
+
+    # Index the descendants of the elements that were not loaded when they
+    # were indexed, and are now (e.g. the CUs of a lazily built model
+    # expanded since). Their entries are numbered after all the others. Called
+    # by the queries.
+    def index_loaded(self):
+        loaded = [entry for entry in self.unloaded if self.is_loaded(self.elements[entry])]
+        if not loaded:
+            return
+
+        loaded_set = set(loaded)
+        self.unloaded = [entry for entry in self.unloaded if entry not in loaded_set]
+
+        keys = dict(zip(self.keys, self.key_entries))
+        stack = []
+        for entry in reversed(loaded):
+            self._push_children(stack, self.elements[entry], entry)
+
+        self._add_entries(stack, keys)
+        self._set_keys(keys)
+        self.offsets = None
+
+    # Returns the number of elements whose children are not indexed, because
+    # they are not loaded yet.
+    def unloaded_count(self):
+        self.index_loaded()
+        return len(self.unloaded)
+
+    def __len__(self):
+        return len(self.elements)
+
+    def element(self, entry):
+        return self.elements[entry]
+
+    # Returns the entry of the element of the DIE at offset, or None.
+    def entry_at_offset(self, offset):
+        self.index_loaded()
+
+        if self.offsets is None:
+            self.offsets = dict()
+            # SharedElement each entry is under, or None
+            shared_types = []
+
+            for entry, elem in enumerate(self.elements):
+                parent = self.parents[entry]
+                shared = shared_types[parent] if parent >= 0 else None
+
+                if shared is not None:
+                    self.offsets.setdefault(shared.child_offset(elem), entry)
+                elif elem.offset is not None:
+                    self.offsets.setdefault(elem.offset, entry)
+
+                if isinstance(elem, SharedElement):
+                    shared = elem
+                shared_types.append(shared)
+
+        return self.offsets.get(offset)
+
+    # Returns the path from the root to entry, as a list of
+    # (group, position), group being a ChildrenGroup or None.
+    def path(self, entry):
+        ret = []
+
+        while self.parents[entry] >= 0:
+            group = self.groups[entry]
+            ret.append((group if group >= 0 else None, self.positions[entry]))
+            entry = self.parents[entry]
+
+        ret.reverse()
+        return ret
+
+    # Yields the entries whose name or type string contains query (or starts
+    # with it, if prefix is True), case insensitively. Entries matching both
+    # by name and by type string may be yielded twice.
+    def search(self, query, prefix = False):
+        self.index_loaded()
+        query = query.lower()
+
+        if not query or '\n' in query:
+            return
+
+        # index_loaded may replace them while the results are consumed.
+        keys = self.keys
+        key_entries = self.key_entries
+
+        if prefix:
+            i = bisect_left(keys, query)
+            while i < len(keys) and keys[i].startswith(query):
+                yield from key_entries[i]
+                i += 1
+
+            return
+
+        haystack = self.haystack
+        key_starts = self.key_starts
+        pos = haystack.find(query)
+
+        while pos >= 0:
+            i = bisect_right(key_starts, pos) - 1
+            yield from key_entries[i]
+
+            # Continue after this key, it's been reported already.
+            if i + 1 == len(keys):
+                break
+
+            pos = haystack.find(query, key_starts[i + 1])
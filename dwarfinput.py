@@ -0,0 +1,108 @@
+from elftools.elf.elffile import ELFFile
+from elftools.dwarf.dwarfinfo import DebugSectionDescriptor
+
+from io import BytesIO
+import mmap
+import struct
+import zlib
+
+class MappedELFFile(ELFFile):
+    # An ELFFile reading from a memory map of the file, whose DWARF sections
+    # are read (and decompressed) once and shared by all the DWARFInfo
+    # objects created by get_dwarf_info.
+    #
+    # pyelftools needs a stream per section, so the content of a section is
+    # copied out of the map once. A BytesIO created from a bytes object
+    # shares its buffer, so the streams handed to each DWARFInfo don't copy
+    # it again.
+    def __init__(self, stream):
+        super(MappedELFFile, self).__init__(stream)
+
+        # section name -> bytes
+        self.section_buffers = dict()
+
+    def _section_buffer(self, section):
+        name = section.name
+
+        if name not in self.section_buffers:
+            # Decompresses SHF_COMPRESSED sections.
+            data = section.data()
+
+            if name.startswith('.zdebug'):
+                data = decompress_zdebug(data)
+
+            self.section_buffers[name] = data
+
+        return self.section_buffers[name]
+
+    def _read_dwarf_section(self, section, relocate_dwarf_sections):
+        # Relocations are only found in object files, let pyelftools apply
+        # them on its own copy.
+        if (relocate_dwarf_sections and self['e_type'] == 'ET_REL') or self.has_phantom_bytes():
+            ret = super(MappedELFFile, self)._read_dwarf_section(section, relocate_dwarf_sections)
+
+            if section.name.startswith('.zdebug'):
+                ret = ELFFile._decompress_dwarf_section(ret)
+
+            return ret
+
+        data = self._section_buffer(section)
+
+        return DebugSectionDescriptor(
+                stream = BytesIO(data),
+                name = section.name,
+                global_offset = section['sh_offset'],
+                size = len(data),
+                address = section['sh_addr'])
+
+    # .zdebug sections are decompressed by _read_dwarf_section already.
+    @staticmethod
+    def _decompress_dwarf_section(section):
+        return section
+
+def decompress_zdebug(data):
+    # "ZLIB" followed by the uncompressed size, in big endian
+    assert data[:4] == b'ZLIB', 'Invalid compression type: %r' % (data[:4])
+    uncompressed_size, = struct.unpack_from('>Q', data, 4)
+
+    ret = zlib.decompress(data[12:])
+    assert len(ret) == uncompressed_size, \
+        'Wrong uncompressed size: expected %r, but got %r' % (uncompressed_size, len(ret))
+
+    return ret
+
+class ElfInput:
+    # An opened ELF file. The file is memory mapped, so that pyelftools reads
+    # don't each need a system call. close() must be called once done with
+    # it, the DWARFInfo objects it returned remain usable after that.
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        self.map = None
+
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Empty file, or a file that can't be mapped: read it directly.
+            pass
+
+        try:
+            self.elf = MappedELFFile(self.map if self.map is not None else self.file)
+        except:
+            self.close()
+            raise
+
+    def has_dwarf_info(self):
+        return self.elf.has_dwarf_info()
+
+    def get_dwarf_info(self):
+        return self.elf.get_dwarf_info()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -1,4 +1,8 @@
 import sys
+import time
+from types import MappingProxyType
+from dwarfcus import CuIndex
+from dwarftable import DieTable, UnsupportedForm, LAYOUT_ATTRIBUTES, section_bytes
 
 class ChildrenGroup:
     BaseType = 0
@@ -34,21 +38,37 @@ class ChildrenGroup:
         "Variables",
     ]
 
+    types = frozenset([BaseType, StructType, EnumType, ArrayType, Typedef,
+                       Enumeration, PointerType, ConstType, VolatileType])
+
     def name(group):
         return ChildrenGroup.names[group]
 
 
+# Shared by all the elements without children, to avoid a dict per element.
+no_children = MappingProxyType(dict())
+
 class Element:
-    def __init__(self, name, die, type_string = None):
+    __slots__ = ('name', 'offset', 'type_string', 'children_groups')
+
+    # offset: absolute offset of the DIE of the element, the DIE itself is
+    #         not kept (see DwarfModelBuilder.get_die).
+    def __init__(self, name, offset, type_string = None):
         self.name = name
-        self.die = die
+        self.offset = offset
         self.type_string = type_string
 
         # Dict ChildrenGroup -> list of children of that group
-        self.children_groups = dict()
+        self.children_groups = no_children
+
+    def has_children(self):
+        return len(self.children_groups) > 0
 
     def add_child(self, group, child_elem):
-        assert(type(child_elem) == Element)
+        assert(isinstance(child_elem, Element))
+        if self.children_groups is no_children:
+            self.children_groups = dict()
+
         if group not in self.children_groups:
             self.children_groups[group] = []
 
@@ -57,16 +77,313 @@ class Element:
     def add_children(self, group, child_elements):
         assert(type(child_elements) == list)
         for x in child_elements:
-            assert(type(x) == Element)
+            assert(isinstance(x, Element))
 
         if len(child_elements) == 0:
             return
 
+        if self.children_groups is no_children:
+            self.children_groups = dict()
+
         if group not in self.children_groups:
             self.children_groups[group] = []
 
         self.children_groups[group] += child_elements
 
+# Convert an element and its children to a tuple that can be sent across
+# processes. It is flat, so that pickle doesn't recurse on deep models: the
+# element and its descendants in depth first order, each as
+#   (name, die offset, type string, ((group, number of children), ...))
+def element_to_tuple(elem):
+    records = []
+    stack = [elem]
+
+    while stack:
+        elem = stack.pop()
+        groups = elem.children_groups
+
+        records.append((elem.name, elem.offset, elem.type_string,
+                        tuple((group, len(children)) for group, children in groups.items())))
+
+        for children in reversed(list(groups.values())):
+            stack.extend(reversed(children))
+
+    return tuple(records)
+
+def element_from_tuple(records):
+    root_elem = None
+    # [element, groups of its children in order, number of children added]
+    stack = []
+
+    for name, offset, type_string, groups in records:
+        elem = Element(name, offset, type_string = type_string)
+
+        if stack:
+            parent = stack[-1]
+            parent[0].add_child(parent[1][parent[2]], elem)
+            parent[2] += 1
+        else:
+            root_elem = elem
+
+        if groups:
+            stack.append([elem, [group for group, n in groups for i in range(n)], 0])
+
+        while stack and stack[-1][2] == len(stack[-1][1]):
+            stack.pop()
+
+    return root_elem
+
+class SharedElement(Element):
+    # A type element of a CU, whose children are those of the identical type
+    # of the first CU it appears in. Only the SharedElement of that first
+    # CU, first, counts the CUs the type appears in.
+    __slots__ = ('first', 'cu_count', 'child_offsets')
+
+    def __init__(self, elem, first = None):
+        self.name = elem.name
+        self.offset = elem.offset
+        self.type_string = elem.type_string
+        self.cu_count = 1
+        # offset of a descendant of first -> offset of its DIE in this CU,
+        # None if they are all at the same distance from the type in both.
+        self.child_offsets = None
+
+        if first is None:
+            self.first = self
+            self.children_groups = elem.children_groups
+            return
+
+        self.first = first
+        self.children_groups = first.children_groups
+
+        # Both types have the same fingerprint, so their children are the
+        # same, in the same order.
+        offset_delta = self.offset - first.offset
+        child_offsets = dict()
+        stack = [(elem, first)]
+
+        while stack:
+            child, first_child = stack.pop()
+
+            if first_child is not first:
+                child_offsets[first_child.offset] = child.offset
+
+            for group, children in child.children_groups.items():
+                stack.extend(zip(children, first_child.children_groups[group]))
+
+        if any(offset - first_offset != offset_delta for first_offset, offset in child_offsets.items()):
+            self.child_offsets = child_offsets
+
+    # Returns the offset in this CU of the DIE of child, a descendant of this
+    # element.
+    def child_offset(self, child):
+        if self.child_offsets is None:
+            return child.offset + self.offset - self.first.offset
+
+        return self.child_offsets[child.offset]
+
+# Returns the values of the LAYOUT_ATTRIBUTES of die, or None if it has none
+# of them. The blocks (location expressions) are given as bytes.
+def die_get_layout(die):
+    attributes = die.attributes
+    ret = None
+
+    for i, name in enumerate(LAYOUT_ATTRIBUTES):
+        if name not in attributes:
+            continue
+
+        if ret is None:
+            ret = [None] * len(LAYOUT_ATTRIBUTES)
+
+        value = attributes[name].value
+        ret[i] = bytes(value) if isinstance(value, list) else value
+
+    return tuple(ret) if ret is not None else None
+
+class TypeDeduplicator:
+    # Replaces the type elements of CUs by a SharedElement common to all the
+    # identical types seen so far, and interns the strings of the elements.
+    #
+    # The layouts of the types and members the elements don't show are
+    # recorded while building them (see DwarfModelBuilder.layouts), and
+    # given as a dict die offset -> die_get_layout.
+    def __init__(self):
+        # (group, fingerprint) -> SharedElement of the first CU
+        self.shared_types = dict()
+        # (group, fingerprint) -> key of the last CU it was seen in
+        self.last_cu = dict()
+
+    # Returns the names, type strings and layouts of elem and its
+    # descendants, with the number of children of each group, in depth first
+    # order. Identical types of different CUs have the same fingerprint.
+    def fingerprint(self, elem, layouts):
+        records = []
+        stack = [elem]
+
+        while stack:
+            elem = stack.pop()
+            groups = elem.children_groups
+
+            records.append((elem.name, elem.type_string, layouts.get(elem.offset),
+                            tuple((group, len(children)) for group, children in groups.items())))
+
+            for children in groups.values():
+                stack.extend(children)
+
+        return tuple(records)
+
+    # cu_key: identifies the CU, e.g. its offset
+    # layouts: the layouts of the DIEs of the CU
+    def dedup_cu(self, cu_elem, cu_key, layouts):
+        intern_strings(cu_elem)
+
+        for group, children in cu_elem.children_groups.items():
+            if group not in ChildrenGroup.types:
+                continue
+
+            for i, child in enumerate(children):
+                key = (group, self.fingerprint(child, layouts))
+                first = self.shared_types.get(key)
+
+                if first is None:
+                    shared = SharedElement(child)
+                    self.shared_types[key] = shared
+                else:
+                    shared = SharedElement(child, first)
+                    if self.last_cu[key] != cu_key:
+                        first.cu_count += 1
+
+                self.last_cu[key] = cu_key
+                children[i] = shared
+
+    # layouts: the layouts of the DIEs of all the CUs
+    def dedup_file(self, file_elem, layouts):
+        for cu_elem in file_elem.children_groups.get(None, []):
+            self.dedup_cu(cu_elem, cu_elem.offset, layouts)
+
+def intern_strings(elem):
+    stack = [elem]
+
+    while stack:
+        elem = stack.pop()
+
+        if elem.name is not None:
+            elem.name = sys.intern(elem.name)
+        if elem.type_string is not None:
+            elem.type_string = sys.intern(elem.type_string)
+
+        for children in elem.children_groups.values():
+            stack += children
+
+class LazyCuElement(Element):
+    # A CU element whose children are only built the first time they are
+    # accessed.
+    __slots__ = ('builder', 'cu_offset', '_children_groups')
+
+    def __init__(self, builder, cu):
+        top_die = cu.get_top_DIE()
+
+        self.name = die_get_name(top_die)
+        self.offset = top_die.offset
+        self.type_string = None
+
+        self.builder = builder
+        self.cu_offset = cu.cu_offset
+        self._children_groups = None
+
+    def is_loaded(self):
+        return self._children_groups is not None
+
+    def has_children(self):
+        if not self.is_loaded():
+            return True
+
+        return len(self._children_groups) > 0
+
+    @property
+    def children_groups(self):
+        if self._children_groups is None:
+            cus = self.builder.cu_index()
+            cu = cus.get_cu(cus.index_containing(self.cu_offset))
+            cu_elem = self.builder.build_cu(cu)
+            self._children_groups = cu_elem.children_groups
+
+        return self._children_groups
+
+class TagDispatcher:
+    # Routes the children of a DIE to their visitor in a single walk.
+    #
+    # entries: list of (tag, group, callback). The resulting groups are added
+    # to the parent element in the order of this list, regardless of the order
+    # in which the children appear.
+    #
+    # descends: tags whose callback walks the children of the DIE itself.
+    def __init__(self, entries, descends = ()):
+        self.entries = entries
+        self.descends = frozenset(descends)
+        self.index = dict()
+
+        for i, (tag, group, callback) in enumerate(entries):
+            assert(tag not in self.index)
+            self.index[tag] = i
+
+    # Returns the state of the walk of the children of die, see
+    # walk_dispatch.
+    def begin(self, parent_elem, die):
+        return (self, parent_elem, die.iter_children(), [[] for _ in self.entries])
+
+    def finish(self, parent_elem, buckets):
+        for (tag, group, callback), children in zip(self.entries, buckets):
+            parent_elem.add_children(group, children)
+
+    def visit(self, parent_elem, die, register = None):
+        walk_dispatch([self.begin(parent_elem, die)], register)
+
+# Walk the children of the DIEs whose walk states (from TagDispatcher.begin)
+# are on stack, without recursing: a callback wanting the children of its DIE
+# walked pushes their walk state on stack. It is walked before the siblings of
+# the DIE, so that the DIEs are still read in order.
+#
+# register: if not None, called as register(child, walked) for every child,
+# walked telling whether the children of that child will be walked by its
+# callback.
+def walk_dispatch(stack, register = None):
+    while stack:
+        depth = len(stack)
+        dispatcher, parent_elem, children, buckets = stack[-1]
+        index = dispatcher.index
+        entries = dispatcher.entries
+        descends = dispatcher.descends
+
+        for child in children:
+            tag = child.tag
+
+            if register is not None:
+                register(child, tag in descends)
+
+            i = index.get(tag)
+            if i is not None:
+                buckets[i].append(entries[i][2](child))
+
+                if len(stack) != depth:
+                    break
+        else:
+            stack.pop()
+            dispatcher.finish(parent_elem, buckets)
+
+type_tags = frozenset([
+    'DW_TAG_structure_type',
+    'DW_TAG_base_type',
+    'DW_TAG_typedef',
+    'DW_TAG_array_type',
+    'DW_TAG_pointer_type',
+    'DW_TAG_const_type',
+    'DW_TAG_subroutine_type',
+    'DW_TAG_volatile_type',
+    'DW_TAG_union_type',
+    'DW_TAG_enumeration_type',
+])
+
 def filter_children_by_tag(die, tag):
     return [x for x in die.iter_children() if x.tag == tag]
 
@@ -96,60 +413,320 @@ def die_get_upper_bound(die):
         return None
 
 
+class BuildCancelled(Exception):
+    pass
+
 class DwarfModelBuilder:
     # dwarf_info: a pyelftools DWAFRInfo object
-    def __init__(self, dwarf_info, verbose):
+    # single_pass: register the types and build the elements in the same walk
+    #              of the DIEs, instead of doing a separate types pass first.
+    # dedup: share the identical types of different CUs (see
+    #        TypeDeduplicator).
+    # profiler: a dwarfprofile.Profiler recording the time spent in each
+    #           phase of the build.
+    # columnar: decode each CU into a dwarftable.DieTable and walk it rather
+    #           than pyelftools DIEs. The CUs the table can't decode are
+    #           still read with pyelftools.
+    # references: a dwarfrefs.TypeReferences to add the type references of
+    #             the DIEs to, in the types pass.
+    # layouts: record the layouts of the types and members in self.layouts,
+    #          for a TypeDeduplicator of another process (dedup does it for
+    #          its own).
+    def __init__(self, dwarf_info, verbose, single_pass = False, dedup = False, profiler = None, columnar = False,
+                 references = None, layouts = False):
         self.dwarf_info = dwarf_info
         self.verbose = verbose
+        self.single_pass = single_pass
+        self.deduplicator = TypeDeduplicator() if dedup else None
+        # die offset -> die_get_layout, of the DIEs that have a layout. With
+        # dedup, only those of the CU being built.
+        self.layouts = dict() if dedup or layouts else None
+        self.profiler = profiler
+        self.columnar = columnar
+        self.references = references
 
         # (cu, relative offset) -> type string
         # abs offset = rel offset + cu offset
         self.types = dict()
-
-    def debug(self, text):
+        # Number of type DIEs seen
+        self.num_types = 0
+
+        # In single pass mode, type names can't be formatted during the walk,
+        # since they may refer to types found later in the CU. They are
+        # resolved once the whole CU has been walked.
+        # List of (element, type DIE) whose name is the formatted type.
+        self.name_fixups = []
+        # List of (element, cu, type offset) whose type_string is the
+        # formatted type.
+        self.type_string_fixups = []
+
+        # absolute DIE offset -> formatted type name
+        self.type_names = dict()
+        self.type_names_hits = 0
+        self.type_names_misses = 0
+
+        # Set by cancel(), possibly from another thread. The walks check it
+        # at every DIE and raise BuildCancelled.
+        self.cancel_requested = False
+
+        # Offset in .debug_info of the end of the last CU built
+        self.bytes_done = 0
+
+        # Walk states of the running walk_dispatch, see visit_children
+        self.walk_stack = []
+
+        # The CuIndex of dwarf_info, created when first needed
+        self.cus = None
+
+        # In columnar mode, the contents of .debug_str and .debug_line_str,
+        # read when first needed, and the DieTable of the CU being built.
+        self.string_sections = None
+        self.table = None
+
+        self.cu_dispatcher = TagDispatcher([
+            ('DW_TAG_base_type', ChildrenGroup.BaseType, self.visit_base_type),
+            ('DW_TAG_structure_type', ChildrenGroup.StructType, self.visit_struct_type),
+            ('DW_TAG_array_type', ChildrenGroup.ArrayType, self.visit_array_type),
+            ('DW_TAG_typedef', ChildrenGroup.Typedef, self.visit_typedef),
+            ('DW_TAG_enumeration_type', ChildrenGroup.Enumeration, self.visit_enumeration),
+            ('DW_TAG_pointer_type', ChildrenGroup.PointerType, self.visit_pointer_types),
+            ('DW_TAG_subprogram', ChildrenGroup.SubProgram, self.visit_subprogram),
+            ('DW_TAG_const_type', ChildrenGroup.ConstType, self.visit_const_type),
+            ('DW_TAG_volatile_type', ChildrenGroup.VolatileType, self.visit_volatile_type),
+        ], descends = ['DW_TAG_structure_type', 'DW_TAG_enumeration_type', 'DW_TAG_subprogram'])
+        self.struct_dispatcher = TagDispatcher([
+            ('DW_TAG_member', None, self.visit_type_member),
+        ])
+        self.enumeration_dispatcher = TagDispatcher([
+            ('DW_TAG_enumerator', None, self.visit_enumerator),
+        ])
+        self.subprogram_dispatcher = TagDispatcher([
+            ('DW_TAG_formal_parameter', ChildrenGroup.FormalParameter, self.visit_formal_parameter),
+            ('DW_TAG_lexical_block', ChildrenGroup.LexicalBlock, self.visit_lexical_block),
+            ('DW_TAG_variable', ChildrenGroup.Variable, self.visit_variable),
+        ], descends = ['DW_TAG_lexical_block'])
+        self.lexical_block_dispatcher = TagDispatcher([
+            ('DW_TAG_lexical_block', ChildrenGroup.LexicalBlock, self.visit_lexical_block),
+            ('DW_TAG_variable', ChildrenGroup.Variable, self.visit_variable),
+        ], descends = ['DW_TAG_lexical_block'])
+
+        if profiler is not None:
+            self._instrument()
+
+    # Only formats text with args if verbose, these are called for every type
+    # lookup.
+    def debug(self, text, *args):
         if self.verbose:
-            print(text)
+            print(text % args if args else text)
 
-    def num_cus(self):
-        n = 0
-        for cu in self.dwarf_info.iter_CUs():
-            n = n + 1
+    # Replace the methods called too often to check self.profiler by versions
+    # that record their calls, on this instance only.
+    def _instrument(self):
+        profiler = self.profiler
+        format_type_name = self.format_type_name
+        lookup_type = self.lookup_type
+
+        def profiled_format_type_name(type_die):
+            profiler.begin("format types")
+            try:
+                return format_type_name(type_die)
+            finally:
+                profiler.end()
+
+        def profiled_lookup_type(cu, offset):
+            profiler.count("type lookups")
+            return lookup_type(cu, offset)
+
+        self.format_type_name = profiled_format_type_name
+        self.lookup_type = profiled_lookup_type
+
+    def cu_index(self):
+        if self.cus is None:
+            if self.profiler is not None:
+                self.profiler.begin("enumerate CUs")
+
+            self.cus = CuIndex(self.dwarf_info)
+
+            if self.profiler is not None:
+                self.profiler.end()
+
+        return self.cus
+
+    # Like dwarf_info.iter_CUs, but the CU headers are only parsed by
+    # pyelftools when the CU is reached.
+    def _iter_cus(self):
+        cus = self.cu_index()
 
-        return n
+        for n in range(len(cus)):
+            yield cus.get_cu(n)
+
+    def cancel(self):
+        self.cancel_requested = True
+
+    def _check_cancel(self):
+        if self.cancel_requested:
+            raise BuildCancelled()
+
+    def debug_info_size(self):
+        return self.dwarf_info.debug_info_sec.size
+
+    def num_cus(self):
+        return len(self.cu_index())
 
     def build(self):
         file_elem = Element("File", None)
 
-        for cu in self.dwarf_info.iter_CUs():
-            top_die = cu.get_top_DIE()
-
-            self._types_pass(top_die)
-            cu_elem = self.visit_cu(top_die)
+        for cu in self._iter_cus():
+            cu_elem = self.build_cu(cu)
             file_elem.add_child(None, cu_elem)
 
         return file_elem
 
+    # Yields the number of bytes of .debug_info consumed after each CU, then
+    # the file element.
     def build_step(self):
         file_elem = Element("File", None)
-        yield None
+        yield 0
 
-        for cu in self.dwarf_info.iter_CUs():
-            top_die = cu.get_top_DIE()
-
-            self._types_pass(top_die)
-            cu_elem = self.visit_cu(top_die)
+        for cu in self._iter_cus():
+            cu_elem = self.build_cu(cu)
             file_elem.add_child(None, cu_elem)
-            yield None
+            yield self.bytes_done
 
         yield file_elem
 
+    # Yields (cu, CU element) for each CU, without keeping the elements. With
+    # release, the DIEs of a CU are dropped once its element is built, so that
+    # memory use doesn't grow with the number of CUs.
+    def build_iter(self, release = False):
+        for cu in self._iter_cus():
+            cu_elem = self.build_cu(cu)
+
+            if release:
+                self.release_cu(cu)
+
+            yield cu, cu_elem
+
+    # pyelftools keeps every DIE it has read in its CU, and every CU in the
+    # DWARFInfo. Drop all the DIEs of cu but the top one.
+    def release_cu(self, cu):
+        if hasattr(cu, '_dielist') and hasattr(cu, '_diemap'):
+            del cu._dielist[1:]
+            del cu._diemap[1:]
+
+    # Build the file element with a skeleton for each CU, the elements of a CU
+    # are built when its children are first accessed.
+    def build_lazy(self):
+        file_elem = Element("File", None)
+
+        for cu in self._iter_cus():
+            self._check_cancel()
+            file_elem.add_child(None, LazyCuElement(self, cu))
+
+        return file_elem
+
+    # Returns the DieTable of cu, or None if it can't be decoded.
+    def _decode_table(self, cu):
+        if self.string_sections is None:
+            self.string_sections = (section_bytes(self.dwarf_info.debug_str_sec),
+                                    section_bytes(getattr(self.dwarf_info, 'debug_line_str_sec', None)))
+
+        if self.profiler is not None:
+            self.profiler.begin("decode tables")
+
+        try:
+            return DieTable(cu, *self.string_sections)
+        except UnsupportedForm as e:
+            self.debug("CU at %x can't be decoded into a table: %s", cu.cu_offset, e)
+            return None
+        finally:
+            if self.profiler is not None:
+                self.profiler.end()
+
+    def build_cu(self, cu):
+        profiler = self.profiler
+        if profiler is not None:
+            start = time.perf_counter()
+            num_types = self.num_types
+
+        table = self._decode_table(cu) if self.columnar else None
+        self.table = table
+
+        # The types of a table are all registered up front, single pass or
+        # not: it is only a filter of its tag column.
+        if table is not None:
+            top_die = table.top_die()
+
+            if profiler is not None:
+                profiler.begin("types pass")
+            self._types_pass_table(table)
+
+            if profiler is not None:
+                profiler.end()
+        else:
+            top_die = cu.get_top_DIE()
+
+            if not self.single_pass:
+                if profiler is not None:
+                    profiler.begin("types pass")
+                self._types_pass(top_die)
+
+                if profiler is not None:
+                    profiler.end()
+
+        if profiler is not None:
+            profiler.begin("visit CUs")
+        cu_elem = self.visit_cu(top_die)
+
+        if self.single_pass:
+            if profiler is not None:
+                profiler.end()
+                profiler.begin("resolve fixups")
+            self._resolve_fixups()
+
+        if profiler is not None:
+            profiler.end()
+
+        # Types are only looked up within their CU, don't keep the DIEs alive
+        # once it is built, nor their names.
+        self.types.clear()
+        self.type_names.clear()
+        self.table = None
+
+        if self.deduplicator is not None:
+            if profiler is not None:
+                profiler.begin("dedup")
+            self.deduplicator.dedup_cu(cu_elem, cu.cu_offset, self.layouts)
+            self.layouts.clear()
+
+            if profiler is not None:
+                profiler.end()
+
+        self.bytes_done = cu.cu_offset + cu.size
+
+        if profiler is not None:
+            if table is not None:
+                dies = len(table)
+            else:
+                dies = len(cu._dielist) if hasattr(cu, '_dielist') else 0
+            profiler.add_cu(cu.cu_offset, cu_elem.name, time.perf_counter() - start, dies)
+            profiler.count("CUs")
+            profiler.count("DIEs", dies)
+            profiler.count("types", self.num_types - num_types)
+
+        return cu_elem
+
+    # Read the DIE at absolute offset, e.g. the DIE of an element.
+    def get_die(self, offset):
+        cu = self.cu_index().get_cu_containing(offset)
+        return cu.get_DIE_from_refaddr(offset)
+
     def eventually_points_to_subprogram(self, type_die):
         assert(type_die.tag == 'DW_TAG_pointer_type')
 
         pointed_type_offset = die_get_type(type_die)
         type_die = self.lookup_type(type_die.cu, pointed_type_offset)
         while True:
-            print(type_die.tag)
             if type_die.tag == 'DW_TAG_subroutine_type':
                 return True
 
@@ -160,6 +737,97 @@ class DwarfModelBuilder:
             type_die = self.lookup_type(type_die.cu, pointed_type_offset)
 
     def format_type_name(self, type_die):
+        type_names = self.type_names
+        name = type_names.get(type_die.offset)
+
+        if name is not None:
+            self.type_names_hits += 1
+            return name
+
+        # The types a type refers to are formatted first, using a stack
+        # rather than recursing since chains of pointers, consts, etc. can be
+        # long. Each entry is [type DIE, the type DIEs it refers to, index of
+        # the next one to look at]. A type referring to itself, which only
+        # broken DWARF does, is shown as <cycle>.
+        stack = [[type_die, self._type_name_deps(type_die), 0]]
+        on_stack = {type_die.offset}
+
+        while stack:
+            entry = stack[-1]
+            die, deps, i = entry
+            pending = None
+
+            while i < len(deps):
+                dep = deps[i]
+                i += 1
+
+                if dep is None or dep.offset in on_stack:
+                    continue
+
+                if dep.offset in type_names:
+                    self.type_names_hits += 1
+                    continue
+
+                pending = dep
+                break
+
+            if pending is not None:
+                entry[2] = i
+                stack.append([pending, self._type_name_deps(pending), 0])
+                on_stack.add(pending.offset)
+                continue
+
+            dep_names = []
+            for dep in deps:
+                if dep is None:
+                    dep_names.append("???")
+                else:
+                    dep_names.append(type_names.get(dep.offset, "<cycle>"))
+
+            self.type_names_misses += 1
+            type_names[die.offset] = self._format_type_name(die, dep_names)
+            on_stack.discard(die.offset)
+            stack.pop()
+
+        return type_names[type_die.offset]
+
+    # Returns (hits, misses) of the type names cache.
+    def type_names_stats(self):
+        return self.type_names_hits, self.type_names_misses
+
+    # Returns the list of the type DIEs whose names are part of the name of
+    # type_die, None for those that can't be found.
+    def _type_name_deps(self, type_die):
+        tag = type_die.tag
+        cu = type_die.cu
+
+        if tag in ('DW_TAG_array_type', 'DW_TAG_pointer_type', 'DW_TAG_const_type', 'DW_TAG_volatile_type'):
+            type_offset = die_get_type(type_die)
+
+            # Pointers to and consts of void
+            if type_offset is None and tag != 'DW_TAG_array_type':
+                return []
+
+            return [self.lookup_type(cu, type_offset)]
+
+        if tag == 'DW_TAG_subroutine_type':
+            deps = []
+
+            ret_type_offset = die_get_type(type_die)
+            if ret_type_offset:
+                deps.append(self.lookup_type(cu, ret_type_offset))
+
+            params = filter_children_by_tag(type_die, 'DW_TAG_formal_parameter')
+            for param in params:
+                deps.append(self.lookup_type(cu, die_get_type(param)))
+
+            return deps
+
+        return []
+
+    # Format the name of type_die, given the names of the types returned by
+    # _type_name_deps.
+    def _format_type_name(self, type_die, dep_names):
         tag = type_die.tag
 
         if tag == 'DW_TAG_base_type':
@@ -178,7 +846,6 @@ class DwarfModelBuilder:
             return "union " + name
 
         if tag == 'DW_TAG_array_type':
-            subtype = self.lookup_type(type_die.cu, die_get_type(type_die))
             subranges = filter_children_by_tag(type_die, 'DW_TAG_subrange_type')
             suffix = ""
 
@@ -190,48 +857,37 @@ class DwarfModelBuilder:
                 else:
                     suffix += "[?]"
 
-            return self.format_type_name(subtype) + suffix
+            return dep_names[0] + suffix
 
         if tag == 'DW_TAG_pointer_type':
             #print(self.eventually_points_to_subprogram(type_die))
-            pointed_type_offset = die_get_type(type_die)
-            if pointed_type_offset is None:
+            if not dep_names:
                 return "void*"
 
-            pointed_type = self.lookup_type(type_die.cu, pointed_type_offset)
-            return self.format_type_name(pointed_type) + " *"
+            return dep_names[0] + " *"
 
         if tag == 'DW_TAG_const_type':
-            consted_type_offset = die_get_type(type_die)
-            if consted_type_offset is None:
+            if not dep_names:
                 return "void const"
 
-            typ = self.lookup_type(type_die.cu, consted_type_offset)
-            return self.format_type_name(typ) + " const"
+            return dep_names[0] + " const"
 
         if tag == 'DW_TAG_volatile_type':
-            typ = self.lookup_type(type_die.cu,die_get_type(type_die))
-            return self.format_type_name(typ) + " volatile"
+            if not dep_names:
+                return "void volatile"
 
-        if tag == 'DW_TAG_subroutine_type':
-            ret_type_offset = die_get_type(type_die)
-            if ret_type_offset:
-                ret_type_die = self.lookup_type(type_die.cu, ret_type_offset)
+            return dep_names[0] + " volatile"
 
-                ret = self.format_type_name(ret_type_die)
+        if tag == 'DW_TAG_subroutine_type':
+            if die_get_type(type_die):
+                ret = dep_names[0]
+                params_formatted = dep_names[1:]
             else:
                 ret = "void"
+                params_formatted = dep_names
 
             ret += " function("
-
-            params = filter_children_by_tag(type_die, 'DW_TAG_formal_parameter')
-            params_formatted = []
-            for param in params:
-                param_type_offset = die_get_type(param)
-                param_type_die = self.lookup_type(type_die.cu, param_type_offset)
-                params_formatted.append(self.format_type_name(param_type_die))
             ret += ', '.join(params_formatted)
-
             ret += ")"
 
             return ret
@@ -245,8 +901,7 @@ class DwarfModelBuilder:
                 name = "<anonymous>"
             return "enum " + name
 
-        print(tag)
-        assert(False)
+        assert False, "Unexpected type tag %s" % tag
 
     def lookup_and_format_type(self, cu, offset):
             type_die = self.lookup_type(cu, offset)
@@ -256,76 +911,153 @@ class DwarfModelBuilder:
 
             return self.format_type_name(type_die)
 
+    # Called for each type reference, don't format the message unless it is
+    # shown.
     def lookup_type(self, cu, offset):
-        self.debug("Type lookup at %x + %x = %x" % (cu.cu_offset, offset, cu.cu_offset + offset))
+        if self.verbose:
+            self.debug("Type lookup at %x + %x = %x", cu.cu_offset, offset, cu.cu_offset + offset)
         if (cu, offset) not in self.types:
-            self.debug("Returns none!")
+            if self.verbose:
+                self.debug("Returns none!")
             return None
 
         return self.types[(cu, offset)]
 
+    def _add_type(self, die):
+        cu = die.cu
+        offset = die.offset - die.cu.cu_offset
+        self.debug("adding type at %x", offset)
+
+        assert((cu, offset) not in self.types)
+
+        self.types[(cu, offset)] = die
+        self.num_types += 1
+
+    # Register the types of the subtree of die, depth first. The iterators
+    # of the children of the DIEs being walked are kept on a stack rather than
+    # recursing, since lexical blocks can be nested deeply.
     def _types_pass(self, die):
-        tag = die.tag
+        references = self.references
+        stack = [iter((die,))]
 
-        type_tags = ['DW_TAG_structure_type',
-                     'DW_TAG_base_type',
-                     'DW_TAG_typedef',
-                     'DW_TAG_array_type',
-                     'DW_TAG_pointer_type',
-                     'DW_TAG_const_type',
-                     'DW_TAG_subroutine_type',
-                     'DW_TAG_volatile_type',
-                     'DW_TAG_union_type',
-                     'DW_TAG_enumeration_type']
+        while stack:
+            for die in stack[-1]:
+                self._check_cancel()
 
-        if tag in type_tags:
-            cu = die.cu
-            offset = die.offset - die.cu.cu_offset
-            self.debug("adding type at %x" % (offset))
+                if die.tag in type_tags:
+                    self._add_type(die)
 
-            assert((cu, offset) not in self.types)
+                if references is not None:
+                    references.add_die(die)
 
-            self.types[(cu, offset)] = die
+                if die.has_children:
+                    stack.append(die.iter_children())
+                    break
+            else:
+                stack.pop()
+
+    # Register the types of a DieTable, filtering its tag column rather than
+    # walking its DIEs.
+    def _types_pass_table(self, table):
+        for row in table.rows_with_tags(type_tags):
+            self._check_cancel()
+            self._add_type(table.die(row))
+
+        if self.references is not None:
+            self.references.add_table(table)
+
+    # Used in single pass mode, called by the dispatchers for every child DIE
+    # they walk. The subtrees that no visitor walks are passed to _types_pass.
+    def _register_die(self, die, walked):
+        self._check_cancel()
+
+        if die.tag in type_tags:
+            self._add_type(die)
+
+        if self.references is not None:
+            self.references.add_die(die)
+
+        if not walked:
+            for child in die.iter_children():
+                self._types_pass(child)
+
+    # Called by the dispatchers for every child DIE they walk, when not in
+    # single pass mode.
+    def _check_cancel_die(self, die, walked):
+        self._check_cancel()
+
+    def _resolve_fixups(self):
+        for elem, type_die in self.name_fixups:
+            self._check_cancel()
+            elem.name = self.format_type_name(type_die)
+
+        for elem, cu, type_offset in self.type_string_fixups:
+            self._check_cancel()
+            elem.type_string = self.lookup_and_format_type(cu, type_offset)
+
+        self.name_fixups = []
+        self.type_string_fixups = []
+
+    # Walk the children of die with dispatcher, adding their elements to
+    # elem. When called by a visitor during a walk, the children are walked
+    # once the visitor returns, by the same walk_dispatch loop, so that deep
+    # DIE trees don't recurse.
+    def visit_children(self, dispatcher, elem, die):
+        walking = len(self.walk_stack) > 0
+        self.walk_stack.append(dispatcher.begin(elem, die))
+
+        if walking:
+            return
 
-        for child in die.iter_children():
-            self._types_pass(child)
+        # The types of a DieTable are all registered before the walk.
+        if self.single_pass and self.table is None:
+            register = self._register_die
+        else:
+            register = self._check_cancel_die
 
+        try:
+            walk_dispatch(self.walk_stack, register)
+        finally:
+            del self.walk_stack[:]
+
+    # Create the element of a type DIE, named after the formatted type.
+    def type_element(self, type_die):
+        if self.layouts is not None:
+            self.record_layout(type_die)
+
+        if self.single_pass:
+            elem = Element(None, type_die.offset)
+            self.name_fixups.append((elem, type_die))
+        else:
+            elem = Element(self.format_type_name(type_die), type_die.offset)
+
+        return elem
+
+
+    def record_layout(self, die):
+        if self.table is not None:
+            layout = self.table.layout(die.row)
+        else:
+            layout = die_get_layout(die)
+        if layout is not None:
+            self.layouts[die.offset] = layout
 
     def visit_cu(self, cu_die):
         name = die_get_name(cu_die)
-        cu_elem = Element(name, cu_die)
-
-        cu_elem.add_children(ChildrenGroup.BaseType,self.visit_children_of_tag(cu_die, 'DW_TAG_base_type', self.visit_base_type))
-        cu_elem.add_children(ChildrenGroup.StructType,self.visit_children_of_tag(cu_die, 'DW_TAG_structure_type', self.visit_struct_type))
-        cu_elem.add_children(ChildrenGroup.ArrayType,self.visit_children_of_tag(cu_die, 'DW_TAG_array_type', self.visit_array_type))
-        cu_elem.add_children(ChildrenGroup.Typedef,self.visit_children_of_tag(cu_die, 'DW_TAG_typedef', self.visit_typedef))
-        cu_elem.add_children(ChildrenGroup.Enumeration,self.visit_children_of_tag(cu_die, 'DW_TAG_enumeration_type', self.visit_enumeration))
-        cu_elem.add_children(ChildrenGroup.PointerType,self.visit_children_of_tag(cu_die, 'DW_TAG_pointer_type', self.visit_pointer_types))
-        cu_elem.add_children(ChildrenGroup.SubProgram,self.visit_children_of_tag(cu_die, 'DW_TAG_subprogram', self.visit_subprogram))
-        cu_elem.add_children(ChildrenGroup.ConstType,self.visit_children_of_tag(cu_die, 'DW_TAG_const_type', self.visit_const_type))
-        cu_elem.add_children(ChildrenGroup.VolatileType,self.visit_children_of_tag(cu_die, 'DW_TAG_volatile_type', self.visit_volatile_type))
-
-        return cu_elem
+        cu_elem = Element(name, cu_die.offset)
 
-    def visit_children_of_tag(self, die, tag, callback):
-        ret = []
-        children_dies = filter_children_by_tag(die, tag)
-        for cd in children_dies:
-            ret.append(callback(cd))
+        self.visit_children(self.cu_dispatcher, cu_elem, cu_die)
 
-        return ret
+        return cu_elem
 
     def visit_base_type(self, base_type_die):
-        name = self.format_type_name(base_type_die)
-        elem = Element(name, base_type_die)
+        elem = self.type_element(base_type_die)
         return elem
 
     def visit_struct_type(self, struct_type_die):
-        name = self.format_type_name(struct_type_die)
+        elem = self.type_element(struct_type_die)
 
-        elem = Element(name, struct_type_die)
-
-        elem.add_children(None, self.visit_children_of_tag(struct_type_die, 'DW_TAG_member', self.visit_type_member))
+        self.visit_children(self.struct_dispatcher, elem, struct_type_die)
 
         return elem
 
@@ -334,28 +1066,32 @@ class DwarfModelBuilder:
         type_offset = die_get_type(member_type_die)
         cu = member_type_die.cu
 
-        type_string = self.lookup_and_format_type(cu, type_offset)
-        member_elem = Element(member_name, member_type_die, type_string = type_string)
+        if self.layouts is not None:
+            self.record_layout(member_type_die)
+
+        if self.single_pass:
+            member_elem = Element(member_name, member_type_die.offset)
+            self.type_string_fixups.append((member_elem, cu, type_offset))
+        else:
+            type_string = self.lookup_and_format_type(cu, type_offset)
+            member_elem = Element(member_name, member_type_die.offset, type_string = type_string)
 
         return member_elem
 
     def visit_array_type(self, array_type_die):
-        name = self.format_type_name(array_type_die)
-        array_elem = Element(name, array_type_die)
+        array_elem = self.type_element(array_type_die)
 
         return array_elem
 
     def visit_typedef(self, typedef_die):
-        name = self.format_type_name(typedef_die)
-        typedef_elem = Element(name, typedef_die)
+        typedef_elem = self.type_element(typedef_die)
 
         return typedef_elem
 
     def visit_enumeration(self, enumeration_die):
-        name = self.format_type_name(enumeration_die)
-        enum_elem = Element(name, enumeration_die)
+        enum_elem = self.type_element(enumeration_die)
 
-        enum_elem.add_children(None, self.visit_children_of_tag(enumeration_die, 'DW_TAG_enumerator', self.visit_enumerator))
+        self.visit_children(self.enumeration_dispatcher, enum_elem, enumeration_die)
 
         return enum_elem
 
@@ -364,35 +1100,30 @@ class DwarfModelBuilder:
         num = die_get_attr(enumerator_die, 'DW_AT_const_value')
         name = "%s = %d" % (label, num)
 
-        enum_elem = Element(name, enumerator_die)
+        enum_elem = Element(name, enumerator_die.offset)
 
         return enum_elem
 
     def visit_pointer_types(self, pointer_type_die):
-        name = self.format_type_name(pointer_type_die)
-        pointer_elem = Element(name, pointer_type_die)
+        pointer_elem = self.type_element(pointer_type_die)
 
         return pointer_elem
 
     def visit_const_type(self, const_type_die):
-        name = self.format_type_name(const_type_die)
-        const_elem = Element(name, const_type_die)
+        const_elem = self.type_element(const_type_die)
 
         return const_elem
 
     def visit_volatile_type(self, volatile_type_die):
-        name = self.format_type_name(volatile_type_die)
-        volatile_elem = Element(name, volatile_type_die)
+        volatile_elem = self.type_element(volatile_type_die)
 
         return volatile_elem
 
     def visit_subprogram(self, subprogram_type_die):
         name = die_get_name(subprogram_type_die)
-        subprogram_elem = Element(name, subprogram_type_die)
+        subprogram_elem = Element(name, subprogram_type_die.offset)
 
-        subprogram_elem.add_children(ChildrenGroup.FormalParameter, self.visit_children_of_tag(subprogram_type_die, 'DW_TAG_formal_parameter', self.visit_formal_parameter))
-        subprogram_elem.add_children(ChildrenGroup.LexicalBlock, self.visit_children_of_tag(subprogram_type_die, 'DW_TAG_lexical_block', self.visit_lexical_block))
-        subprogram_elem.add_children(ChildrenGroup.Variable, self.visit_children_of_tag(subprogram_type_die, 'DW_TAG_variable', self.visit_variable))
+        self.visit_children(self.subprogram_dispatcher, subprogram_elem, subprogram_type_die)
 
         return subprogram_elem
 
@@ -400,7 +1131,7 @@ class DwarfModelBuilder:
         name = die_get_name(formal_parameter_die)
         type_ = die_get_type(formal_parameter_die)
 
-        elem = Element(name, formal_parameter_die)
+        elem = Element(name, formal_parameter_die.offset)
 
         return elem
 
@@ -418,17 +1149,16 @@ class DwarfModelBuilder:
 
         name = '0x{:x}-0x{:x}'.format(low_pc, high_pc)
 
-        elem = Element(name, lexical_block_die)
+        elem = Element(name, lexical_block_die.offset)
 
-        elem.add_children(ChildrenGroup.LexicalBlock, self.visit_children_of_tag(lexical_block_die, 'DW_TAG_lexical_block', self.visit_lexical_block))
-        elem.add_children(ChildrenGroup.Variable, self.visit_children_of_tag(lexical_block_die, 'DW_TAG_variable', self.visit_variable))
+        self.visit_children(self.lexical_block_dispatcher, elem, lexical_block_die)
 
         return elem
 
     def visit_variable(self, variable_die):
         name = die_get_name(variable_die)
 
-        elem = Element(name, variable_die)
+        elem = Element(name, variable_die.offset)
 
         return elem
 
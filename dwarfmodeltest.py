@@ -1,24 +1,107 @@
 from dwarfmodel import ChildrenGroup, DwarfModelBuilder
+from dwarfprofile import Profiler
+import argparse
+import json
 import sys
 from elftools.elf.elffile import ELFFile
 
-def print_rec(elem, tabs = ""):
-	print("%s%s" % (tabs, elem.name))
+def print_rec(elem, tabs = "", out = None):
+	# Elements to print with their indentation, and lines already formatted
+	stack = [(elem, tabs)]
 
-	tabs += "  "
+	while stack:
+		elem, tabs = stack.pop()
 
-	for group in elem.children_groups:
-		children_list = elem.children_groups[group]
-		if group is not None:
-			print("%s%s:" % (tabs, ChildrenGroup.name(group)))
+		if elem is None:
+			print(tabs, file = out)
+			continue
+
+		print("%s%s" % (tabs, elem.name), file = out)
+
+		tabs += "  "
+		pending = []
+
+		for group in elem.children_groups:
+			children_list = elem.children_groups[group]
+			if group is not None:
+				pending.append((None, "%s%s:" % (tabs, ChildrenGroup.name(group))))
+			else:
+				pending.append((None, "%s%s:" % (tabs, "Others")))
+			pending.extend((child, tabs) for child in children_list)
+
+		stack.extend(reversed(pending))
+
+# Returns the JSON text of elem and its descendants, on one line. It is
+# written piece by piece rather than with json.dumps, which cannot encode
+# objects nested as deep as some lexical blocks are.
+def element_to_json(elem):
+	parts = []
+	# Elements to encode, and text already encoded
+	stack = [elem]
+
+	while stack:
+		elem = stack.pop()
+
+		if isinstance(elem, str):
+			parts.append(elem)
+			continue
+
+		parts.append('{"name": %s, "offset": %s, "type": %s, "groups": [' %
+		             (json.dumps(elem.name), json.dumps(elem.offset), json.dumps(elem.type_string)))
+		pending = []
+
+		for i, group in enumerate(elem.children_groups):
+			children_list = elem.children_groups[group]
+			if i > 0:
+				pending.append(", ")
+			pending.append('{"group": %s, "children": [' % json.dumps(ChildrenGroup.name(group) if group is not None else None))
+			for j, child in enumerate(children_list):
+				if j > 0:
+					pending.append(", ")
+				pending.append(child)
+			pending.append("]}")
+
+		pending.append("]}")
+		stack.extend(reversed(pending))
+
+	return "".join(parts)
+
+# Print the model of dwarf_info one CU at a time, as they are built. The
+# elements of a CU are dropped once printed.
+#
+# fmt: "text", the output of print_rec for the whole model, or "jsonl", one
+#      JSON object per CU and per line
+# profiler: a Profiler recording the phases of the build, or None
+# columnar: see DwarfModelBuilder
+def stream(dwarf_info, fmt, out = sys.stdout, profiler = None, columnar = False):
+	builder = DwarfModelBuilder(dwarf_info, False, single_pass = True, profiler = profiler, columnar = columnar)
+
+	if fmt == "text":
+		print("File", file = out)
+		print("  Others:", file = out)
+
+	for cu, cu_elem in builder.build_iter(release = True):
+		if fmt == "text":
+			print_rec(cu_elem, "  ", out)
 		else:
-			print("%s%s:" % (tabs, "Others"))
-		for child in children_list:
-			print_rec(child, tabs)
+			out.write(element_to_json(cu_elem))
+			out.write("\n")
+
+		out.flush()
 
 
 if __name__ == "__main__":
-	filename = sys.argv[1]
+	parser = argparse.ArgumentParser(description = 'Print the DWARF model of an ELF binary')
+	parser.add_argument('elfbinary', help = 'The ELF binary to analyze')
+	parser.add_argument('--format', choices = ["text", "jsonl", "ndjson"], default = "text",
+	                    help = 'Output format, jsonl and ndjson are the same')
+	parser.add_argument('--profile', nargs = '?', const = "time", choices = ["time", "allocations"],
+	                    help = 'Print the time spent in each phase of the build on stderr, and optionally the memory allocated')
+	parser.add_argument('--columnar', action = "store_true",
+	                    help = 'Decode the DIEs of each CU into columns instead of reading them with pyelftools')
+	args = parser.parse_args()
+
+	filename = args.elfbinary
 
 	with open(filename, 'rb') as f:
 		elf = ELFFile(f)
@@ -30,6 +113,14 @@ if __name__ == "__main__":
 
 		di = elf.get_dwarf_info()
 
-		builder = DwarfModelBuilder(di)
-		root_elem = builder.build()
-		print_rec(root_elem)
+		fmt = "jsonl" if args.format == "ndjson" else args.format
+
+		profiler = None
+		if args.profile is not None:
+			profiler = Profiler(allocations = args.profile == "allocations")
+
+		stream(di, fmt, profiler = profiler, columnar = args.columnar)
+
+		if profiler is not None:
+			profiler.stop()
+			print("\n".join(profiler.report()), file = sys.stderr)
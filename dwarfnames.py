@@ -0,0 +1,502 @@
+from dwarfmodel import DwarfModelBuilder, die_get_name
+import dwarfmodeltest
+from elftools.elf.elffile import ELFFile
+
+import argparse
+import struct
+import sys
+
+# Readers of the name indexes compilers and linkers emit. lookup(name)
+# returns a list of (cu offset, die offset), with absolute offsets. The die
+# offset is None when the index only knows the CU.
+
+def read_uleb128(data, pos):
+    result = 0
+    shift = 0
+
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        shift += 7
+
+        if byte & 0x80 == 0:
+            return result, pos
+
+def read_cstring(data, pos):
+    end = data.index(b'\0', pos)
+    return data[pos:end]
+
+# The hash of the names in .debug_names that DWARF 5 specifies.
+def djb_hash(name_bytes):
+    h = 5381
+    for c in name_bytes:
+        h = (h * 33 + c) & 0xffffffff
+
+    return h
+
+# The hash LLVM uses instead: that of the UTF-8 of the name with its
+# characters case folded.
+def case_folding_djb_hash(name):
+    folded = []
+    for c in name:
+        lower = c.lower()
+        folded.append(lower if len(lower) == 1 else c)
+
+    return djb_hash(''.join(folded).encode())
+
+class DebugNamesIndex:
+    # The DWARF 5 .debug_names section.
+    name = '.debug_names'
+
+    DW_IDX_compile_unit = 1
+    DW_IDX_die_offset = 3
+
+    # form -> size of the value, None for ULEB128
+    form_sizes = {
+        0x0b: 1, # DW_FORM_data1
+        0x05: 2, # DW_FORM_data2
+        0x06: 4, # DW_FORM_data4
+        0x07: 8, # DW_FORM_data8
+        0x0c: 1, # DW_FORM_flag
+        0x0f: None, # DW_FORM_udata
+        0x11: 1, # DW_FORM_ref1
+        0x12: 2, # DW_FORM_ref2
+        0x13: 4, # DW_FORM_ref4
+        0x14: 8, # DW_FORM_ref8
+        0x15: None, # DW_FORM_ref_udata
+        0x19: 0, # DW_FORM_flag_present
+        0x20: 8, # DW_FORM_ref_sig8
+    }
+
+    def __init__(self, data, str_data, little_endian):
+        self.data = data
+        self.str_data = str_data
+        self.endian = '<' if little_endian else '>'
+        self.units = []
+
+        pos = 0
+        while pos < len(data):
+            unit, pos = self._read_unit(pos)
+            self.units.append(unit)
+
+    def _unpack(self, fmt, pos):
+        return struct.unpack_from(self.endian + fmt, self.data, pos)
+
+    def _read_unit(self, pos):
+        unit = dict()
+
+        unit_length, = self._unpack('I', pos)
+        pos += 4
+        offset_fmt = 'I'
+        if unit_length == 0xffffffff:
+            unit_length, = self._unpack('Q', pos)
+            pos += 8
+            offset_fmt = 'Q'
+        end = pos + unit_length
+        offset_size = struct.calcsize(offset_fmt)
+
+        (version, padding, cu_count, local_tu_count, foreign_tu_count,
+         bucket_count, name_count, abbrev_table_size,
+         augmentation_size) = self._unpack('HHIIIIIII', pos)
+        pos += 32 + augmentation_size
+
+        def read_array(fmt, count):
+            nonlocal pos
+            values = self._unpack('%d%s' % (count, fmt), pos)
+            pos += count * struct.calcsize(fmt)
+            return values
+
+        unit['cu_offsets'] = read_array(offset_fmt, cu_count)
+        read_array(offset_fmt, local_tu_count)
+        read_array('Q', foreign_tu_count)
+        unit['buckets'] = read_array('I', bucket_count)
+        unit['hashes'] = read_array('I', name_count) if bucket_count > 0 else ()
+        unit['string_offsets'] = read_array(offset_fmt, name_count)
+        unit['entry_offsets'] = read_array(offset_fmt, name_count)
+
+        # code -> list of (index attribute, form)
+        abbrevs = dict()
+        abbrev_pos = pos
+        while True:
+            code, abbrev_pos = read_uleb128(self.data, abbrev_pos)
+            if code == 0:
+                break
+
+            tag, abbrev_pos = read_uleb128(self.data, abbrev_pos)
+            attrs = []
+            while True:
+                idx, abbrev_pos = read_uleb128(self.data, abbrev_pos)
+                form, abbrev_pos = read_uleb128(self.data, abbrev_pos)
+                if idx == 0 and form == 0:
+                    break
+                attrs.append((idx, form))
+
+            abbrevs[code] = attrs
+
+        unit['abbrevs'] = abbrevs
+        unit['entry_pool'] = pos + abbrev_table_size
+
+        return unit, end
+
+    def _name_at(self, unit, i):
+        return read_cstring(self.str_data, unit['string_offsets'][i])
+
+    def _read_entries(self, unit, i):
+        ret = []
+        pos = unit['entry_pool'] + unit['entry_offsets'][i]
+
+        while True:
+            code, pos = read_uleb128(self.data, pos)
+            if code == 0:
+                return ret
+
+            attrs = unit['abbrevs'].get(code)
+            if attrs is None:
+                return ret
+
+            cu_index = 0
+            die_offset = None
+
+            for idx, form in attrs:
+                if form not in self.form_sizes:
+                    return ret
+
+                size = self.form_sizes[form]
+                if size is None:
+                    value, pos = read_uleb128(self.data, pos)
+                else:
+                    value = int.from_bytes(self.data[pos:pos + size],
+                                           'little' if self.endian == '<' else 'big')
+                    pos += size
+
+                if idx == self.DW_IDX_compile_unit:
+                    cu_index = value
+                elif idx == self.DW_IDX_die_offset:
+                    die_offset = value
+
+            # Entries of type units are not handled.
+            if cu_index < len(unit['cu_offsets']) and die_offset is not None:
+                cu_offset = unit['cu_offsets'][cu_index]
+                ret.append((cu_offset, cu_offset + die_offset))
+
+    # The names are hashed with djb_hash as DWARF 5 specifies, or with
+    # case_folding_djb_hash by LLVM. They only differ for names with uppercase
+    # letters, both are looked up.
+    def lookup(self, name):
+        ret = []
+        name_bytes = name.encode()
+        name_hashes = set([djb_hash(name_bytes), case_folding_djb_hash(name)])
+
+        for unit in self.units:
+            buckets = unit['buckets']
+            hashes = unit['hashes']
+            name_count = len(unit['string_offsets'])
+
+            if buckets:
+                for h in name_hashes:
+                    i = buckets[h % len(buckets)]
+                    if i == 0:
+                        continue
+
+                    # Names of a bucket are contiguous, indexes start at 1.
+                    i -= 1
+                    while i < name_count and hashes[i] % len(buckets) == h % len(buckets):
+                        if hashes[i] == h and self._name_at(unit, i) == name_bytes:
+                            ret += self._read_entries(unit, i)
+                        i += 1
+            else:
+                for i in range(name_count):
+                    if self._name_at(unit, i) == name_bytes:
+                        ret += self._read_entries(unit, i)
+
+        return ret
+
+class GdbIndex:
+    # The .gdb_index section added by gdb-add-index or the linkers, versions
+    # 7 and up. It only maps names to CUs.
+    name = '.gdb_index'
+
+    def __init__(self, data):
+        self.data = data
+
+        self.version, = struct.unpack_from('<I', data, 0)
+        if self.version < 7:
+            raise ValueError("unsupported .gdb_index version %d" % self.version)
+
+        if self.version >= 9:
+            (cu_list, types_cu_list, address_area, symbol_table,
+             symbol_table_end, constant_pool) = struct.unpack_from('<6I', data, 4)
+        else:
+            (cu_list, types_cu_list, address_area, symbol_table,
+             constant_pool) = struct.unpack_from('<5I', data, 4)
+            symbol_table_end = constant_pool
+
+        num_cus = (types_cu_list - cu_list) // 16
+        self.cu_offsets = [struct.unpack_from('<Q', data, cu_list + 16 * i)[0]
+                           for i in range(num_cus)]
+        self.symbol_table = symbol_table
+        self.num_slots = (symbol_table_end - symbol_table) // 8
+        self.constant_pool = constant_pool
+
+    @staticmethod
+    def hash(name_bytes):
+        r = 0
+        for c in name_bytes:
+            if ord('A') <= c <= ord('Z'):
+                c += ord('a') - ord('A')
+            r = (r * 67 + c - 113) & 0xffffffff
+
+        return r
+
+    def lookup(self, name):
+        if self.num_slots == 0:
+            return []
+
+        name_bytes = name.encode()
+        h = self.hash(name_bytes)
+        mask = self.num_slots - 1
+        index = h & mask
+        step = ((h * 17) & mask) | 1
+
+        while True:
+            name_offset, vec_offset = struct.unpack_from('<II', self.data, self.symbol_table + 8 * index)
+
+            if name_offset == 0 and vec_offset == 0:
+                return []
+
+            if read_cstring(self.data, self.constant_pool + name_offset) == name_bytes:
+                break
+
+            index = (index + step) & mask
+
+        ret = []
+        vec = self.constant_pool + vec_offset
+        count, = struct.unpack_from('<I', self.data, vec)
+
+        for i in range(count):
+            value, = struct.unpack_from('<I', self.data, vec + 4 + 4 * i)
+            cu_index = value & 0xffffff
+
+            # Type units are not handled.
+            if cu_index < len(self.cu_offsets):
+                cu_offset = self.cu_offsets[cu_index]
+                if (cu_offset, None) not in ret:
+                    ret.append((cu_offset, None))
+
+        return ret
+
+class PubNamesIndex:
+    # The .debug_pubnames and .debug_pubtypes sections. Unlike the NameLUT of
+    # pyelftools, which keeps the last entry of each name, every entry of
+    # every set is kept, a name may be in several CUs.
+    name = '.debug_pubnames'
+
+    # sections: the data of the sections
+    def __init__(self, sections, little_endian):
+        self.endian = '<' if little_endian else '>'
+        # name -> list of (cu offset, die offset)
+        self.entries = dict()
+
+        for data in sections:
+            pos = 0
+            while pos < len(data):
+                pos = self._read_set(data, pos)
+
+    def _read_set(self, data, pos):
+        unit_length, = struct.unpack_from(self.endian + 'I', data, pos)
+        pos += 4
+        offset_fmt = self.endian + 'I'
+        if unit_length == 0xffffffff:
+            unit_length, = struct.unpack_from(self.endian + 'Q', data, pos)
+            pos += 8
+            offset_fmt = self.endian + 'Q'
+        end = pos + unit_length
+        offset_size = struct.calcsize(offset_fmt)
+
+        # Version, then the offset and size of the CU in .debug_info
+        cu_offset, = struct.unpack_from(offset_fmt, data, pos + 2)
+        pos += 2 + 2 * offset_size
+
+        while pos < end:
+            die_offset, = struct.unpack_from(offset_fmt, data, pos)
+            pos += offset_size
+            if die_offset == 0:
+                break
+
+            name = read_cstring(data, pos)
+            pos += len(name) + 1
+
+            entry = (cu_offset, cu_offset + die_offset)
+            entries = self.entries.setdefault(name.decode(errors = 'replace'), [])
+            if entry not in entries:
+                entries.append(entry)
+
+        return end
+
+    def lookup(self, name):
+        return list(self.entries.get(name, []))
+
+class ScanIndex:
+    # No index, look at the name of every DIE.
+    name = 'scan'
+
+    def __init__(self, dwarf_info):
+        self.dwarf_info = dwarf_info
+
+    def lookup(self, name):
+        ret = []
+
+        for cu in self.dwarf_info.iter_CUs():
+            for die in cu.iter_DIEs():
+                if die_get_name(die) == name:
+                    ret.append((cu.cu_offset, die.offset))
+
+        return ret
+
+# Returns the best index available in the ELF file.
+def open_name_index(elf, dwarf_info):
+    section = elf.get_section_by_name('.debug_names')
+    str_section = elf.get_section_by_name('.debug_str')
+    if section is not None and str_section is not None:
+        return DebugNamesIndex(section.data(), str_section.data(), elf.little_endian)
+
+    section = elf.get_section_by_name('.gdb_index')
+    if section is not None:
+        try:
+            return GdbIndex(section.data())
+        except ValueError:
+            pass
+
+    sections = [elf.get_section_by_name(name) for name in ('.debug_pubnames', '.debug_pubtypes')]
+    sections = [section.data() for section in sections if section is not None]
+    if sections:
+        return PubNamesIndex(sections, elf.little_endian)
+
+    return ScanIndex(dwarf_info)
+
+# Returns the path from root to the element of the DIE at offset, as a list
+# of (group, position), or None.
+def element_path(root, offset):
+    # (element, path to it)
+    stack = [(root, [])]
+
+    while stack:
+        elem, path = stack.pop()
+
+        if elem.offset == offset:
+            return path
+
+        for group, children in elem.children_groups.items():
+            for i, child in enumerate(children):
+                stack.append((child, path + [(group, i)]))
+
+    return None
+
+# Returns the offset of the DIE of name in cu, that of a definition rather
+# than a declaration if there is one, or None.
+def find_die_by_name(cu, name):
+    ret = None
+
+    for die in cu.iter_DIEs():
+        if die_get_name(die) == name:
+            if 'DW_AT_declaration' not in die.attributes:
+                return die.offset
+
+            if ret is None:
+                ret = die.offset
+
+    return ret
+
+def is_declaration(dwarf_info, cu_offset, die_offset):
+    if die_offset is None:
+        return False
+
+    die = dwarf_info.get_CU_at(cu_offset).get_DIE_from_refaddr(die_offset)
+    return 'DW_AT_declaration' in die.attributes
+
+# Returns the (cu offset, die offset) of found, the die offset being looked
+# up by name when the index only knows the CU.
+def resolve_dies(dwarf_info, found, name):
+    ret = []
+
+    for cu_offset, die_offset in found:
+        if die_offset is None:
+            cu = dwarf_info.get_CU_at(cu_offset)
+            die_offset = find_die_by_name(cu, name)
+
+        ret.append((cu_offset, die_offset))
+
+    return ret
+
+# Look name up in index. Returns a list of (cu offset, die offset), the die
+# offset being None if the DIE could not be found in the CU. The
+# declarations (e.g. those of extern variables) are left out when there is
+# a definition.
+#
+# The indexes may leave out some names (e.g. those of the CUs built without
+# one), the DIEs are scanned when index has no definition of name.
+def locate_symbol(dwarf_info, index, name):
+    found = resolve_dies(dwarf_info, index.lookup(name), name)
+    definitions = [x for x in found if not is_declaration(dwarf_info, *x)]
+
+    if not definitions and not isinstance(index, ScanIndex):
+        found += [x for x in ScanIndex(dwarf_info).lookup(name) if x not in found]
+        definitions = [x for x in found if not is_declaration(dwarf_info, *x)]
+
+    return definitions or found
+
+# Look name up in index and build the CUs it is in. Returns a list of
+# (CU element, path from the CU element to the element of name), the path
+# being None if the DIE of that name has no element.
+#
+# cu_elems: dict cu offset -> CU element, the CUs already built
+def open_symbol(builder, index, name, cu_elems = None):
+    ret = []
+
+    if cu_elems is None:
+        cu_elems = dict()
+
+    for cu_offset, die_offset in locate_symbol(builder.dwarf_info, index, name):
+        if cu_offset not in cu_elems:
+            cu = builder.dwarf_info.get_CU_at(cu_offset)
+            cu_elems[cu_offset] = builder.build_cu(cu)
+
+        cu_elem = cu_elems[cu_offset]
+        path = element_path(cu_elem, die_offset) if die_offset is not None else None
+        ret.append((cu_elem, path))
+
+    return ret
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Show the elements of the given names, building only the CUs they are in')
+    parser.add_argument('elfbinary', help = 'The ELF binary to analyze')
+    parser.add_argument('names', help = 'Names of functions, variables or types', nargs = '+')
+    args = parser.parse_args()
+
+    with open(args.elfbinary, 'rb') as f:
+        elf = ELFFile(f)
+
+        if not elf.has_dwarf_info():
+            print("%s has no dwarf info." % args.elfbinary)
+            sys.exit(1)
+
+        di = elf.get_dwarf_info()
+        builder = DwarfModelBuilder(di, False, single_pass = True)
+        index = open_name_index(elf, di)
+        cu_elems = dict()
+
+        for name in args.names:
+            found = open_symbol(builder, index, name, cu_elems)
+
+            if not found:
+                print("%s: not found (using %s)" % (name, index.name))
+
+            for cu_elem, path in found:
+                print("%s: in %s (using %s)" % (name, cu_elem.name, index.name))
+
+                elem = cu_elem
+                for group, position in path or []:
+                    elem = elem.children_groups[group][position]
+
+                dwarfmodeltest.print_rec(elem, "  ")
@@ -0,0 +1,108 @@
+from dwarfmodel import DwarfModelBuilder, Element, BuildCancelled, element_to_tuple, element_from_tuple
+from dwarfinput import ElfInput
+from dwarfcus import CuIndex
+
+import multiprocessing
+import os
+
+# State of a worker process, set up by _worker_init.
+_worker_input = None
+_worker_builder = None
+
+def _worker_init(filename, layouts):
+    global _worker_input, _worker_builder
+
+    _worker_input = ElfInput(filename)
+    _worker_builder = DwarfModelBuilder(_worker_input.get_dwarf_info(), False, single_pass = True, layouts = layouts)
+
+# Returns the tuples of the CU elements, and the layouts recorded while
+# building them (None if not recorded).
+def _worker_build_cus(cu_offsets):
+    ret = []
+    dwarf_info = _worker_builder.dwarf_info
+
+    for cu_offset in cu_offsets:
+        cu = dwarf_info.get_CU_at(cu_offset)
+        cu_elem = _worker_builder.build_cu(cu)
+        ret.append(element_to_tuple(cu_elem))
+
+    layouts = _worker_builder.layouts
+    if layouts is not None:
+        _worker_builder.layouts = dict()
+
+    return ret, layouts
+
+def split_in_chunks(items, jobs):
+    # Enough chunks to balance the load between workers, but not so many
+    # that the overhead of sending them dominates.
+    chunk_size = max(1, min(64, len(items) // (jobs * 4)))
+
+    return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+# Wait for the next result of a pool.imap, calling stop_check regularly.
+# Raise BuildCancelled if it returns True.
+def _next_result(results, stop_check):
+    if stop_check is None:
+        return next(results)
+
+    while True:
+        try:
+            return results.next(timeout = 0.05)
+        except multiprocessing.TimeoutError:
+            if stop_check():
+                raise BuildCancelled()
+
+# Build the model of filename using a pool of jobs processes, each building
+# the elements of a subset of the CUs. Like DwarfModelBuilder.build_step,
+# yields the number of bytes of .debug_info consumed each time a CU is done,
+# then the file element. If stop_check is given, it is polled while waiting
+# for the workers; when it returns True, the pool is terminated and
+# BuildCancelled is raised.
+#
+# layouts: if not None, a dict the layouts of the types and members of the
+#          CUs are added to, for a TypeDeduplicator (see
+#          DwarfModelBuilder.layouts).
+def build_parallel_step(filename, jobs = None, stop_check = None, layouts = None):
+    if jobs is None:
+        jobs = os.cpu_count()
+
+    elf_input = ElfInput(filename)
+    try:
+        cus = CuIndex(elf_input.get_dwarf_info())
+    finally:
+        elf_input.close()
+
+    cu_offsets = list(cus.offsets)
+    cu_ends = iter(cus.ends)
+
+    file_elem = Element("File", None)
+    yield 0
+
+    # Don't fork, the calling process may have threads (e.g. the UI).
+    context = multiprocessing.get_context('spawn')
+
+    # Leaving the with block terminates the workers, including when the
+    # build is cancelled.
+    with context.Pool(jobs, _worker_init, (filename, layouts is not None)) as pool:
+        # imap returns the results in the order of the chunks, so the CUs
+        # end up in file order.
+        chunks = split_in_chunks(cu_offsets, jobs)
+        results = pool.imap(_worker_build_cus, chunks)
+
+        for i in range(len(chunks)):
+            cu_tuples, cu_layouts = _next_result(results, stop_check)
+
+            if layouts is not None:
+                layouts.update(cu_layouts)
+
+            for cu_tuple in cu_tuples:
+                file_elem.add_child(None, element_from_tuple(cu_tuple))
+                yield next(cu_ends)
+
+    yield file_elem
+
+def build_parallel(filename, jobs = None):
+    for file_elem in build_parallel_step(filename, jobs):
+        pass
+
+    return file_elem
@@ -0,0 +1,155 @@
+import time
+import tracemalloc
+
+# Statistics of one phase. The time and allocations of nested phases are not
+# counted in their parent, so the phases add up to the total.
+class PhaseStats:
+    __slots__ = ('calls', 'seconds', 'allocated')
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        # Net number of bytes allocated, only with allocations tracking
+        self.allocated = 0
+
+# Records the time spent in the phases of building and showing a model,
+# some counters, and the time spent on each CU.
+#
+# Nothing calls a profiler unless one is given, e.g. to DwarfModelBuilder, so
+# that profiling costs nothing when it is disabled.
+class Profiler:
+    # allocations: also record the memory allocated in each phase, using
+    #              tracemalloc. This slows everything down noticeably.
+    def __init__(self, allocations = False):
+        self.allocations = allocations
+        self.tracing = False
+
+        if allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracing = True
+
+        # Phase name -> PhaseStats, in the order they first ran
+        self.phases = dict()
+        # Counter name -> value
+        self.counters = dict()
+        # List of (CU offset, CU name, seconds, DIEs read)
+        self.cus = []
+
+        # The running phases, as lists of [name, start time, time of the
+        # nested phases, start memory, memory of the nested phases].
+        self.stack = []
+
+    def stop(self):
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+
+    def _memory(self):
+        if not self.allocations:
+            return 0
+
+        current, peak = tracemalloc.get_traced_memory()
+        return current
+
+    def begin(self, name):
+        self.stack.append([name, time.perf_counter(), 0.0, self._memory(), 0])
+
+    def end(self):
+        name, start, nested_seconds, start_memory, nested_allocated = self.stack.pop()
+        seconds = time.perf_counter() - start
+        allocated = self._memory() - start_memory
+
+        stats = self.phases.get(name)
+        if stats is None:
+            stats = PhaseStats()
+            self.phases[name] = stats
+
+        stats.calls += 1
+        stats.seconds += seconds - nested_seconds
+        stats.allocated += allocated - nested_allocated
+
+        if self.stack:
+            parent = self.stack[-1]
+            parent[2] += seconds
+            parent[4] += allocated
+
+    # Use as: with profiler.phase("name"): ...
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def count(self, name, n = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_cu(self, cu_offset, name, seconds, dies):
+        self.cus.append((cu_offset, name, seconds, dies))
+
+    def total_seconds(self):
+        return sum(stats.seconds for stats in self.phases.values())
+
+    def as_dict(self):
+        return {
+            "phases": [{
+                "name": name,
+                "calls": stats.calls,
+                "seconds": stats.seconds,
+                "allocated": stats.allocated if self.allocations else None,
+            } for name, stats in self.phases.items()],
+            "counters": dict(self.counters),
+            "cus": [{
+                "offset": cu_offset,
+                "name": name,
+                "seconds": seconds,
+                "dies": dies,
+            } for cu_offset, name, seconds, dies in self.cus],
+        }
+
+    # Returns the report as a list of lines, with the slowest_cus slowest
+    # CUs.
+    def report(self, slowest_cus = 10):
+        lines = []
+        total = self.total_seconds()
+
+        lines.append("Phases:")
+        for name, stats in self.phases.items():
+            percent = 100.0 * stats.seconds / total if total else 0.0
+            line = "  %-20s %10.3f s %5.1f %% %8d calls" % (name, stats.seconds, percent, stats.calls)
+
+            if self.allocations:
+                line += " %12s" % format_bytes(stats.allocated)
+
+            lines.append(line)
+        lines.append("  %-20s %10.3f s" % ("total", total))
+
+        if self.counters:
+            lines.append("Counters:")
+            for name, value in self.counters.items():
+                lines.append("  %-20s %10d" % (name, value))
+
+        if self.cus:
+            lines.append("Slowest CUs (%d in total):" % len(self.cus))
+            cus = sorted(self.cus, key = lambda cu: cu[2], reverse = True)
+            for cu_offset, name, seconds, dies in cus[:slowest_cus]:
+                lines.append("  %10.3f s %8d DIEs  0x%x %s" % (seconds, dies, cu_offset, name))
+
+        return lines
+
+class _Phase:
+    __slots__ = ('profiler', 'name')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.begin(self.name)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.end()
+
+def format_bytes(n):
+    for unit in ["B", "KiB", "MiB"]:
+        if abs(n) < 1024:
+            return "%d %s" % (n, unit)
+        n //= 1024
+
+    return "%d GiB" % n
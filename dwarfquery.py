@@ -0,0 +1,407 @@
+from dwarfmodel import ChildrenGroup, DwarfModelBuilder
+from dwarfindex import NameIndex
+from dwarfaddr import AddressIndex
+from dwarfinput import ElfInput
+import dwarfcache
+
+from array import array
+from bisect import bisect_left, bisect_right
+from fnmatch import fnmatchcase
+from itertools import chain, islice
+import argparse
+import sys
+import time
+
+# Group of the entries in no ChildrenGroup (struct members, enumerators), as
+# in NameIndex.groups
+others_group = -1
+
+def group_name(group):
+    if group is None:
+        return "CUs"
+
+    return ChildrenGroup.name(group) if group != others_group else "Others"
+
+# Returns the group named text (case insensitively, or the only one whose
+# name starts with it), "Others" being others_group.
+def parse_group(text):
+    names = [name.lower() for name in ChildrenGroup.names] + ["others"]
+    text = text.lower()
+
+    matches = [i for i, name in enumerate(names) if name == text]
+    if not matches:
+        matches = [i for i, name in enumerate(names) if name.startswith(text)]
+
+    if len(matches) != 1:
+        raise ValueError("Unknown or ambiguous group: %s" % text)
+
+    return matches[0] if matches[0] < len(ChildrenGroup.names) else others_group
+
+# The prefix of pattern before its first wildcard.
+def literal_prefix(pattern):
+    for i, c in enumerate(pattern):
+        if c in '*?[':
+            return pattern[:i]
+
+    return pattern
+
+class ValueIndex:
+    # Index of the entries of a NameIndex by a value (name, type string...).
+    #
+    # Each distinct value has an id, in the order they are first seen, and
+    # ids[entry] is the id of the value of entry, -1 if it has none. The
+    # entries having each value are stored one value after the other in a
+    # single array: those of value id i are entries[starts[i]:starts[i + 1]],
+    # in increasing order. The values are also kept sorted, for pattern
+    # lookups.
+    #
+    # entry_values: the value of each entry, None for none
+    def __init__(self, entry_values):
+        first_ids = dict()
+        # Entries of each value id
+        value_entries = []
+        self.ids = array('l')
+
+        for entry, value in enumerate(entry_values):
+            if value is None:
+                self.ids.append(-1)
+                continue
+
+            i = first_ids.get(value)
+            if i is None:
+                i = len(value_entries)
+                first_ids[value] = i
+                value_entries.append([])
+
+            self.ids.append(i)
+            value_entries[i].append(entry)
+
+        self.entries = array('l')
+        self.starts = array('l', [0])
+        for entries in value_entries:
+            self.entries.extend(entries)
+            self.starts.append(len(self.entries))
+
+        # The values in the order of their ids, and sorted with their ids
+        self.id_values = list(first_ids)
+        self.values = sorted(first_ids)
+        self.value_ids = [first_ids[value] for value in self.values]
+
+    # Returns the ids of the values equal to value.
+    def ids_equal(self, value):
+        i = bisect_left(self.values, value)
+
+        if i < len(self.values) and self.values[i] == value:
+            return [self.value_ids[i]]
+
+        return []
+
+    # Returns the ids of the values matching pattern, a glob pattern (see
+    # fnmatch) of strings. Only the values starting with the literal prefix
+    # of pattern are looked at.
+    def ids_matching(self, pattern):
+        prefix = literal_prefix(pattern)
+
+        if prefix == pattern:
+            return self.ids_equal(pattern)
+
+        start = bisect_left(self.values, prefix)
+        ret = []
+
+        for i in range(start, len(self.values)):
+            value = self.values[i]
+
+            if not value.startswith(prefix):
+                break
+
+            if fnmatchcase(value, pattern):
+                ret.append(self.value_ids[i])
+
+        return ret
+
+    def value(self, i):
+        return self.id_values[i] if i >= 0 else None
+
+    def count(self, ids):
+        return sum(self.starts[i + 1] - self.starts[i] for i in ids)
+
+    # Returns the entries having one of the values of ids, in increasing
+    # order.
+    def entries_of(self, ids):
+        if len(ids) == 1:
+            i = ids[0]
+            return self.entries[self.starts[i]:self.starts[i + 1]]
+
+        return sorted(chain.from_iterable(self.entries[self.starts[i]:self.starts[i + 1]] for i in ids))
+
+    # Returns the entries of entries having one of the values of ids.
+    def filter(self, entries, ids):
+        column = self.ids
+        wanted = frozenset(ids)
+
+        return [entry for entry in entries if column[entry] in wanted]
+
+class QueryIndex:
+    # Indexes of the elements of a model by group, name, type string and CU,
+    # built once, to select elements without walking the model.
+    #
+    # The elements are those of a NameIndex, identified by their entry. Its
+    # entries are numbered depth first, so the elements of each CU are a
+    # range of entries.
+    #
+    # address_index: a dwarfaddr.AddressIndex of the file, to select elements
+    #                by address. Optional.
+    def __init__(self, name_index, address_index = None):
+        self.name_index = name_index
+        self.address_index = address_index
+
+        elements = name_index.elements
+        parents = name_index.parents
+        n = len(elements)
+
+        # The CUs, by increasing entry, and the entry following each
+        self.cu_entries = array('l', (entry for entry in range(n) if parents[entry] == 0))
+        self.cu_ends = array('l', self.cu_entries[1:])
+        self.cu_ends.append(n)
+        self.cu_names = ValueIndex(elements[entry].name for entry in self.cu_entries)
+
+        # The file and CU elements are in no group.
+        groups = name_index.groups
+        self.groups = ValueIndex(groups[entry] if parents[entry] > 0 else None for entry in range(n))
+
+        # Neither is the file element selected by name or type.
+        self.names = ValueIndex(chain([None], (elem.name for elem in islice(elements, 1, None))))
+        self.type_strings = ValueIndex(chain([None], (elem.type_string for elem in islice(elements, 1, None))))
+
+    def __len__(self):
+        return len(self.name_index)
+
+    # Returns the index of the CU of entry in cu_entries, -1 for the file.
+    def cu_of(self, entry):
+        return bisect_right(self.cu_entries, entry) - 1
+
+    # Returns the entries of the elements matching all the given filters, in
+    # increasing order:
+    #
+    # groups: list of ChildrenGroup (or others_group)
+    # name, type_string, cu: glob patterns of the name, type string and CU
+    #                        name of the elements
+    # addresses: (low, high), the elements of the CUs, subprograms and
+    #            lexical blocks with code in [low, high). Needs an
+    #            address_index.
+    # parent_groups: list of the groups of the parents of the elements, e.g.
+    #                StructType for struct members
+    #
+    # The filter matching the fewest entries according to the indexes gives
+    # the candidates, which the others then filter.
+    def select(self, groups = None, name = None, type_string = None, cu = None, addresses = None, parent_groups = None):
+        # List of (number of candidates, function returning them in
+        # increasing order, function filtering a list of candidates in
+        # increasing order). The first two are None when the indexes cannot
+        # tell the candidates.
+        filters = []
+
+        if groups is not None:
+            ids = [i for group in groups for i in self.groups.ids_equal(group)]
+            filters.append(self._value_filter(self.groups, ids))
+
+        if name is not None:
+            filters.append(self._value_filter(self.names, self.names.ids_matching(name)))
+
+        if type_string is not None:
+            filters.append(self._value_filter(self.type_strings, self.type_strings.ids_matching(type_string)))
+
+        if cu is not None:
+            filters.append(self._cu_filter(self.cu_names.ids_matching(cu)))
+
+        if addresses is not None:
+            filters.append(self._address_filter(*addresses))
+
+        if parent_groups is not None:
+            filters.append(self._parent_group_filter(parent_groups))
+
+        candidates = [f for f in filters if f[1] is not None]
+
+        if candidates:
+            driver = min(candidates, key = lambda f: f[0])
+            entries = driver[1]()
+        else:
+            driver = None
+            entries = range(1, len(self))
+
+        for f in filters:
+            if f is not driver:
+                entries = f[2](entries)
+
+        return list(entries)
+
+    def _value_filter(self, index, ids):
+        return (index.count(ids), lambda: index.entries_of(ids), lambda entries: index.filter(entries, ids))
+
+    def _cu_filter(self, cu_ids):
+        # Indexes in cu_entries, their elements are a range of entries each.
+        cus = self.cu_names.entries_of(cu_ids)
+        ranges = [(self.cu_entries[i], self.cu_ends[i]) for i in cus]
+
+        def candidates():
+            return list(chain.from_iterable(range(start, end) for start, end in ranges))
+
+        def filter_entries(entries):
+            ret = []
+            for start, end in ranges:
+                ret.extend(entries[bisect_left(entries, start):bisect_left(entries, end)])
+            return ret
+
+        return (sum(end - start for start, end in ranges), candidates, filter_entries)
+
+    def _address_filter(self, low, high):
+        if self.address_index is None:
+            raise ValueError("Selecting elements by address needs an address index")
+
+        entries = []
+        for scope in self.address_index.lookup_range(low, high):
+            entry = self.name_index.entry_at_offset(scope.offset)
+            if entry is not None:
+                entries.append(entry)
+
+        entries.sort()
+        wanted = frozenset(entries)
+
+        return (len(entries), lambda: entries, lambda candidates: [entry for entry in candidates if entry in wanted])
+
+    def _parent_group_filter(self, parent_groups):
+        parents = self.name_index.parents
+        column = self.groups.ids
+        wanted = frozenset(i for group in parent_groups for i in self.groups.ids_equal(group))
+
+        def filter_entries(entries):
+            return [entry for entry in entries if parents[entry] > 0 and column[parents[entry]] in wanted]
+
+        return (None, None, filter_entries)
+
+    # Returns the distinct parents of entries, in increasing order.
+    def parents_of(self, entries):
+        parents = self.name_index.parents
+        return sorted(set(parents[entry] for entry in entries if parents[entry] >= 0))
+
+    # Returns dict group -> number of entries in it, None for the CUs.
+    def count_by_group(self, entries):
+        ids = self.groups.ids
+        counts = dict()
+
+        for entry in entries:
+            i = ids[entry]
+            counts[i] = counts.get(i, 0) + 1
+
+        return {self.groups.value(i): count for i, count in counts.items()}
+
+    # Returns the list of (CU name, number of entries in that CU), for the
+    # CUs having some. entries must be in increasing order.
+    def count_by_cu(self, entries):
+        ret = []
+        elements = self.name_index.elements
+
+        for cu_entry, cu_end in zip(self.cu_entries, self.cu_ends):
+            count = bisect_left(entries, cu_end) - bisect_left(entries, cu_entry)
+            if count:
+                ret.append((elements[cu_entry].name, count))
+
+        return ret
+
+    def format_entry(self, entry):
+        elem = self.name_index.element(entry)
+        cu = self.cu_of(entry)
+        cu_name = self.name_index.element(self.cu_entries[cu]).name if cu >= 0 else None
+        group = group_name(self.groups.value(self.groups.ids[entry]))
+
+        return "0x%x\t%s\t%s\t%s\t%s" % (elem.offset if elem.offset is not None else 0, cu_name or "-",
+                                         group, elem.name or "-", elem.type_string or "-")
+
+def parse_address_range(text):
+    low, sep, high = text.partition('-')
+    low = int(low, 16)
+
+    return (low, int(high, 16) if sep else low + 1)
+
+# Returns the model of the file of elf_input, from cache if it has it.
+def load_model(elf_input, cache):
+    key = None
+
+    if cache is not None:
+        key = dwarfcache.model_key(elf_input.elf, elf_input.file)
+        file_elem = cache.load(key)
+        if file_elem is not None:
+            return file_elem
+
+    builder = DwarfModelBuilder(elf_input.get_dwarf_info(), False, single_pass = True, columnar = True)
+    file_elem = builder.build()
+
+    if key is not None:
+        try:
+            cache.store(key, file_elem)
+        except OSError as e:
+            print("Could not store the model in the cache: %s" % e, file = sys.stderr)
+
+    return file_elem
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Select the elements of the DWARF model of an ELF binary')
+    parser.add_argument('elfbinary', help = 'The ELF binary to analyze')
+    parser.add_argument('--group', '-g', action = 'append',
+                        help = 'Only the elements of this group (e.g. "Structure types", or "struct"), can be repeated')
+    parser.add_argument('--name', '-n', help = 'Only the elements whose name matches this glob pattern')
+    parser.add_argument('--type', '-t', help = 'Only the elements whose type matches this glob pattern')
+    parser.add_argument('--cu', help = 'Only the elements of the CUs whose name matches this glob pattern')
+    parser.add_argument('--address', '-a', help = 'Only the CUs, subprograms and lexical blocks with code in LOW-HIGH, or at LOW (hexadecimal)')
+    parser.add_argument('--parent-group', action = 'append',
+                        help = 'Only the elements whose parent is in this group (e.g. "struct" for members), can be repeated')
+    parser.add_argument('--parents', action = "store_true",
+                        help = 'Print the parents of the elements selected instead, e.g. the structs of the members')
+    parser.add_argument('--count', choices = ["total", "group", "cu"],
+                        help = 'Print the number of elements selected, in total, per group or per CU')
+    parser.add_argument('--limit', type = int, help = 'Print at most this many elements')
+    parser.add_argument('--no-cache', action = "store_true", help = 'Do not use the cache of built models')
+    args = parser.parse_args()
+
+    elf_input = ElfInput(args.elfbinary)
+
+    if not elf_input.elf.has_dwarf_info():
+        print("%s has no dwarf info." % args.elfbinary)
+        sys.exit(1)
+
+    try:
+        groups = [parse_group(g) for g in args.group] if args.group else None
+        parent_groups = [parse_group(g) for g in args.parent_group] if args.parent_group else None
+        addresses = parse_address_range(args.address) if args.address else None
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+
+    start = time.perf_counter()
+    file_elem = load_model(elf_input, None if args.no_cache else dwarfcache.ModelCache())
+    address_index = AddressIndex(elf_input.get_dwarf_info()) if addresses is not None else None
+    index = QueryIndex(NameIndex(file_elem), address_index)
+    load_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    entries = index.select(groups = groups, name = args.name, type_string = args.type, cu = args.cu,
+                           addresses = addresses, parent_groups = parent_groups)
+    if args.parents:
+        entries = index.parents_of(entries)
+    query_time = time.perf_counter() - start
+
+    if args.count == "total":
+        print(len(entries))
+    elif args.count == "group":
+        for group, count in sorted(index.count_by_group(entries).items(), key = lambda x: -x[1]):
+            print("%d\t%s" % (count, group_name(group)))
+    elif args.count == "cu":
+        for cu_name, count in index.count_by_cu(entries):
+            print("%d\t%s" % (count, cu_name))
+    else:
+        for entry in entries[:args.limit]:
+            print(index.format_entry(entry))
+
+    print("%d elements, loaded in %.3f s, selected in %.1f ms" % (len(entries), load_time, query_time * 1000),
+          file = sys.stderr)
+    elf_input.close()
@@ -0,0 +1,175 @@
+from dwarfcus import CuIndex
+from dwarftable import DieTable, UnsupportedForm, section_bytes
+from elftools.elf.elffile import ELFFile
+
+import argparse
+import sys
+
+# Tags of the types whose users are also users of the type they refer to:
+# the users of "struct foo *" or of "typedef struct foo foo_t" use struct foo.
+derived_tags = frozenset([
+    'DW_TAG_typedef',
+    'DW_TAG_const_type',
+    'DW_TAG_volatile_type',
+    'DW_TAG_pointer_type',
+])
+
+# Returns the absolute offset of the DIE a reference of the given form and
+# value in cu refers to, or None if it is not in .debug_info (type units,
+# supplementary files).
+def ref_target(cu, form, value):
+    if form == 'DW_FORM_ref_addr':
+        return value
+
+    if form in ('DW_FORM_ref_sig8', 'DW_FORM_ref_sup4', 'DW_FORM_ref_sup8', 'DW_FORM_GNU_ref_alt'):
+        return None
+
+    return cu.cu_offset + value
+
+class TypeReferences:
+    # Which DIEs refer to each type DIE through their DW_AT_type: members,
+    # variables, parameters, subprograms and other types. All offsets are
+    # absolute DIE offsets, like those of the elements of the model.
+    #
+    # It is filled by DwarfModelBuilder during its types pass when given one,
+    # or by build_type_references.
+    def __init__(self):
+        # type offset -> list of offsets of the DIEs referring to it
+        self.referrers = dict()
+        # Offsets of the referring DIEs whose tag is in derived_tags
+        self.derived = set()
+        # type offset -> list returned by users(), computed when first asked
+        self.closures = dict()
+
+    def add(self, type_offset, offset, tag):
+        referrers = self.referrers.get(type_offset)
+        if referrers is None:
+            referrers = []
+            self.referrers[type_offset] = referrers
+
+        referrers.append(offset)
+
+        if tag in derived_tags:
+            self.derived.add(offset)
+
+        if self.closures:
+            self.closures.clear()
+
+    # Add the reference of die, a pyelftools DIE or a dwarftable.TableDie,
+    # if it has one.
+    def add_die(self, die):
+        attr = die.attributes.get('DW_AT_type')
+        if attr is None:
+            return
+
+        type_offset = ref_target(die.cu, attr.form, attr.value)
+        if type_offset is not None:
+            self.add(type_offset, die.offset, die.tag)
+
+    # Add the references of the DIEs of a dwarftable.DieTable.
+    def add_table(self, table):
+        cu = table.cu
+        offsets = table.offsets
+        abbrevs = table.abbrevs
+        tags = table.tags
+        type_refs = table.type_refs
+
+        for row in table.rows_with_attribute('DW_AT_type'):
+            form = table.abbrev_forms[abbrevs[row]]['DW_AT_type']
+            type_offset = ref_target(cu, form, type_refs[row])
+
+            if type_offset is not None:
+                self.add(type_offset, offsets[row], table.tag_names[tags[row]])
+
+    def __len__(self):
+        return len(self.referrers)
+
+    # Returns the offsets of the DIEs referring to the type at type_offset.
+    def direct_users(self, type_offset):
+        return self.referrers.get(type_offset, [])
+
+    # Returns the offsets of the DIEs referring to the type at type_offset,
+    # directly or through typedefs, consts, volatiles and pointers, in
+    # increasing order. The typedefs, etc. themselves are included.
+    def users(self, type_offset):
+        ret = self.closures.get(type_offset)
+        if ret is not None:
+            return ret
+
+        ret = []
+        seen = {type_offset}
+        pending = [type_offset]
+
+        while pending:
+            for offset in self.referrers.get(pending.pop(), []):
+                if offset in seen:
+                    continue
+
+                seen.add(offset)
+                ret.append(offset)
+
+                if offset in self.derived:
+                    pending.append(offset)
+
+        ret.sort()
+        self.closures[type_offset] = ret
+        return ret
+
+# Fill references with the references of all the CUs of dwarf_info. Like
+# DwarfModelBuilder.build_step, yields the number of bytes of .debug_info
+# consumed after each CU, so that the caller can show progress or stop.
+def build_type_references_step(dwarf_info, references):
+    strings = section_bytes(dwarf_info.debug_str_sec)
+    line_strings = section_bytes(getattr(dwarf_info, 'debug_line_str_sec', None))
+    cus = CuIndex(dwarf_info)
+
+    for n in range(len(cus)):
+        cu = cus.get_cu(n)
+
+        try:
+            references.add_table(DieTable(cu, strings, line_strings))
+        except UnsupportedForm:
+            for die in cu.iter_DIEs():
+                references.add_die(die)
+
+        yield cus.ends[n]
+
+def build_type_references(dwarf_info):
+    references = TypeReferences()
+
+    for bytes_done in build_type_references_step(dwarf_info, references):
+        pass
+
+    return references
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Print the DIEs using the types at the given DIE offsets')
+    parser.add_argument('elfbinary', help = 'The ELF binary to analyze')
+    parser.add_argument('offsets', help = 'Offsets of type DIEs, in hexadecimal', nargs = '+')
+    parser.add_argument('--direct', action = "store_true", help = 'Only print the DIEs referring to the types themselves, not through typedefs, pointers, etc.')
+    args = parser.parse_args()
+
+    with open(args.elfbinary, 'rb') as f:
+        elf = ELFFile(f)
+
+        if not elf.has_dwarf_info():
+            print("%s has no dwarf info." % args.elfbinary)
+            sys.exit(1)
+
+        di = elf.get_dwarf_info()
+        references = build_type_references(di)
+
+        for text in args.offsets:
+            try:
+                type_offset = int(text, 16)
+            except ValueError:
+                print("%s\tinvalid offset" % text)
+                continue
+
+            users = references.direct_users(type_offset) if args.direct else references.users(type_offset)
+
+            for offset in users:
+                die = di.get_DIE_from_refaddr(offset)
+                name = die.attributes.get('DW_AT_name')
+                name = name.value.decode() if name is not None else "-"
+                print("0x%x\t0x%x\t%s\t%s" % (type_offset, offset, die.tag, name))
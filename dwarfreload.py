@@ -0,0 +1,401 @@
+from dwarfcus import CuIndex
+from dwarfmodel import Element, ChildrenGroup
+from dwarftable import read_uleb, section_bytes
+from elftools.dwarf.enums import ENUM_DW_FORM
+
+import hashlib
+
+# How _cu_digest handles the value of each form, as (kind, size).
+_HASH = 0           # hash the size bytes
+_SKIP = 1           # skip the size bytes
+_LEB = 2            # hash a LEB128
+_SKIP_LEB = 3       # skip a LEB128, hashing only its length
+_STRING = 4         # hash an inline string
+_STRP = 5           # hash the string at the size bytes offset in .debug_str
+_LINE_STRP = 6      # same, in .debug_line_str
+_ADDR = 7           # hash the size bytes address, relative to the base
+_BLOCK = 8          # hash a block whose length takes size bytes (0: LEB128)
+_SKIP_BLOCK = 9     # skip the content of such a block, hashing its length
+_INDIRECT = 10      # the form is in the DIE
+_ADDRX = 11         # an index in .debug_addr: the CU can't be reused
+_STRX = 12          # hash the string at a size bytes index (0: LEB128) in
+                    # .debug_str_offsets
+
+def _form_actions(version, offset_size, address_size):
+    return {
+        'DW_FORM_addr': (_ADDR, address_size),
+        'DW_FORM_data1': (_HASH, 1),
+        'DW_FORM_ref1': (_HASH, 1),
+        'DW_FORM_flag': (_HASH, 1),
+        'DW_FORM_strx1': (_STRX, 1),
+        'DW_FORM_data2': (_HASH, 2),
+        'DW_FORM_ref2': (_HASH, 2),
+        'DW_FORM_strx2': (_STRX, 2),
+        'DW_FORM_strx3': (_STRX, 3),
+        'DW_FORM_data4': (_HASH, 4),
+        'DW_FORM_ref4': (_HASH, 4),
+        'DW_FORM_strx4': (_STRX, 4),
+        'DW_FORM_ref_sup4': (_HASH, 4),
+        'DW_FORM_data8': (_HASH, 8),
+        'DW_FORM_ref8': (_HASH, 8),
+        'DW_FORM_ref_sig8': (_HASH, 8),
+        'DW_FORM_ref_sup8': (_HASH, 8),
+        'DW_FORM_data16': (_HASH, 16),
+        'DW_FORM_flag_present': (_HASH, 0),
+        'DW_FORM_implicit_const': (_HASH, 0),
+        'DW_FORM_udata': (_LEB, 0),
+        'DW_FORM_sdata': (_LEB, 0),
+        'DW_FORM_ref_udata': (_LEB, 0),
+        'DW_FORM_strx': (_STRX, 0),
+        'DW_FORM_rnglistx': (_SKIP_LEB, 0),
+        'DW_FORM_loclistx': (_SKIP_LEB, 0),
+        'DW_FORM_addrx': (_ADDRX, 0),
+        'DW_FORM_addrx1': (_ADDRX, 1),
+        'DW_FORM_addrx2': (_ADDRX, 2),
+        'DW_FORM_addrx3': (_ADDRX, 3),
+        'DW_FORM_addrx4': (_ADDRX, 4),
+        'DW_FORM_GNU_addr_index': (_ADDRX, 0),
+        'DW_FORM_GNU_str_index': (_STRX, 0),
+        'DW_FORM_string': (_STRING, 0),
+        'DW_FORM_strp': (_STRP, offset_size),
+        'DW_FORM_line_strp': (_LINE_STRP, offset_size),
+        'DW_FORM_strp_sup': (_HASH, offset_size),
+        'DW_FORM_GNU_strp_alt': (_HASH, offset_size),
+        'DW_FORM_GNU_ref_alt': (_HASH, offset_size),
+        'DW_FORM_sec_offset': (_SKIP, offset_size),
+        'DW_FORM_ref_addr': (_SKIP, offset_size if version >= 3 else address_size),
+        'DW_FORM_block1': (_BLOCK, 1),
+        'DW_FORM_block2': (_BLOCK, 2),
+        'DW_FORM_block4': (_BLOCK, 4),
+        'DW_FORM_block': (_BLOCK, 0),
+        'DW_FORM_exprloc': (_SKIP_BLOCK, 0),
+        'DW_FORM_indirect': (_INDIRECT, 0),
+    }
+
+# The blocks of these attributes are DWARF expressions, which the model
+# doesn't show and which contain addresses.
+_expression_attrs = frozenset([
+    'DW_AT_location',
+    'DW_AT_frame_base',
+    'DW_AT_data_member_location',
+    'DW_AT_vtable_elem_location',
+    'DW_AT_static_link',
+    'DW_AT_return_addr',
+    'DW_AT_call_value',
+    'DW_AT_call_target',
+    'DW_AT_GNU_call_site_value',
+    'DW_AT_GNU_call_site_target',
+])
+
+# Before DWARF 4, the offsets in other sections of these attributes use the
+# data4 and data8 forms rather than sec_offset.
+_section_offset_attrs = frozenset([
+    'DW_AT_stmt_list',
+    'DW_AT_ranges',
+    'DW_AT_macro_info',
+    'DW_AT_location',
+    'DW_AT_frame_base',
+    'DW_AT_string_length',
+    'DW_AT_return_addr',
+    'DW_AT_static_link',
+    'DW_AT_use_location',
+    'DW_AT_vtable_elem_location',
+    'DW_AT_data_member_location',
+])
+
+class _CannotReuse(Exception):
+    pass
+
+def _read_string(strings, offset):
+    end = strings.index(b'\0', offset)
+    return strings[offset:end + 1]
+
+# Returns the offset of the string offsets of cu in .debug_str_offsets.
+def _str_offsets_base(cu):
+    base = cu.get_top_DIE().attributes.get('DW_AT_str_offsets_base')
+    if base is None:
+        raise _CannotReuse()
+
+    return base.value
+
+# Returns the digest of the content of cu that the model depends on, and the
+# first address in the CU, which its other addresses are hashed relative to.
+#
+# Hashing the bytes of the CU as they are would not do: adding a string or
+# some code to an object file moves the strings and code of those linked
+# after it, and their CUs would all look changed. So the DIEs of the CU are
+# scanned (much faster than pyelftools parses them), hashing the strings
+# instead of their offsets and the addresses relative to the first one, and
+# leaving out the offsets in other sections and the DWARF expressions. The
+# lengths of the values left out are still hashed: the offsets of the DIEs
+# following them depend on them.
+#
+# strings, line_strings, str_offsets: the content of .debug_str,
+# .debug_line_str and .debug_str_offsets
+def _cu_digest(cu, data, strings, line_strings, str_offsets):
+    structs = cu.structs
+    byteorder = 'little' if structs.little_endian else 'big'
+    offset_size = 8 if structs.dwarf_format == 64 else 4
+    address_size = structs.address_size
+    version = cu['version']
+    forms = _form_actions(version, offset_size, address_size)
+    indirect_forms = None
+
+    abbrev_table = cu.get_abbrev_table()
+    # abbreviation code -> list of (kind, size)
+    decoders = dict()
+
+    out = bytearray()
+    out += repr((version, cu.header.get('unit_type'), address_size, offset_size)).encode()
+
+    base = None
+    str_offsets_base = None
+    pos = cu.cu_die_offset - cu.cu_offset
+    end = len(data)
+
+    while pos < end:
+        start = pos
+        code, pos = read_uleb(data, pos)
+        out += data[start:pos]
+
+        if code == 0:
+            continue
+
+        decoder = decoders.get(code)
+        if decoder is None:
+            abbrev = abbrev_table.get_abbrev(code)
+            decoder = []
+
+            for spec in abbrev['attr_spec']:
+                action = forms.get(spec.form)
+                if action is None:
+                    raise _CannotReuse()
+
+                if action[0] == _BLOCK and spec.name in _expression_attrs:
+                    action = (_SKIP_BLOCK, action[1])
+
+                if (version < 4 and spec.form in ('DW_FORM_data4', 'DW_FORM_data8')
+                        and spec.name in _section_offset_attrs):
+                    action = (_SKIP, action[1])
+
+                decoder.append(action)
+
+            # The meaning of the bytes of the DIEs depends on their
+            # abbreviation.
+            out += repr((abbrev['tag'], abbrev.has_children(),
+                         [(spec.name, spec.form, spec.value) for spec in abbrev['attr_spec']])).encode()
+            decoders[code] = decoder
+
+        for kind, size in decoder:
+            if kind == _INDIRECT:
+                if indirect_forms is None:
+                    indirect_forms = {value: name for name, value in ENUM_DW_FORM.items()}
+
+                form_code, pos = read_uleb(data, pos)
+                action = forms.get(indirect_forms.get(form_code))
+                if action is None or action[0] == _INDIRECT:
+                    raise _CannotReuse()
+
+                out += repr(form_code).encode()
+                kind, size = action
+
+            if kind == _HASH:
+                out += data[pos:pos + size]
+                pos += size
+            elif kind == _SKIP:
+                pos += size
+            elif kind == _LEB or kind == _SKIP_LEB:
+                start = pos
+                while data[pos] & 0x80:
+                    pos += 1
+                pos += 1
+
+                if kind == _LEB:
+                    out += data[start:pos]
+                else:
+                    out.append(pos - start)
+            elif kind == _STRING:
+                start = pos
+                pos = data.index(b'\0', pos) + 1
+                out += data[start:pos]
+            elif kind == _STRP or kind == _LINE_STRP:
+                offset = int.from_bytes(data[pos:pos + size], byteorder)
+                pos += size
+                out += _read_string(strings if kind == _STRP else line_strings, offset)
+            elif kind == _STRX:
+                if size == 0:
+                    index, pos = read_uleb(data, pos)
+                else:
+                    index = int.from_bytes(data[pos:pos + size], byteorder)
+                    pos += size
+
+                # The string offsets base (a sec_offset, skipped) may come
+                # after the first strx of the top DIE, it is read from the
+                # DIE when first needed.
+                if str_offsets_base is None:
+                    str_offsets_base = _str_offsets_base(cu)
+
+                start = str_offsets_base + index * offset_size
+                if start + offset_size > len(str_offsets):
+                    raise _CannotReuse()
+
+                offset = int.from_bytes(str_offsets[start:start + offset_size], byteorder)
+                out += _read_string(strings, offset)
+            elif kind == _ADDR:
+                address = int.from_bytes(data[pos:pos + size], byteorder)
+                pos += size
+
+                if base is None:
+                    base = address
+
+                out += (address - base).to_bytes(size + 1, 'little', signed = True)
+            elif kind == _BLOCK or kind == _SKIP_BLOCK:
+                start = pos
+
+                if size == 0:
+                    length, pos = read_uleb(data, pos)
+                else:
+                    length = int.from_bytes(data[pos:pos + size], byteorder)
+                    pos += size
+
+                if kind == _BLOCK:
+                    out += data[start:pos + length]
+                else:
+                    out += data[start:pos]
+
+                pos += length
+            else:
+                # _ADDRX: the addresses are in .debug_addr, which can't be
+                # compared cheaply.
+                raise _CannotReuse()
+
+    return hashlib.blake2b(out, digest_size = 16).digest(), base
+
+# Fill fingerprints with the (CU offset, size, digest, base address) of the
+# CUs of dwarf_info. Two CUs with the same digest have the same elements, but
+# for their DIE offsets and the addresses of their lexical blocks, which are
+# shifted by the difference of their offsets and base addresses. The digest
+# is None for CUs that can't be compared.
+#
+# Like DwarfModelBuilder.build_step, yields the number of bytes of
+# .debug_info consumed after each CU, so that the caller can stop.
+def cu_fingerprints_step(dwarf_info, fingerprints):
+    stream = dwarf_info.debug_info_sec.stream
+    strings = section_bytes(dwarf_info.debug_str_sec)
+    line_strings = section_bytes(getattr(dwarf_info, 'debug_line_str_sec', None))
+    str_offsets = section_bytes(getattr(dwarf_info, 'debug_str_offsets_sec', None))
+    cus = CuIndex(dwarf_info)
+
+    for n in range(len(cus)):
+        cu = cus.get_cu(n)
+        size = cus.size(n)
+        stream.seek(cu.cu_offset)
+        data = stream.read(size)
+
+        try:
+            digest, base = _cu_digest(cu, data, strings, line_strings, str_offsets)
+        except (_CannotReuse, KeyError, ValueError, IndexError):
+            digest, base = None, None
+
+        fingerprints.append((cu.cu_offset, size, digest, base))
+        yield cus.ends[n]
+
+def cu_fingerprints(dwarf_info):
+    fingerprints = []
+
+    for bytes_done in cu_fingerprints_step(dwarf_info, fingerprints):
+        pass
+
+    return fingerprints
+
+# Returns, for each CU of new_fingerprints, the index of the identical CU in
+# old_fingerprints, or None if it has to be built. Identical CUs are matched
+# in order, so that copies of a CU keep their relative order.
+def plan_reload(old_fingerprints, new_fingerprints):
+    # (size, digest) -> indexes of the old CUs not matched yet, in order
+    old_cus = dict()
+
+    for i, (cu_offset, size, digest, base) in enumerate(old_fingerprints):
+        if digest is not None:
+            old_cus.setdefault((size, digest), []).append(i)
+
+    plan = []
+
+    for cu_offset, size, digest, base in new_fingerprints:
+        candidates = old_cus.get((size, digest)) if digest is not None else None
+
+        if candidates:
+            plan.append(candidates.pop(0))
+        else:
+            plan.append(None)
+
+    return plan
+
+# Returns a copy of elem and its descendants, with offset_delta added to
+# their DIE offsets and address_delta to the addresses of their lexical
+# blocks. The elements of the previous model may still be shown while the
+# file is reloaded, so they are not changed.
+def shift_cu_element(elem, offset_delta, address_delta):
+    root_elem = Element(elem.name, elem.offset + offset_delta, elem.type_string)
+    # (element, its copy)
+    stack = [(elem, root_elem)]
+
+    while stack:
+        elem, copy = stack.pop()
+
+        for group, children in elem.children_groups.items():
+            copies = []
+
+            for child in children:
+                name = child.name
+
+                if group == ChildrenGroup.LexicalBlock and address_delta != 0:
+                    low_pc, high_pc = name.split('-')
+                    name = '0x{:x}-0x{:x}'.format(int(low_pc, 16) + address_delta,
+                                                  int(high_pc, 16) + address_delta)
+
+                child_copy = Element(name, child.offset + offset_delta, child.type_string)
+                copies.append(child_copy)
+                stack.append((child, child_copy))
+
+            copy.add_children(group, copies)
+
+    return root_elem
+
+# Build the model of the file of builder, reusing the CU elements of
+# old_file_elem whose CU is unchanged according to plan (see plan_reload).
+# Like DwarfModelBuilder.build_step, yields the number of bytes of .debug_info
+# consumed, then the file element.
+#
+# The elements of the CUs reused where they were are shared with
+# old_file_elem, those of the CUs that moved are copied: old_file_elem is
+# left as it was.
+def reload_step(builder, old_file_elem, old_fingerprints, new_fingerprints, plan):
+    old_cu_elems = old_file_elem.children_groups.get(None, [])
+    file_elem = Element("File", None)
+    yield 0
+
+    for (cu_offset, size, digest, base), old_index in zip(new_fingerprints, plan):
+        if old_index is None:
+            cu = builder.dwarf_info.get_CU_at(cu_offset)
+            cu_elem = builder.build_cu(cu)
+        else:
+            old_cu_offset, old_size, old_digest, old_base = old_fingerprints[old_index]
+            cu_elem = old_cu_elems[old_index]
+
+            offset_delta = cu_offset - old_cu_offset
+            address_delta = base - old_base if base is not None else 0
+
+            if offset_delta != 0 or address_delta != 0:
+                cu_elem = shift_cu_element(cu_elem, offset_delta, address_delta)
+
+        file_elem.add_child(None, cu_elem)
+        yield cu_offset + size
+
+    yield file_elem
+
+def reload(builder, old_file_elem, old_fingerprints, new_fingerprints, plan):
+    for file_elem in reload_step(builder, old_file_elem, old_fingerprints, new_fingerprints, plan):
+        pass
+
+    return file_elem
@@ -0,0 +1,535 @@
+from array import array
+from collections import namedtuple
+from elftools.dwarf.enums import ENUM_DW_FORM, ENUM_DW_TAG
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# How DieTable reads the value of each form, as (kind, size).
+_FIXED = 0          # an unsigned integer of size bytes
+_ULEB = 1           # an unsigned LEB128
+_SLEB = 2           # a signed LEB128
+_STRING = 3         # an inline string
+_STRP = 4           # an offset of size bytes in .debug_str
+_LINE_STRP = 5      # same, in .debug_line_str
+_BLOCK = 6          # a block whose length takes size bytes (0: LEB128)
+_IMPLICIT = 7       # the value is in the abbreviation
+_INDIRECT = 8       # the form is in the DIE
+
+def _form_kinds(version, offset_size, address_size):
+    return {
+        'DW_FORM_addr': (_FIXED, address_size),
+        'DW_FORM_data1': (_FIXED, 1),
+        'DW_FORM_ref1': (_FIXED, 1),
+        'DW_FORM_flag': (_FIXED, 1),
+        'DW_FORM_strx1': (_FIXED, 1),
+        'DW_FORM_addrx1': (_FIXED, 1),
+        'DW_FORM_data2': (_FIXED, 2),
+        'DW_FORM_ref2': (_FIXED, 2),
+        'DW_FORM_strx2': (_FIXED, 2),
+        'DW_FORM_addrx2': (_FIXED, 2),
+        'DW_FORM_strx3': (_FIXED, 3),
+        'DW_FORM_addrx3': (_FIXED, 3),
+        'DW_FORM_data4': (_FIXED, 4),
+        'DW_FORM_ref4': (_FIXED, 4),
+        'DW_FORM_strx4': (_FIXED, 4),
+        'DW_FORM_addrx4': (_FIXED, 4),
+        'DW_FORM_ref_sup4': (_FIXED, 4),
+        'DW_FORM_data8': (_FIXED, 8),
+        'DW_FORM_ref8': (_FIXED, 8),
+        'DW_FORM_ref_sig8': (_FIXED, 8),
+        'DW_FORM_ref_sup8': (_FIXED, 8),
+        'DW_FORM_data16': (_FIXED, 16),
+        'DW_FORM_flag_present': (_FIXED, 0),
+        'DW_FORM_implicit_const': (_IMPLICIT, 0),
+        'DW_FORM_udata': (_ULEB, 0),
+        'DW_FORM_sdata': (_SLEB, 0),
+        'DW_FORM_ref_udata': (_ULEB, 0),
+        'DW_FORM_strx': (_ULEB, 0),
+        'DW_FORM_addrx': (_ULEB, 0),
+        'DW_FORM_rnglistx': (_ULEB, 0),
+        'DW_FORM_loclistx': (_ULEB, 0),
+        'DW_FORM_GNU_addr_index': (_ULEB, 0),
+        'DW_FORM_GNU_str_index': (_ULEB, 0),
+        'DW_FORM_string': (_STRING, 0),
+        'DW_FORM_strp': (_STRP, offset_size),
+        'DW_FORM_line_strp': (_LINE_STRP, offset_size),
+        'DW_FORM_strp_sup': (_FIXED, offset_size),
+        'DW_FORM_GNU_strp_alt': (_FIXED, offset_size),
+        'DW_FORM_GNU_ref_alt': (_FIXED, offset_size),
+        'DW_FORM_sec_offset': (_FIXED, offset_size),
+        'DW_FORM_ref_addr': (_FIXED, offset_size if version >= 3 else address_size),
+        'DW_FORM_block1': (_BLOCK, 1),
+        'DW_FORM_block2': (_BLOCK, 2),
+        'DW_FORM_block4': (_BLOCK, 4),
+        'DW_FORM_block': (_BLOCK, 0),
+        'DW_FORM_exprloc': (_BLOCK, 0),
+        'DW_FORM_indirect': (_INDIRECT, 0),
+    }
+
+# The forms of the values of the decoded attributes, other forms make the CU
+# unsupported.
+_name_forms = frozenset(['DW_FORM_string', 'DW_FORM_strp', 'DW_FORM_line_strp'])
+_integer_kinds = frozenset([_FIXED, _ULEB, _SLEB, _IMPLICIT])
+_address_forms = frozenset(['DW_FORM_addrx', 'DW_FORM_addrx1', 'DW_FORM_addrx2', 'DW_FORM_addrx3',
+                            'DW_FORM_addrx4', 'DW_FORM_GNU_addr_index'])
+_signed_forms = frozenset(['DW_FORM_sdata', 'DW_FORM_implicit_const'])
+
+# Attributes giving the layout of a type or member, which the elements don't
+# show, see DieTable.layouts.
+LAYOUT_ATTRIBUTES = ('DW_AT_byte_size', 'DW_AT_bit_size', 'DW_AT_data_member_location',
+                     'DW_AT_data_bit_offset', 'DW_AT_bit_offset', 'DW_AT_alignment')
+
+_tag_codes = dict(ENUM_DW_TAG)
+
+class UnsupportedForm(Exception):
+    pass
+
+def read_uleb(data, pos):
+    value = 0
+    shift = 0
+
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+
+        if not byte & 0x80:
+            return value, pos
+
+def read_sleb(data, pos):
+    value = 0
+    shift = 0
+
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+
+        if not byte & 0x80:
+            if byte & 0x40:
+                value -= 1 << shift
+            return value, pos
+
+# Returns the content of section (an elftools DebugSectionDescriptor), or
+# empty bytes if the file doesn't have it.
+def section_bytes(section):
+    if section is None:
+        return b''
+
+    section.stream.seek(0)
+    return section.stream.read(section.size)
+
+def _read_string(strings, offset):
+    end = strings.index(b'\0', offset)
+    return strings[offset:end]
+
+TableAttribute = namedtuple('TableAttribute', 'form value')
+
+# The DIEs of a CU as columns, one row per DIE in the order of .debug_info
+# (so that the subtree of a DIE is the rows following it). The DIEs are read
+# straight from the bytes of the CU through its abbreviation table, which is
+# much faster than pyelftools and doesn't create an object per DIE.
+#
+# Only the attributes the model uses are decoded: name, type, low_pc,
+# high_pc, const_value and upper_bound, and the LAYOUT_ATTRIBUTES. Their
+# values are kept as pyelftools gives them (e.g. type is the raw reference,
+# relative to the CU for the ref1-8 forms), but for the blocks, kept as
+# bytes. Whether a DIE has one is given by its abbreviation.
+#
+# strings, line_strings: the content of .debug_str and .debug_line_str
+#
+# Raises UnsupportedForm if one of the decoded attributes has a form that
+# can't be decoded without other sections (e.g. strx, addrx) or that isn't
+# a plain value (e.g. an exprloc upper bound); the CU must then be read with
+# pyelftools.
+class DieTable:
+    # The decoded attributes, and the name of their column
+    columns = {
+        'DW_AT_name': 'names',
+        'DW_AT_type': 'type_refs',
+        'DW_AT_low_pc': 'low_pcs',
+        'DW_AT_high_pc': 'high_pcs',
+        'DW_AT_const_value': 'const_values',
+        'DW_AT_upper_bound': 'upper_bounds',
+    }
+    # Position of the layout attributes in the tuples of layout_values
+    layout_positions = {name: i for i, name in enumerate(LAYOUT_ATTRIBUTES)}
+
+    def __init__(self, cu, strings, line_strings):
+        self.cu = cu
+
+        # Absolute offset of each DIE
+        self.offsets = array('Q')
+        # Tag code (DW_TAG_*) and abbreviation code of each DIE
+        self.tags = array('I')
+        self.abbrevs = array('I')
+        # Row of the parent of each DIE, -1 for the top DIE
+        self.parents = array('q')
+        # Row following the subtree of each DIE
+        self.subtree_ends = array('q')
+        # Index of the name of each DIE in self.strings, -1 if none
+        self.names = array('i')
+        # The integer attributes, 0 where a DIE doesn't have them. Signed
+        # values are stored as their two's complement.
+        self.type_refs = array('Q')
+        self.low_pcs = array('Q')
+        self.high_pcs = array('Q')
+        self.const_values = array('Q')
+        self.upper_bounds = array('Q')
+        # Index of the values of the LAYOUT_ATTRIBUTES of each DIE in
+        # self.layout_values, -1 if it has none of them
+        self.layouts = array('i')
+        self.layout_values = []
+
+        # The names of the DIEs, each appearing once
+        self.strings = []
+        self.string_indexes = dict()
+
+        # Tag code -> tag, as pyelftools names it
+        self.tag_names = dict()
+        # Abbreviation code -> dict attribute -> form, of the decoded
+        # attributes of the abbreviation
+        self.abbrev_forms = dict()
+
+        # Lazily created numpy views of the columns, see column()
+        self.arrays = dict()
+
+        self._decode(strings, line_strings)
+
+    def _abbrev_decoder(self, abbrev, forms):
+        tag = abbrev['tag']
+        code = _tag_codes.get(tag, tag) if isinstance(tag, str) else tag
+        self.tag_names[code] = tag
+
+        decoded_forms = dict()
+        # List of (kind, size, column or None, implicit value). The column
+        # of a layout attribute is its position in the layout tuple.
+        decoder = []
+        has_layout = False
+
+        for spec in abbrev['attr_spec']:
+            kind_size = forms.get(spec.form)
+            if kind_size is None:
+                raise UnsupportedForm(spec.form)
+
+            kind, size = kind_size
+            column_name = self.columns.get(spec.name)
+            column = self.layout_positions.get(spec.name)
+
+            if column is not None:
+                has_layout = True
+                decoded_forms[spec.name] = spec.form
+            elif column_name is not None:
+                if spec.name == 'DW_AT_name':
+                    if spec.form not in _name_forms:
+                        raise UnsupportedForm(spec.form)
+                elif kind not in _integer_kinds or spec.form in _address_forms:
+                    raise UnsupportedForm(spec.form)
+
+                column = getattr(self, column_name)
+                decoded_forms[spec.name] = spec.form
+
+            decoder.append((kind, size, column, spec.value))
+
+        return code, abbrev.has_children(), decoded_forms, decoder, has_layout
+
+    def _decode(self, strings, line_strings):
+        cu = self.cu
+        structs = cu.structs
+        byteorder = 'little' if structs.little_endian else 'big'
+        offset_size = 8 if structs.dwarf_format == 64 else 4
+        forms = _form_kinds(cu['version'], offset_size, structs.address_size)
+        indirect_forms = {value: name for name, value in ENUM_DW_FORM.items()}
+        abbrev_table = cu.get_abbrev_table()
+
+        stream = cu.dwarfinfo.debug_info_sec.stream
+        stream.seek(cu.cu_offset)
+        data = stream.read(cu.size)
+
+        # abbreviation code -> (tag code, has children, decoder)
+        decoders = dict()
+
+        offsets = self.offsets
+        tags = self.tags
+        abbrevs = self.abbrevs
+        parents = self.parents
+        subtree_ends = self.subtree_ends
+        names = self.names
+        layouts = self.layouts
+        layout_values = self.layout_values
+        integer_columns = [self.type_refs, self.low_pcs, self.high_pcs, self.const_values, self.upper_bounds]
+        string_indexes = self.string_indexes
+
+        # Rows of the DIEs whose children are being read
+        stack = []
+        pos = cu.cu_die_offset - cu.cu_offset
+        end = len(data)
+
+        while pos < end:
+            die_offset = pos
+            code, pos = read_uleb(data, pos)
+
+            if code == 0:
+                if stack:
+                    subtree_ends[stack.pop()] = len(offsets)
+                continue
+
+            decoder = decoders.get(code)
+            if decoder is None:
+                tag_code, has_children, decoded_forms, attrs, has_layout = self._abbrev_decoder(abbrev_table.get_abbrev(code), forms)
+                self.abbrev_forms[code] = decoded_forms
+                decoder = (tag_code, has_children, attrs, has_layout)
+                decoders[code] = decoder
+
+            tag_code, has_children, attrs, has_layout = decoder
+            row = len(offsets)
+
+            offsets.append(cu.cu_offset + die_offset)
+            tags.append(tag_code)
+            abbrevs.append(code)
+            parents.append(stack[-1] if stack else -1)
+            subtree_ends.append(row + 1)
+            names.append(-1)
+            for column in integer_columns:
+                column.append(0)
+
+            layout = [None] * len(LAYOUT_ATTRIBUTES) if has_layout else None
+
+            for kind, size, column, implicit_value in attrs:
+                if kind == _INDIRECT:
+                    form_code, pos = read_uleb(data, pos)
+                    kind_size = forms.get(indirect_forms.get(form_code))
+                    if kind_size is None or kind_size[0] == _INDIRECT:
+                        raise UnsupportedForm(form_code)
+
+                    kind, size = kind_size
+
+                if kind == _FIXED:
+                    value = int.from_bytes(data[pos:pos + size], byteorder)
+                    pos += size
+                elif kind == _ULEB:
+                    value, pos = read_uleb(data, pos)
+                elif kind == _SLEB:
+                    value, pos = read_sleb(data, pos)
+                elif kind == _IMPLICIT:
+                    value = implicit_value
+                elif kind == _STRING:
+                    string_end = data.index(b'\0', pos)
+                    value = data[pos:string_end]
+                    pos = string_end + 1
+                elif kind == _STRP or kind == _LINE_STRP:
+                    value = int.from_bytes(data[pos:pos + size], byteorder)
+                    pos += size
+
+                    if column is not None:
+                        value = _read_string(strings if kind == _STRP else line_strings, value)
+                else:
+                    if size == 0:
+                        length, pos = read_uleb(data, pos)
+                    else:
+                        length = int.from_bytes(data[pos:pos + size], byteorder)
+                        pos += size
+
+                    if column is None:
+                        pos += length
+                        continue
+
+                    value = data[pos:pos + length]
+                    pos += length
+
+                if column is None:
+                    continue
+
+                if column.__class__ is int:
+                    layout[column] = value
+                elif column is names:
+                    index = string_indexes.get(value)
+                    if index is None:
+                        index = len(self.strings)
+                        self.strings.append(value)
+                        string_indexes[value] = index
+
+                    names[row] = index
+                else:
+                    column[row] = value & 0xffffffffffffffff
+
+            if layout is None:
+                layouts.append(-1)
+            else:
+                layouts.append(len(layout_values))
+                layout_values.append(tuple(layout))
+
+            if has_children:
+                stack.append(row)
+
+        for row in stack:
+            subtree_ends[row] = len(offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def die(self, row):
+        return TableDie(self, row)
+
+    def top_die(self):
+        return TableDie(self, 0)
+
+    # Returns the column of the given name (e.g. 'tags') as a numpy array,
+    # sharing the memory of the column. Requires numpy.
+    def column(self, name):
+        ret = self.arrays.get(name)
+
+        if ret is None:
+            ret = numpy.frombuffer(getattr(self, name), dtype = getattr(self, name).typecode)
+            self.arrays[name] = ret
+
+        return ret
+
+    # Returns the rows of the DIEs with one of the given tags, in order. Uses
+    # numpy if it is installed.
+    def rows_with_tags(self, tags):
+        codes = [_tag_codes[tag] for tag in tags if tag in _tag_codes]
+
+        if numpy is not None:
+            return numpy.flatnonzero(numpy.isin(self.column('tags'), codes)).tolist()
+
+        codes = frozenset(codes)
+        return [row for row, code in enumerate(self.tags) if code in codes]
+
+    def rows_with_tag(self, tag):
+        return self.rows_with_tags([tag])
+
+    # Returns the rows of the DIEs having the decoded attribute name, in
+    # order.
+    def rows_with_attribute(self, name):
+        codes = [code for code, forms in self.abbrev_forms.items() if name in forms]
+
+        if numpy is not None:
+            return numpy.flatnonzero(numpy.isin(self.column('abbrevs'), codes)).tolist()
+
+        codes = frozenset(codes)
+        return [row for row, code in enumerate(self.abbrevs) if code in codes]
+
+    # Returns the rows of the DIEs named name (bytes), in order.
+    def rows_named(self, name):
+        index = self.string_indexes.get(name)
+        if index is None:
+            return []
+
+        if numpy is not None:
+            return numpy.flatnonzero(self.column('names') == index).tolist()
+
+        return [row for row, name_index in enumerate(self.names) if name_index == index]
+
+    # Returns the values of the LAYOUT_ATTRIBUTES of the DIE at row, None for
+    # those it doesn't have, or None if it has none of them.
+    def layout(self, row):
+        index = self.layouts[row]
+        return self.layout_values[index] if index >= 0 else None
+
+    # Returns the rows of the children of the DIE at row.
+    def children_rows(self, row):
+        ret = []
+        end = self.subtree_ends[row]
+        row += 1
+
+        while row < end:
+            ret.append(row)
+            row = self.subtree_ends[row]
+
+        return ret
+
+# A DIE of a DieTable, with the parts of the interface of pyelftools DIEs
+# the model builder uses, so that its visitors can walk either.
+class TableDie:
+    __slots__ = ('table', 'row', 'offset')
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+        self.offset = table.offsets[row]
+
+    @property
+    def tag(self):
+        table = self.table
+        return table.tag_names[table.tags[self.row]]
+
+    @property
+    def cu(self):
+        return self.table.cu
+
+    @property
+    def has_children(self):
+        return self.table.subtree_ends[self.row] > self.row + 1
+
+    @property
+    def attributes(self):
+        return TableAttributes(self.table, self.row)
+
+    def iter_children(self):
+        table = self.table
+        subtree_ends = table.subtree_ends
+        end = subtree_ends[self.row]
+        row = self.row + 1
+
+        while row < end:
+            yield TableDie(table, row)
+            row = subtree_ends[row]
+
+    def get_parent(self):
+        parent = self.table.parents[self.row]
+
+        if parent < 0:
+            return None
+
+        return TableDie(self.table, parent)
+
+# The decoded attributes of a TableDie, as a read-only mapping attribute ->
+# TableAttribute.
+class TableAttributes:
+    __slots__ = ('table', 'row')
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    def _forms(self):
+        return self.table.abbrev_forms[self.table.abbrevs[self.row]]
+
+    def __contains__(self, name):
+        return name in self._forms()
+
+    def __getitem__(self, name):
+        table = self.table
+        form = self._forms()[name]
+        position = table.layout_positions.get(name)
+
+        if position is not None:
+            value = table.layout_values[table.layouts[self.row]][position]
+            return TableAttribute(form, value)
+
+        value = getattr(table, table.columns[name])[self.row]
+
+        if name == 'DW_AT_name':
+            value = table.strings[value]
+        elif form in _signed_forms and value >= 1 << 63:
+            value -= 1 << 64
+
+        return TableAttribute(form, value)
+
+    def get(self, name, default = None):
+        if name not in self:
+            return default
+
+        return self[name]
+
+    def __iter__(self):
+        return iter(self._forms())
+
+    def __len__(self):
+        return len(self._forms())
@@ -1,65 +1,468 @@
 #!/usr/bin/python
 from gi.repository import Gtk
 from gi.repository import GLib
-from gi.repository import Gio
-import dwarfmodeltest
-from elftools.elf.elffile import ELFFile
-from dwarfmodel import DwarfModelBuilder, ChildrenGroup
+from elftools.common.exceptions import ELFError
+from dwarfmodel import DwarfModelBuilder, ChildrenGroup, SharedElement, TypeDeduplicator, Element, LazyCuElement, BuildCancelled
+import dwarfparallel
+import dwarfcache
+from dwarfindex import NameIndex
+from dwarfaddr import AddressIndex
+import dwarfnames
+import dwarfreload
+import dwarfrefs
+import dwarfdiff
+from dwarfinput import ElfInput
+from dwarfprofile import Profiler
 
 import threading
 import argparse
+import time
 import signal
 import sys
 import os
 
 class DwarfLoaderThread(threading.Thread):
-    def __init__(self, window, f, verbose):
+    # Minimum time between two progress updates posted to the UI, in seconds.
+    progress_interval = 0.05
+
+    # elf_input: the ElfInput the thread reads the file from, closed by the
+    #            thread once done. The window reads the file it shows from
+    #            an input of its own.
+    # profiler: a Profiler recording the phases of the load, or None
+    # fingerprints: compute the CU fingerprints of the model once it is shown,
+    #               so that the next reload can reuse its CUs
+    # previous: to reload a file that changed, the (file element, CU
+    #           fingerprints) of its previous model, whose elements are reused
+    #           for the CUs that didn't change (see dwarfreload).
+    def __init__(self, window, filename, elf_input, verbose, lazy, jobs, cache, symbol, dedup, profiler, fingerprints = False, previous = None):
         super(DwarfLoaderThread, self).__init__()
-        self.f = f
+        self.filename = filename
+        self.elf_input = elf_input
         self.window = window
         self.stop_requested = False
         self.verbose = verbose
-
+        self.lazy = lazy
+        self.jobs = jobs
+        self.cache = cache
+        self.symbol = symbol
+        self.dedup = dedup
+        self.profiler = profiler
+        self.fingerprints = fingerprints
+        self.previous = previous
+        self.builder = None
+        self.progress_pending = False
+        self.progress_time = 0
+
+    # Called from the UI thread. The builder stops at the next DIE it
+    # visits.
     def request_stop(self):
         self.stop_requested = True
 
+        builder = self.builder
+        if builder is not None:
+            builder.cancel()
+
+    def is_stop_requested(self):
+        return self.stop_requested
+
     def run(self):
-        elf = ELFFile(self.f)
+        try:
+            self.load()
+        except BuildCancelled:
+            pass
+        finally:
+            self.elf_input.close()
+
+    def load(self):
+        elf = self.elf_input.elf
 
         if not elf.has_dwarf_info():
-            GLib.idle_add(self.window.display_error, "This file has no DWARF info.")
+            self.post(self.window.display_error, "This file has no DWARF info.")
             return
 
         di = elf.get_dwarf_info()
 
-        builder = DwarfModelBuilder(di, self.verbose)
-        total = builder.num_cus()
-        n = 0
+        cache_key = None
+        # Showing a symbol only needs the CUs it is in.
+        lazy = self.lazy or self.symbol is not None
+
+        # The cache keeps neither the layouts the types are shared by, nor
+        # the shared types, whose children are those of their first CU.
+        if self.cache and not lazy and not self.dedup:
+            if self.profiler is not None:
+                self.profiler.begin("cache")
+            cache_key = dwarfcache.model_key(elf, self.elf_input.file)
+            # A reload patches the current model, so that the UI keeps its
+            # state, rather than replacing it.
+            file_elem = self.cache.load(cache_key) if self.previous is None else None
+            if self.profiler is not None:
+                self.profiler.end()
+
+            if file_elem is not None:
+                self.finish(file_elem)
+
+                self.post_fingerprints(di, file_elem)
+                return
 
-        generator = builder.build_step()
-        file_elem = next(generator)
-        while not file_elem:
-            if self.stop_requested:
+        # A serial build of the whole file fills the type references in its
+        # types pass, sparing a scan of the file when they are first needed.
+        references = None
+        if not lazy and self.previous is None and self.jobs <= 1:
+            references = dwarfrefs.TypeReferences()
+
+        builder = DwarfModelBuilder(di, self.verbose, single_pass = True, dedup = self.dedup, profiler = self.profiler,
+                                    references = references)
+        self.builder = builder
+
+        # request_stop may have been called before self.builder was set.
+        if self.stop_requested:
+            return
+
+        if lazy:
+            file_elem = builder.build_lazy()
+
+            reveal_path = None
+            if self.symbol is not None:
+                reveal_path = self.locate_symbol(elf, di, file_elem)
+
+            self.finish(file_elem, reveal_path)
+            return
+
+        # The steps report how much of .debug_info they consumed, which
+        # does not need a pass over the CU headers first.
+        total = max(1, builder.debug_info_size())
+        plan = None
+        parallel = self.previous is None and self.jobs > 1
+
+        if self.previous is not None:
+            old_file_elem, old_fingerprints = self.previous
+
+            if self.profiler is not None:
+                self.profiler.begin("fingerprints")
+            fingerprints = self.cu_fingerprints(di)
+            if self.profiler is not None:
+                self.profiler.end()
+
+            if fingerprints is None:
                 return
 
-            GLib.idle_add(self.window.load_progress, float(n) / total)
-            n = n + 1
-            file_elem = next(generator)
+            plan = dwarfreload.plan_reload(old_fingerprints, fingerprints)
+            generator = dwarfreload.reload_step(builder, old_file_elem, old_fingerprints, fingerprints, plan)
+        elif parallel:
+            layouts = dict() if self.dedup else None
+            generator = dwarfparallel.build_parallel_step(self.filename, self.jobs, self.is_stop_requested, layouts)
+            # The workers are not profiled, only the time spent waiting for
+            # them is.
+            if self.profiler is not None:
+                self.profiler.begin("parallel build")
+        else:
+            generator = builder.build_step()
+
+        try:
+            result = next(generator)
+            while not isinstance(result, Element):
+                self.post_progress(float(result) / total)
+                result = next(generator)
+        finally:
+            generator.close()
+
+        if parallel and self.profiler is not None:
+            self.profiler.end()
 
+        file_elem = result
 
         #root_elem = builder.build()
 
         if self.stop_requested:
             return
 
-        GLib.idle_add(self.window.done_loading, file_elem)
+        if self.dedup and parallel:
+            TypeDeduplicator().dedup_file(file_elem, layouts)
+
+        if self.verbose and not parallel:
+            hits, misses = builder.type_names_stats()
+            print("Type names cache: %d hits, %d misses" % (hits, misses))
+
+        if cache_key is not None:
+            try:
+                if self.profiler is not None:
+                    with self.profiler.phase("cache"):
+                        self.cache.store(cache_key, file_elem)
+                else:
+                    self.cache.store(cache_key, file_elem)
+            except OSError as e:
+                print("Could not store the model in the cache: %s" % e)
+
+        if plan is not None:
+            self.finish_reload(file_elem, plan, fingerprints)
+            return
+
+        self.finish(file_elem, references = references)
+        self.post_fingerprints(di, file_elem)
+
+    # Post a progress update to the UI, unless one was posted less than
+    # progress_interval ago or the previous one was not handled yet.
+    def post_progress(self, fraction):
+        now = time.monotonic()
+
+        if self.progress_pending or now - self.progress_time < self.progress_interval:
+            return
+
+        self.progress_pending = True
+        self.progress_time = now
+        GLib.idle_add(self.deliver_progress, fraction)
+
+    # Called in the UI thread.
+    def deliver_progress(self, fraction):
+        self.progress_pending = False
+
+        if not self.stop_requested:
+            self.window.load_progress(fraction)
+
+        return False
+
+    # Call callback with args in the UI thread, unless the thread is stopped
+    # before: the window has moved on to another file then.
+    def post(self, callback, *args):
+        GLib.idle_add(self.deliver, callback, args)
+
+    # Called in the UI thread.
+    def deliver(self, callback, args):
+        if not self.stop_requested:
+            callback(*args)
+
+        return False
+
+    # Load the CU of self.symbol in the lazily built file_elem, and return the
+    # path to its element.
+    def locate_symbol(self, elf, di, file_elem):
+        index = dwarfnames.open_name_index(elf, di)
+        found = dwarfnames.locate_symbol(di, index, self.symbol)
+
+        if not found:
+            self.post(self.window.display_status, "%s not found" % self.symbol)
+            return None
+
+        cu_offset, die_offset = found[0]
+
+        for position, cu_elem in enumerate(file_elem.children_groups[None]):
+            if cu_elem.cu_offset == cu_offset:
+                path = dwarfnames.element_path(cu_elem, die_offset)
+                if path is None:
+                    return [(None, position)]
+
+                return [(None, position)] + path
+
+        return None
+
+    # references: the dwarfrefs.TypeReferences of the file, if they were
+    #             built with the model
+    def finish(self, file_elem, reveal_path = None, references = None):
+        if self.stop_requested:
+            return
+
+        if self.profiler is not None:
+            with self.profiler.phase("name index"):
+                index = NameIndex(file_elem)
+        else:
+            index = NameIndex(file_elem)
+
+        if self.stop_requested:
+            return
+
+        self.post(self.window.done_loading, file_elem, index, reveal_path, references)
+
+    def finish_reload(self, file_elem, plan, fingerprints):
+        if self.stop_requested:
+            return
+
+        index = NameIndex(file_elem)
+
+        if self.stop_requested:
+            return
+
+        self.post(self.window.done_reloading, file_elem, index, plan, fingerprints)
+
+    # Returns the fingerprints of the CUs of di, or None if the thread is
+    # stopped meanwhile.
+    def cu_fingerprints(self, di):
+        fingerprints = []
+
+        for bytes_done in dwarfreload.cu_fingerprints_step(di, fingerprints):
+            if self.stop_requested:
+                return None
+
+        return fingerprints
+
+    # Compute the fingerprints of the CUs of the model once it is shown, if
+    # asked to: a reload of the file needs them. The CUs of a model whose
+    # types are shared between CUs can't be reused.
+    def post_fingerprints(self, di, file_elem):
+        if not self.fingerprints or self.dedup or self.stop_requested:
+            return
+
+        fingerprints = self.cu_fingerprints(di)
+
+        if fingerprints is not None:
+            self.post(self.window.set_cu_fingerprints, file_elem, fingerprints)
+
 
+class DwarfDiffThread(threading.Thread):
+    # Number of diff entries posted to the window at a time
+    batch_size = 200
+
+    def __init__(self, window, diff):
+        super(DwarfDiffThread, self).__init__()
+        self.window = window
+        self.diff = diff
+
+    def request_stop(self):
+        self.diff.request_stop()
+
+    def run(self):
+        batch = []
+
+        try:
+            for entry in self.diff.entries():
+                batch.append(entry)
+
+                if len(batch) == self.batch_size:
+                    GLib.idle_add(self.window.add_entries, batch)
+                    batch = []
+        except (OSError, ELFError) as e:
+            GLib.idle_add(self.window.display_status, "Could not compare the files: %s" % e)
+            return
+
+        GLib.idle_add(self.window.add_entries, batch)
+        GLib.idle_add(self.window.done_comparing)
+
+class DwarfDiffWindow(Gtk.Window):
+    # Background of the rows of each kind of DiffEntry
+    colors = ["#d4f7d4", "#f7d4d4", "#f7f0c8"]
+
+    # Shows the differences between the models of the file of ui (the old
+    # one) and new_filename, side by side, one row per DiffEntry under the
+    # row of its CU. Activating a row selects its element in ui.
+    def __init__(self, ui, new_filename):
+        super(DwarfDiffWindow, self).__init__(title = "%s - %s" % (os.path.basename(ui.filename), os.path.basename(new_filename)))
+        self.ui = ui
+        self.set_default_size(800, 480)
+        self.set_transient_for(ui)
+
+        box = Gtk.Box(orientation = Gtk.Orientation.VERTICAL)
+        self.add(box)
+
+        # Element, old, new, background, DiffEntry
+        self.store = Gtk.TreeStore(str, str, str, str, object)
+        # CU name -> iter of its row
+        self.cu_iters = dict()
+
+        tree = Gtk.TreeView(model = self.store)
+        for i, title in enumerate(["Element", ui.filename, new_filename]):
+            column = Gtk.TreeViewColumn(title, Gtk.CellRendererText(), text = i, cell_background = 3)
+            column.set_resizable(True)
+            tree.append_column(column)
+        tree.connect("row-activated", self.on_row_activated)
+
+        scrolled_win = Gtk.ScrolledWindow()
+        scrolled_win.add(tree)
+        box.pack_start(scrolled_win, True, True, 0)
+
+        self.statusbar = Gtk.Statusbar()
+        self.statusbar_context_id = self.statusbar.get_context_id("diff")
+        box.pack_end(self.statusbar, False, False, 0)
+
+        self.diff = dwarfdiff.FileDiff(ui.filename, new_filename)
+        self.thread = DwarfDiffThread(self, self.diff)
+        self.closed = False
+        self.connect("destroy", self.on_destroy)
+
+        self.display_status("Comparing...")
+        self.thread.start()
+
+    def on_destroy(self, widget):
+        self.closed = True
+        self.thread.request_stop()
+
+    # The thread may post entries after the window is closed.
+    def display_status(self, text):
+        if not self.closed:
+            self.statusbar.push(self.statusbar_context_id, text)
+
+        return False
+
+    def format_side(self, elem):
+        if elem is None:
+            return ""
+
+        if elem.type_string:
+            return "0x%x  %s" % (elem.offset, elem.type_string)
+
+        return "0x%x" % elem.offset
+
+    def add_entries(self, entries):
+        if self.closed:
+            return False
+
+        for entry in entries:
+            color = self.colors[entry.kind]
+            old = self.format_side(entry.old)
+            new = self.format_side(entry.new)
+            group, cu_name = entry.path[0]
+
+            if len(entry.path) == 1:
+                self.cu_iters[cu_name] = self.store.append(None, [cu_name or "", old, new, color, entry])
+                continue
+
+            cu_iter = self.cu_iters.get(cu_name)
+            if cu_iter is None:
+                cu_iter = self.store.append(None, [cu_name or "", "", "", None, None])
+                self.cu_iters[cu_name] = cu_iter
+
+            self.store.append(cu_iter, [dwarfdiff.format_path(entry.path[1:]), old, new, color, entry])
+
+        return False
+
+    def done_comparing(self):
+        if self.closed:
+            return False
+
+        diff = self.diff
+        self.display_status("%d CUs unchanged, %d compared, %d removed, %d added" %
+                            (diff.cus_skipped, diff.cus_compared, diff.cus_removed, diff.cus_added))
+
+        return False
+
+    def on_row_activated(self, view, path, column):
+        entry = self.store[path][4]
+
+        if entry is None or entry.old is None or self.ui.name_index is None:
+            return
+
+        index_entry = self.ui.name_index.entry_at_offset(entry.old.offset)
+        if index_entry is not None:
+            self.ui.reveal_element(self.ui.name_index.path(index_entry))
 
 class DwarfUi(Gtk.Window):
-    def __init__(self, file_to_open = None, verbose = False):
+    # profile: record the time spent in each phase of loading and showing a
+    #          file, see View > Statistics. None to not profile, "time" or
+    #          "allocations" to also record the memory allocated.
+    # watch: reload the file when it changes on disk
+    def __init__(self, file_to_open = None, verbose = False, lazy = False, jobs = 1, cache = None, symbol = None, dedup = False, profile = None, watch = False):
         super(DwarfUi, self).__init__(title = "DWARF Tree")
 
         self.verbose = verbose
+        self.lazy = lazy
+        self.jobs = jobs
+        self.cache = cache
+        self.dedup = dedup
+        self.profile = profile
+        # Whether to compute the CU fingerprints of the models, so that a
+        # reload only builds the CUs that changed: when watching the file,
+        # or once it was reloaded.
+        self.fingerprint_cus = watch
+        # Profiler of the current file
+        self.profiler = None
 
         self.connect("delete-event", Gtk.main_quit)
 
@@ -80,7 +483,43 @@ class DwarfUi(Gtk.Window):
         tree_scrolled_win = Gtk.ScrolledWindow()
         tree_scrolled_win.add(self.tree)
 
-        box.pack_start(tree_scrolled_win, True, True, 0)
+        # Find stuff
+        self.search_box = self.build_search_box()
+        box.pack_start(self.search_box, False, False, 0)
+
+        paned = Gtk.Paned(orientation = Gtk.Orientation.HORIZONTAL)
+        paned.pack1(tree_scrolled_win, True, False)
+        paned.pack2(self.search_results_win, False, True)
+        box.pack_start(paned, True, True, 0)
+
+        self.name_index = None
+        self.search_source = None
+
+        self.filename = None
+        # The ElfInput of the file shown, read by the address index, the type
+        # references and the CUs of a lazily built model, and that of the file
+        # being loaded, which replaces it once the model is shown. The loader
+        # thread reads the file from an input of its own.
+        self.elf_input = None
+        self.loading_elf_input = None
+        self.address_index = None
+
+        # The dwarfrefs.TypeReferences of the file, built when first needed
+        # if they were not built with the model, and the GLib source building
+        # them.
+        self.type_references = None
+        self.references_source = None
+        self.tree_menu = None
+
+        # The file element of the model shown, and the fingerprints of its
+        # CUs once computed (see dwarfreload), to reload the file.
+        self.root_elem = None
+        self.cu_fingerprints = None
+
+        # (inode, size, modification time) of the file when it was loaded,
+        # and of its last change seen by the watch, see on_watch_timeout.
+        self.file_stat = None
+        self.pending_file_stat = None
 
         # Status bar stuff
         statusbarbox = Gtk.Box(orientation = Gtk.Orientation.HORIZONTAL)
@@ -97,8 +536,11 @@ class DwarfUi(Gtk.Window):
 
         self.loader_thread = None
 
+        if watch:
+            GLib.timeout_add(self.watch_interval, self.on_watch_timeout)
+
         if file_to_open:
-            self.open_file(file_to_open)
+            self.open_file(file_to_open, symbol)
 
     def build_menus(self, menus_xml_file):
         uimanager = self.create_ui_manager(menus_xml_file)
@@ -113,6 +555,14 @@ class DwarfUi(Gtk.Window):
         action_group.add_action_with_accel(action_fileopen, None)
         action_fileopen.connect("activate", self.on_menu_file_open)
 
+        action_filereload = Gtk.Action(name = "FileReload", label = "Reload", tooltip = "Reload the changed CUs of the file", stock_id = Gtk.STOCK_REFRESH)
+        action_group.add_action_with_accel(action_filereload, "<control>r")
+        action_filereload.connect("activate", self.on_menu_file_reload)
+
+        action_filecompare = Gtk.Action(name = "FileCompare", label = "Compare with...", tooltip = "Show the differences with another build of the file", stock_id = None)
+        action_group.add_action_with_accel(action_filecompare, None)
+        action_filecompare.connect("activate", self.on_menu_file_compare)
+
         action_filequit = Gtk.Action(name = "FileQuit", label = "Quit", tooltip = None, stock_id = Gtk.STOCK_QUIT)
         action_group.add_action_with_accel(action_filequit, None)
         action_filequit.connect("activate", self.on_menu_file_quit)
@@ -122,9 +572,21 @@ class DwarfUi(Gtk.Window):
         action_group.add_action(action_editmenu)
 
         action_editfind = Gtk.Action(name = "EditFind", label = "Find", tooltip = None, stock_id = Gtk.STOCK_FIND)
-        action_group.add_action(action_editfind)
+        action_group.add_action_with_accel(action_editfind, "<control>f")
         action_editfind.connect("activate", self.on_menu_edit_find)
 
+        action_editgotoaddress = Gtk.Action(name = "EditGoToAddress", label = "Go to address", tooltip = None, stock_id = Gtk.STOCK_JUMP_TO)
+        action_group.add_action_with_accel(action_editgotoaddress, "<control>g")
+        action_editgotoaddress.connect("activate", self.on_menu_edit_go_to_address)
+
+        # View menu
+        action_viewmenu = Gtk.Action(name = "ViewMenu", label = "View", tooltip = None, stock_id = None)
+        action_group.add_action(action_viewmenu)
+
+        action_viewstatistics = Gtk.Action(name = "ViewStatistics", label = "Statistics", tooltip = None, stock_id = Gtk.STOCK_INFO)
+        action_group.add_action_with_accel(action_viewstatistics, None)
+        action_viewstatistics.connect("activate", self.on_menu_view_statistics)
+
         uimanager.insert_action_group(action_group)
 
         menubar = uimanager.get_widget("/MenuBar")
@@ -142,6 +604,33 @@ class DwarfUi(Gtk.Window):
         return uimanager
 
 
+    def build_search_box(self):
+        search_box = Gtk.Box(orientation = Gtk.Orientation.HORIZONTAL)
+        search_box.set_no_show_all(True)
+
+        self.search_entry = Gtk.SearchEntry()
+        self.search_entry.connect("search-changed", self.on_search_changed)
+        self.search_entry.connect("stop-search", self.on_search_stop)
+        search_box.pack_start(self.search_entry, True, True, 0)
+
+        self.search_prefix_button = Gtk.CheckButton(label = "Prefix")
+        self.search_prefix_button.connect("toggled", self.on_search_changed)
+        search_box.pack_start(self.search_prefix_button, False, False, 0)
+
+        # Element, Type, index entry
+        self.search_results = Gtk.ListStore(str, str, int)
+        results_view = Gtk.TreeView(model = self.search_results)
+        results_view.append_column(Gtk.TreeViewColumn("Element", Gtk.CellRendererText(), text = 0))
+        results_view.append_column(Gtk.TreeViewColumn("Type", Gtk.CellRendererText(), text = 1))
+        results_view.connect("row-activated", self.on_search_result_activated)
+
+        self.search_results_win = Gtk.ScrolledWindow()
+        self.search_results_win.add(results_view)
+        self.search_results_win.set_no_show_all(True)
+        results_view.show()
+
+        return search_box
+
     def build_tree_view(self):
         tree = Gtk.TreeView()
 
@@ -149,57 +638,248 @@ class DwarfUi(Gtk.Window):
         tree.append_column(Gtk.TreeViewColumn("Offset",  Gtk.CellRendererText(), text = 1))
         tree.append_column(Gtk.TreeViewColumn("Type",  Gtk.CellRendererText(), text = 2))
 
+        tree.connect("test-expand-row", self.on_tree_test_expand_row)
+        tree.connect("button-press-event", self.on_tree_button_press)
+
         return tree
 
+    # The rows of the store are created lazily, when their parent is
+    # expanded. The last column holds what the row stands for: an Element, the
+    # list of children of a group, or None for the placeholder row that makes
+    # a row expandable before its children are created.
     def build_tree_store(self, root_element):
-        store = Gtk.TreeStore(str, str, str)
+        store = Gtk.TreeStore(str, str, str, object)
 
         if root_element is not None:
 
             # Create root element
-            root_iter = store.append(None, [root_element.name, "", ""])
-
-            self.build_tree_store_rec(store, root_iter, root_element)
+            root_iter = store.append(None, [root_element.name, "", "", root_element])
+            self.append_placeholder_row(store, root_iter, root_element)
 
         return store
 
-    def build_tree_store_rec(self, store, parent_iter, parent):
-        for group_id in parent.children_groups:
-            children_list = parent.children_groups[group_id]
+    def append_placeholder_row(self, store, parent_iter, elem):
+        if elem.has_children():
+            store.append(parent_iter, ["", "", "", None])
+
+    def append_element_rows(self, store, parent_iter, children_list, shared):
+        for child in children_list:
+            values = self.build_element_row_values(child, shared)
+            child_iter = store.append(parent_iter, values + [child])
+            self.append_placeholder_row(store, child_iter, child)
+
+    # shared: see row_shared_type
+    def fill_tree_store_row(self, store, parent_iter, node, shared = None):
+        if isinstance(node, list):
+            self.append_element_rows(store, parent_iter, node, shared)
+            return
+
+        for group_id in node.children_groups:
+            children_list = node.children_groups[group_id]
             if group_id is not None:
                 group_name = ChildrenGroup.name(group_id)
                 # Add a tree element for the group
-                add_to_iter = store.append(parent_iter, [group_name, "", ""])
+                group_iter = store.append(parent_iter, [group_name, "", "", children_list])
+                store.append(group_iter, ["", "", "", None])
             else:
-                add_to_iter = parent_iter
-
-            for child in children_list:
-                values = self.build_element_row_values(child)
-                child_iter = store.append(add_to_iter, values)
-
-                self.build_tree_store_rec(store, child_iter, child)
-
-    def build_element_row_values(self, elem):
+                self.append_element_rows(store, parent_iter, children_list, shared)
+
+    # Returns the SharedElement the row it is under (it included), or None.
+    # The elements under a type shared by several CUs are those of the first
+    # CU, their offsets in the others are given by it.
+    def row_shared_type(self, store, it):
+        while it is not None:
+            node = store.get_value(it, 3)
+            if isinstance(node, SharedElement):
+                return node
+
+            it = store.iter_parent(it)
+
+        return None
+
+    def on_tree_test_expand_row(self, tree, it, path):
+        store = tree.get_model()
+        placeholder_iter = store.iter_children(it)
+
+        if placeholder_iter is None or store.get_value(placeholder_iter, 3) is not None:
+            # Already filled
+            return False
+
+        shared = self.row_shared_type(store, it)
+
+        if self.profiler is not None:
+            with self.profiler.phase("tree store"):
+                self.fill_tree_store_row(store, it, store.get_value(it, 3), shared)
+                store.remove(placeholder_iter)
+            self.profiler.count("rows expanded")
+        else:
+            self.fill_tree_store_row(store, it, store.get_value(it, 3), shared)
+            store.remove(placeholder_iter)
+
+        return False
+
+    def on_tree_button_press(self, tree, event):
+        if event.button != 3:
+            return False
+
+        found = tree.get_path_at_pos(int(event.x), int(event.y))
+        if found is None:
+            return False
+
+        path = found[0]
+        tree.set_cursor(path, None, False)
+        store = tree.get_model()
+        it = store.get_iter(path)
+        node = store.get_value(it, 3)
+
+        if not isinstance(node, Element) or node.offset is None:
+            return True
+
+        shared = self.row_shared_type(store, store.iter_parent(it))
+        offset = shared.child_offset(node) if shared is not None else node.offset
+
+        # Kept, so that the menu isn't destroyed while shown
+        self.tree_menu = Gtk.Menu()
+        item = Gtk.MenuItem(label = "Find users of this type")
+        item.connect("activate", lambda item: self.find_type_users(node, offset))
+        self.tree_menu.append(item)
+        self.tree_menu.show_all()
+        self.tree_menu.popup_at_pointer(event)
+
+        return True
+
+    # shared: the SharedElement elem is under, see row_shared_type
+    def build_element_row_values(self, elem, shared = None):
         ret = []
 
-        ret.append(elem.name)
-        ret.append("0x%x" % (elem.die.offset))
+        if isinstance(elem, SharedElement) and elem.first.cu_count > 1:
+            ret.append("%s [%d CUs]" % (elem.name, elem.first.cu_count))
+        else:
+            ret.append(elem.name)
+        ret.append("0x%x" % (shared.child_offset(elem) if shared is not None else elem.offset))
         ret.append(elem.type_string if elem.type_string else "")
 
         return ret
 
-    def open_file(self, filename):
+    # Returns the ElfInput of filename, or None if it can't be opened.
+    def open_elf_input(self, filename):
         try:
-            f = open(filename, 'rb')
-            if self.loader_thread:
-                self.loader_thread.request_stop()
-
-            self.loader_thread = DwarfLoaderThread(self, f, self.verbose)
-            self.loader_thread.start()
-            self.display_status("Loading...")
-
+            return ElfInput(filename)
         except FileNotFoundError as e:
             self.display_status("File %s not found..." % (filename))
+        except ELFError as e:
+            self.display_status("File %s is not a valid ELF file: %s" % (filename, e))
+
+        return None
+
+    # Stop loading the previous file, and start loading filename. Returns
+    # False if it can't be opened. See DwarfLoaderThread for previous.
+    def start_loading(self, filename, symbol = None, previous = None):
+        elf_input = self.open_elf_input(filename)
+        if elf_input is None:
+            return False
+
+        loader_input = self.open_elf_input(filename)
+        if loader_input is None:
+            elf_input.close()
+            return False
+
+        if self.loader_thread:
+            self.loader_thread.request_stop()
+
+        if self.loading_elf_input is not None:
+            self.loading_elf_input.close()
+
+        self.loading_elf_input = elf_input
+        self.file_stat = file_stat(filename)
+        self.pending_file_stat = None
+        self.cu_fingerprints = None
+
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+
+        if self.profile is not None:
+            self.profiler = Profiler(allocations = self.profile == "allocations")
+
+        self.loader_thread = DwarfLoaderThread(self, filename, loader_input, self.verbose, self.lazy, self.jobs, self.cache, symbol, self.dedup, self.profiler,
+                                               self.fingerprint_cus, previous)
+        self.loader_thread.start()
+
+        self.filename = filename
+        self.stop_type_references()
+        self.type_references = None
+
+        return True
+
+    # Called when the model of the file being loaded is shown.
+    def switch_elf_input(self):
+        if self.elf_input is not None:
+            self.elf_input.close()
+
+        self.elf_input = self.loading_elf_input
+        self.loading_elf_input = None
+        self.address_index = None
+        # They were being built for the previous model.
+        self.stop_type_references()
+
+    # symbol: if not None, only build the CUs it is in and select it
+    def open_file(self, filename, symbol = None):
+        if not self.start_loading(filename, symbol):
+            return
+
+        self.display_status("Loading...")
+
+        # The results refer to the index of the previous file.
+        self.name_index = None
+        self.stop_search()
+        self.search_results.clear()
+
+    # Load the current file again, building only the CUs that changed and
+    # patching the tree in place, so that the rows expanded stay so.
+    def reload_file(self):
+        if self.filename is None:
+            return
+
+        # Only a fully built model whose CU fingerprints are known can be
+        # patched.
+        if self.cu_fingerprints is None or self.root_elem is None:
+            # The next reloads will reuse the CUs of this load.
+            self.fingerprint_cus = True
+            self.open_file(self.filename)
+            return
+
+        previous = (self.root_elem, self.cu_fingerprints)
+        if not self.start_loading(self.filename, previous = previous):
+            return
+
+        self.display_status("Reloading...")
+
+    def on_menu_file_reload(self, widget):
+        self.reload_file()
+
+    # Interval between two checks of the file, in milliseconds
+    watch_interval = 500
+
+    def on_watch_timeout(self):
+        if self.filename is None:
+            return True
+
+        stat = file_stat(self.filename)
+
+        if stat is None or stat == self.file_stat:
+            self.pending_file_stat = None
+            return True
+
+        # Wait for the file to stay the same for an interval, the linker may
+        # still be writing it.
+        if stat == self.pending_file_stat:
+            self.pending_file_stat = None
+            self.reload_file()
+        else:
+            self.pending_file_stat = stat
+
+        return True
 
     def on_menu_file_open(self, widget):
         dialog = Gtk.FileChooserDialog(
@@ -215,8 +895,256 @@ class DwarfUi(Gtk.Window):
 
         dialog.destroy()
 
+    def on_menu_file_compare(self, widget):
+        if self.filename is None:
+            return
+
+        dialog = Gtk.FileChooserDialog(
+            title = "Choose the ELF binary to compare with",
+            parent = self, action = Gtk.FileChooserAction.OPEN)
+        dialog.add_button(Gtk.STOCK_OK, Gtk.ResponseType.OK)
+        dialog.add_button(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL)
+
+        resp = dialog.run()
+        new_filename = dialog.get_filename()
+        dialog.destroy()
+
+        if resp == Gtk.ResponseType.OK:
+            DwarfDiffWindow(self, new_filename).show_all()
+
     def on_menu_edit_find(self, widget):
-        print("Pressed find")
+        self.search_box.show()
+        self.search_entry.show()
+        self.search_prefix_button.show()
+        self.search_results_win.show()
+        self.search_entry.grab_focus()
+
+    def on_search_stop(self, widget):
+        self.stop_search()
+        self.search_box.hide()
+        self.search_results_win.hide()
+
+    def stop_search(self):
+        if self.search_source is not None:
+            GLib.source_remove(self.search_source)
+            self.search_source = None
+
+    # Maximum number of results shown for a query.
+    max_search_results = 10000
+
+    def on_search_changed(self, widget):
+        self.stop_search()
+        self.search_results.clear()
+
+        if self.name_index is None:
+            return
+
+        query = self.search_entry.get_text()
+        prefix = self.search_prefix_button.get_active()
+        results = self.name_index.search(query, prefix)
+
+        unloaded = self.name_index.unloaded_count()
+        if unloaded and query:
+            self.display_status("%d CUs are not searched, they are not loaded yet" % unloaded)
+
+        # Results are added a batch at a time, so that typing is not blocked
+        # by a query with many matches.
+        self.search_source = GLib.idle_add(self.search_step, results)
+
+    def search_step(self, results):
+        for i in range(200):
+            entry = next(results, None)
+
+            if entry is None or len(self.search_results) >= self.max_search_results:
+                self.search_source = None
+                return False
+
+            elem = self.name_index.element(entry)
+            self.search_results.append([elem.name or "", elem.type_string or "", entry])
+
+        return True
+
+    def on_search_result_activated(self, view, path, column):
+        entry = self.search_results[path][2]
+        self.reveal_element(self.name_index.path(entry))
+
+    # Expand the tree along elem_path, a list of (group, position) as
+    # returned by NameIndex.path, and select the element at its end.
+    def reveal_element(self, elem_path):
+        store = self.tree.get_model()
+        it = store.get_iter_first()
+
+        for group, position in elem_path:
+            node = store.get_value(it, 3)
+            self.tree.expand_row(store.get_path(it), False)
+
+            # Rows of the groups before this one
+            n = 0
+            for group_id, children_list in node.children_groups.items():
+                if group_id == group:
+                    break
+
+                n += 1 if group_id is not None else len(children_list)
+
+            if group is not None:
+                it = store.iter_nth_child(it, n)
+                self.tree.expand_row(store.get_path(it), False)
+                it = store.iter_nth_child(it, position)
+            else:
+                it = store.iter_nth_child(it, n + position)
+
+        path = store.get_path(it)
+        self.tree.set_cursor(path, None, False)
+        self.tree.scroll_to_cell(path, None, True, 0.5, 0.0)
+
+    def on_menu_edit_go_to_address(self, widget):
+        if self.name_index is None:
+            return
+
+        dialog = Gtk.Dialog(title = "Go to address", parent = self)
+        dialog.add_button(Gtk.STOCK_OK, Gtk.ResponseType.OK)
+        dialog.add_button(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL)
+        dialog.set_default_response(Gtk.ResponseType.OK)
+
+        entry = Gtk.Entry()
+        entry.set_activates_default(True)
+        dialog.get_content_area().pack_start(entry, False, False, 0)
+        dialog.show_all()
+
+        resp = dialog.run()
+        text = entry.get_text().strip()
+        dialog.destroy()
+
+        if resp != Gtk.ResponseType.OK:
+            return
+
+        try:
+            addr = int(text, 16)
+        except ValueError:
+            self.display_status("Invalid address: %s" % text)
+            return
+
+        self.go_to_address(addr)
+
+    def go_to_address(self, addr):
+        if self.address_index is None:
+            self.address_index = AddressIndex(self.elf_input.get_dwarf_info())
+
+        scope = self.address_index.lookup(addr)
+        if scope is None:
+            self.display_status("No scope contains 0x%x" % addr)
+            return
+
+        # In a lazily built model, the CU may not be built yet.
+        entry = self.name_index.entry_at_offset(scope.chain()[0].offset)
+        if entry is not None:
+            cu_elem = self.name_index.element(entry)
+            if not self.name_index.is_loaded(cu_elem):
+                # Builds it
+                cu_elem.children_groups
+
+        # The innermost scope that is an element of the model
+        for s in reversed(scope.chain()):
+            entry = self.name_index.entry_at_offset(s.offset)
+            if entry is not None:
+                self.reveal_element(self.name_index.path(entry))
+                break
+
+        names = [s.name or "?" for s in scope.chain()]
+        self.display_status("0x%x: %s" % (addr, " > ".join(names)))
+
+    # Show the elements using the type of elem in the results list, building
+    # the type references first if needed.
+    # offset: that of the DIE of elem (see row_shared_type)
+    def find_type_users(self, elem, offset):
+        if self.type_references is not None:
+            self.show_type_users(elem, offset)
+            return
+
+        if self.name_index is None:
+            self.display_status("Wait for the file to be loaded")
+            return
+
+        self.stop_type_references()
+
+        di = self.elf_input.get_dwarf_info()
+        references = dwarfrefs.TypeReferences()
+        steps = dwarfrefs.build_type_references_step(di, references)
+        total = max(1, di.debug_info_sec.size)
+
+        self.display_status("Finding the type references...")
+        self.references_source = GLib.idle_add(self.type_references_step, steps, total, references, elem, offset)
+
+    # Read a CU at a time, so that the UI stays responsive.
+    def type_references_step(self, steps, total, references, elem, offset):
+        bytes_done = next(steps, None)
+
+        if bytes_done is not None:
+            self.load_progress(float(bytes_done) / total)
+            return True
+
+        self.references_source = None
+        self.type_references = references
+        self.show_type_users(elem, offset)
+
+        return False
+
+    def stop_type_references(self):
+        if self.references_source is not None:
+            GLib.source_remove(self.references_source)
+            self.references_source = None
+
+    def show_type_users(self, elem, offset):
+        users = self.type_references.users(offset)
+
+        self.stop_search()
+        self.search_results.clear()
+
+        # The users that are not elements of the model, e.g. the parameters
+        # of subroutine types, or in CUs not loaded yet
+        hidden = 0
+
+        for offset in users[:self.max_search_results]:
+            entry = self.name_index.entry_at_offset(offset)
+            if entry is None:
+                hidden += 1
+                continue
+
+            user = self.name_index.element(entry)
+            self.search_results.append([user.name or "", user.type_string or "", entry])
+
+        self.search_results_win.show()
+
+        status = "%d users of %s" % (len(users), elem.name)
+        if hidden:
+            status += ", %d not in the tree" % hidden
+
+            unloaded = self.name_index.unloaded_count()
+            if unloaded:
+                status += " (%d CUs are not loaded yet)" % unloaded
+        self.display_status(status)
+
+    def on_menu_view_statistics(self, widget):
+        if self.profiler is None:
+            self.display_status("Run with --profile to record statistics")
+            return
+
+        dialog = Gtk.Dialog(title = "Statistics", parent = self)
+        dialog.add_button(Gtk.STOCK_CLOSE, Gtk.ResponseType.CLOSE)
+        dialog.set_default_size(640, 400)
+
+        text_view = Gtk.TextView()
+        text_view.set_editable(False)
+        text_view.set_monospace(True)
+        text_view.get_buffer().set_text("\n".join(self.profiler.report()))
+
+        scrolled_win = Gtk.ScrolledWindow()
+        scrolled_win.add(text_view)
+        dialog.get_content_area().pack_start(scrolled_win, True, True, 0)
+
+        dialog.show_all()
+        dialog.run()
+        dialog.destroy()
 
     def on_menu_file_quit(self, widget):
         Gtk.main_quit()
@@ -230,17 +1158,206 @@ class DwarfUi(Gtk.Window):
         dialog.run()
         dialog.destroy()
 
-    def done_loading(self, root_elem):
+    def done_loading(self, root_elem, name_index, reveal_path = None, references = None):
+        self.switch_elf_input()
+        self.adopt_lazy_cus(root_elem)
+
+        if self.profiler is not None:
+            self.profiler.begin("tree store")
+
         store = self.build_tree_store(root_elem)
         self.tree.set_model(store)
+        self.root_elem = root_elem
+
+        if self.profiler is not None:
+            self.profiler.end()
+
+        self.name_index = name_index
+        self.type_references = references
+        self.on_search_changed(None)
+
+        if reveal_path is not None:
+            self.reveal_element(reveal_path)
+
         self.display_status("Done loading")
 
+        if self.profiler is not None:
+            print("\n".join(self.profiler.report()))
+
+    # The CUs of a lazily built model are built in the UI thread when their row
+    # is expanded. They get a builder of the window, reading its input: that
+    # of the loader thread is cancelled when another file is opened, while
+    # this model is still shown.
+    def adopt_lazy_cus(self, root_elem):
+        builder = None
+
+        for cu_elem in root_elem.children_groups.get(None, []):
+            if isinstance(cu_elem, LazyCuElement):
+                if builder is None:
+                    builder = DwarfModelBuilder(self.elf_input.get_dwarf_info(), self.verbose, single_pass = True,
+                                                dedup = self.dedup, profiler = self.profiler)
+                cu_elem.builder = builder
+
+    def set_cu_fingerprints(self, root_elem, fingerprints):
+        if root_elem is self.root_elem:
+            self.cu_fingerprints = fingerprints
+
+    # plan: for each CU of root_elem, the index of the CU of the previous model
+    #       it reuses, or None if it was built (see dwarfreload.plan_reload)
+    def done_reloading(self, root_elem, name_index, plan, fingerprints):
+        self.switch_elf_input()
+
+        store = self.tree.get_model()
+        root_iter = store.get_iter_first()
+        store.set_value(root_iter, 3, root_elem)
+
+        # The CU rows exist only if the root row was ever expanded.
+        placeholder_iter = store.iter_children(root_iter)
+        if placeholder_iter is not None and store.get_value(placeholder_iter, 3) is not None:
+            self.patch_cu_rows(store, root_iter, root_elem, plan)
+
+        self.root_elem = root_elem
+        self.cu_fingerprints = fingerprints
+        self.name_index = name_index
+        # The offsets of the DIEs may have changed.
+        self.type_references = None
+        self.on_search_changed(None)
+
+        rebuilt = sum(1 for old_index in plan if old_index is None)
+        self.display_status("Reloaded, %d of %d CUs changed" % (rebuilt, len(plan)))
+
+        if self.profiler is not None:
+            print("\n".join(self.profiler.report()))
+
+    # Make the CU rows under root_iter those of root_elem: the rows of the
+    # reused CUs are kept, so the rows expanded in them stay so, the others are
+    # replaced. The rows that were expanded in a replaced CU are expanded again
+    # in the new CU of the same name, as far as they can be found by name.
+    def patch_cu_rows(self, store, root_iter, root_elem, plan):
+        old_iters = []
+        it = store.iter_children(root_iter)
+        while it is not None:
+            old_iters.append(it)
+            it = store.iter_next(it)
+
+        reused = set(old_index for old_index in plan if old_index is not None)
+        # CU name -> names of the rows expanded in it
+        expanded = dict()
+
+        for old_index, it in enumerate(old_iters):
+            if old_index not in reused:
+                expanded.setdefault(store.get_value(it, 0), []).extend(self.expanded_rows(store, it))
+                store.remove(it)
+
+        cu_elems = root_elem.children_groups.get(None, [])
+
+        for position, (cu_elem, old_index) in enumerate(zip(cu_elems, plan)):
+            current = store.iter_nth_child(root_iter, position)
+
+            if old_index is not None:
+                it = old_iters[old_index]
+
+                if current is None or store.get_path(current) != store.get_path(it):
+                    store.move_before(it, current)
+
+                # The CU may have moved, its elements are then copies with
+                # other offsets and addresses.
+                self.rebind_rows(store, it, cu_elem)
+            else:
+                values = self.build_element_row_values(cu_elem)
+                it = store.insert(root_iter, position, values + [cu_elem])
+                self.append_placeholder_row(store, it, cu_elem)
+                self.expand_rows(store, it, expanded.get(cu_elem.name, []))
+
+    # Returns the names of the rows from it to the expanded rows under it
+    # (it included), parents first.
+    def expanded_rows(self, store, it):
+        ret = []
+        stack = [(it, ())]
+
+        while stack:
+            it, names = stack.pop()
+
+            if not self.tree.row_expanded(store.get_path(it)):
+                continue
+
+            ret.append(names)
+
+            child = store.iter_children(it)
+            while child is not None:
+                stack.append((child, names + (store.get_value(child, 0),)))
+                child = store.iter_next(child)
+
+        return ret
+
+    def expand_rows(self, store, it, names_list):
+        for names in names_list:
+            row = it
+
+            for name in names:
+                child = store.iter_children(row)
+                while child is not None and store.get_value(child, 0) != name:
+                    child = store.iter_next(child)
+
+                row = child
+                if row is None:
+                    break
+
+            if row is not None:
+                self.tree.expand_row(store.get_path(row), False)
+
+    # Make the row it, which shows an element identical to elem but for its
+    # offsets and addresses, and the rows created under it show elem and its
+    # descendants. The rows are matched in the order fill_tree_store_row
+    # creates them.
+    def rebind_rows(self, store, it, elem):
+        stack = [(it, elem, None)]
+
+        while stack:
+            it, node, shared = stack.pop()
+
+            if isinstance(node, Element):
+                store.set(it, [0, 1, 2, 3], self.build_element_row_values(node, shared) + [node])
+
+                if isinstance(node, SharedElement):
+                    shared = node
+
+                # What the rows under it stand for, in order
+                child_nodes = []
+                for group_id, children_list in node.children_groups.items():
+                    if group_id is not None:
+                        child_nodes.append(children_list)
+                    else:
+                        child_nodes.extend(children_list)
+            else:
+                store.set_value(it, 3, node)
+                child_nodes = node
+
+            child = store.iter_children(it)
+
+            # Not filled yet
+            if child is None or store.get_value(child, 3) is None:
+                continue
+
+            for child_node in child_nodes:
+                stack.append((child, child_node, shared))
+                child = store.iter_next(child)
+
     def display_status(self, text):
         self.statusbar.push(self.statusbar_context_id, text)
 
     def load_progress(self, fraction):
         self.loading_progress_bar.set_fraction(fraction)
 
+# Returns what tells that filename changed, or None if it doesn't exist.
+def file_stat(filename):
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
 def print_version():
     print("DWARF Tree version 0.00001bbb")
 
@@ -249,6 +1366,14 @@ if __name__ == "__main__":
     parser.add_argument('elfbinary', help = 'The ELF binary to analyze', nargs = '?')
     parser.add_argument('--verbose', action = "store_true")
     parser.add_argument('--version', action = "store_true")
+    parser.add_argument('--jobs', '-j', type = int, default = 1, help = 'Number of processes used to build the model')
+    parser.add_argument('--no-cache', action = "store_true", help = 'Do not use the cache of built models')
+    parser.add_argument('--symbol', help = 'Show this function, variable or type, only building the CUs it is in')
+    parser.add_argument('--dedup', action = "store_true", help = 'Share the identical types of different CUs')
+    parser.add_argument('--lazy', action = "store_true", help = 'Build the elements of a CU only when it is expanded')
+    parser.add_argument('--watch', action = "store_true", help = 'Reload the file when it changes, only building the CUs that changed')
+    parser.add_argument('--profile', nargs = '?', const = "time", choices = ["time", "allocations"],
+                        help = 'Print the time spent in each phase of loading, and optionally the memory allocated')
     args = parser.parse_args()
 
     if args.version:
@@ -258,7 +1383,9 @@ if __name__ == "__main__":
     if args.verbose:
         print('Verbose mode enabled.')
 
-    win = DwarfUi(args.elfbinary, verbose = args.verbose)
+    cache = None if args.no_cache else dwarfcache.ModelCache()
+
+    win = DwarfUi(args.elfbinary, verbose = args.verbose, lazy = args.lazy, jobs = args.jobs, cache = cache, symbol = args.symbol, dedup = args.dedup, profile = args.profile, watch = args.watch)
     win.show_all()
     signal.signal(signal.SIGINT, signal.SIG_DFL)
     Gtk.main()